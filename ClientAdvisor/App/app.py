@@ -1,28 +1,37 @@
-import copy
+import asyncio
+import base64
+import binascii
 import json
 import logging
 import os
 import time
 import uuid
-from types import SimpleNamespace
+from datetime import datetime
 
 import httpx
-import requests
+from azure.cosmos import exceptions
 from azure.identity.aio import (DefaultAzureCredential,
                                 get_bearer_token_provider)
 from dotenv import load_dotenv
 # from quart.sessions import SecureCookieSessionInterface
 from openai import AsyncAzureOpenAI
-from quart import (Blueprint, Quart, jsonify, make_response, render_template,
-                   request, send_from_directory)
+from quart import (Blueprint, Quart, current_app, jsonify, make_response,
+                   render_template, request, send_from_directory)
+from quart.json.provider import DefaultJSONProvider
 
 from backend.auth.auth_utils import (get_authenticated_user_details,
                                      get_tenantid)
 from backend.history.cosmosdbservice import CosmosConversationClient
-from backend.utils import (convert_to_pf_format, format_as_ndjson,
+from backend.history.localstore import (MemoryConversationStore,
+                                        SqliteConversationStore)
+from backend.history.store import PreconditionFailedError
+from backend.history.writebehind import WriteBehindQueue
+from backend.utils import (close_graph_client, coalesce_ndjson,
+                           convert_to_pf_format, format_as_ndjson,
                            format_pf_non_streaming_response,
                            format_stream_response, generateFilterString,
-                           parse_multi_columns)
+                           gzip_ndjson, json_dumps, json_loads,
+                           parse_multi_columns, stream_text_frame_formatter)
 from db import get_connection
 
 bp = Blueprint("routes", __name__, static_folder="static", template_folder="static")
@@ -49,8 +58,22 @@ UI_FAVICON = os.environ.get("UI_FAVICON") or "/favicon.ico"
 UI_SHOW_SHARE_BUTTON = os.environ.get("UI_SHOW_SHARE_BUTTON", "true").lower() == "true"
 
 
+class JSONProvider(DefaultJSONProvider):
+    """Serves jsonify and request.get_json through the fast JSON helpers."""
+
+    def dumps(self, obj, **kwargs):
+        # Indented debug output keeps the stdlib formatting
+        if "indent" in kwargs:
+            return super().dumps(obj, **kwargs)
+        return json_dumps(obj, default=self.default)
+
+    def loads(self, s, **kwargs):
+        return json_loads(s)
+
+
 def create_app():
     app = Quart(__name__)
+    app.json = JSONProvider(app)
     app.register_blueprint(bp)
     app.config["TEMPLATES_AUTO_RELOAD"] = True
     # app.secret_key = secrets.token_hex(16)
@@ -136,6 +159,12 @@ AZURE_OPENAI_MODEL_NAME = os.environ.get(
 AZURE_OPENAI_EMBEDDING_ENDPOINT = os.environ.get("AZURE_OPENAI_EMBEDDING_ENDPOINT")
 AZURE_OPENAI_EMBEDDING_KEY = os.environ.get("AZURE_OPENAI_EMBEDDING_KEY")
 AZURE_OPENAI_EMBEDDING_NAME = os.environ.get("AZURE_OPENAI_EMBEDDING_NAME", "")
+# Connection pool of the worker-wide Azure OpenAI client
+AZURE_OPENAI_MAX_CONNECTIONS = os.environ.get("AZURE_OPENAI_MAX_CONNECTIONS", 100)
+AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS = os.environ.get(
+    "AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS", 20
+)
+AZURE_OPENAI_KEEPALIVE_EXPIRY = os.environ.get("AZURE_OPENAI_KEEPALIVE_EXPIRY", 30.0)
 
 # CosmosDB Mongo vcore vector db Settings
 AZURE_COSMOSDB_MONGO_VCORE_CONNECTION_STRING = os.environ.get(
@@ -174,6 +203,33 @@ AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS = os.environ.get(
 )
 
 SHOULD_STREAM = True if AZURE_OPENAI_STREAM.lower() == "true" else False
+# Streamed lines are merged into chunks of up to this many bytes, or whatever is
+# pending after this many milliseconds; 0 sends every line on its own
+STREAM_COALESCE_MAX_BYTES = os.environ.get("STREAM_COALESCE_MAX_BYTES", 4096)
+STREAM_COALESCE_MAX_DELAY_MS = os.environ.get("STREAM_COALESCE_MAX_DELAY_MS", 30)
+
+# Where chat history is kept: "cosmosdb", or "memory" / "sqlite" to run the
+# history routes without a Cosmos DB account (the memory store is per worker)
+CHAT_HISTORY_STORE = os.environ.get("CHAT_HISTORY_STORE", "cosmosdb").lower()
+CHAT_HISTORY_SQLITE_PATH = os.environ.get("CHAT_HISTORY_SQLITE_PATH", "chat_history.db")
+# Answer /history/update once its messages are queued and write them from a
+# background task; the queue is drained when the worker shuts down
+CHAT_HISTORY_WRITE_BEHIND = (
+    os.environ.get("CHAT_HISTORY_WRITE_BEHIND", "false").lower() == "true"
+)
+CHAT_HISTORY_WRITE_BEHIND_QUEUE_SIZE = os.environ.get(
+    "CHAT_HISTORY_WRITE_BEHIND_QUEUE_SIZE", 1000
+)
+CHAT_HISTORY_WRITE_BEHIND_MAX_ATTEMPTS = os.environ.get(
+    "CHAT_HISTORY_WRITE_BEHIND_MAX_ATTEMPTS", 5
+)
+CHAT_HISTORY_WRITE_BEHIND_RETRY_DELAY_MS = os.environ.get(
+    "CHAT_HISTORY_WRITE_BEHIND_RETRY_DELAY_MS", 200
+)
+# Kept below gunicorn's graceful timeout (30s by default)
+CHAT_HISTORY_WRITE_BEHIND_DRAIN_TIMEOUT_SECONDS = os.environ.get(
+    "CHAT_HISTORY_WRITE_BEHIND_DRAIN_TIMEOUT_SECONDS", 25
+)
 
 # Chat History CosmosDB Integration Settings
 AZURE_COSMOSDB_DATABASE = os.environ.get("AZURE_COSMOSDB_DATABASE")
@@ -185,6 +241,53 @@ AZURE_COSMOSDB_ACCOUNT_KEY = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
 AZURE_COSMOSDB_ENABLE_FEEDBACK = (
     os.environ.get("AZURE_COSMOSDB_ENABLE_FEEDBACK", "false").lower() == "true"
 )
+# Deletes a single request keeps in flight when removing messages
+AZURE_COSMOSDB_DELETE_CONCURRENCY = os.environ.get(
+    "AZURE_COSMOSDB_DELETE_CONCURRENCY", 10
+)
+# Conversations a /history/delete_all job removes at the same time
+AZURE_COSMOSDB_DELETE_ALL_CONCURRENCY = os.environ.get(
+    "AZURE_COSMOSDB_DELETE_ALL_CONCURRENCY", 4
+)
+DELETE_ALL_PAGE_SIZE = 100
+# Keep a per-user index document so /history/list is a single point read; users
+# with more conversations than fit in it are partly listed by query
+AZURE_COSMOSDB_USE_CONVERSATION_INDEX = (
+    os.environ.get("AZURE_COSMOSDB_USE_CONVERSATION_INDEX", "false").lower() == "true"
+)
+AZURE_COSMOSDB_CONVERSATION_INDEX_SIZE = os.environ.get(
+    "AZURE_COSMOSDB_CONVERSATION_INDEX_SIZE", 1000
+)
+# Conversations (with their messages) each worker keeps for /history/read; 0
+# turns the cache off. Entries older than the TTL are revalidated by etag.
+AZURE_COSMOSDB_CACHE_SIZE = os.environ.get("AZURE_COSMOSDB_CACHE_SIZE", 0)
+AZURE_COSMOSDB_CACHE_TTL_SECONDS = os.environ.get(
+    "AZURE_COSMOSDB_CACHE_TTL_SECONDS", 30
+)
+# The container is partitioned by (userId, conversationId) rather than userId;
+# see tools/migrate_history_partition_key.py to copy an existing container
+AZURE_COSMOSDB_HIERARCHICAL_PARTITION_KEY = (
+    os.environ.get("AZURE_COSMOSDB_HIERARCHICAL_PARTITION_KEY", "false").lower()
+    == "true"
+)
+# New messages are stored in the conversation document, keeping the latest
+# ones up to a count and a size; older ones move out to message items
+AZURE_COSMOSDB_EMBED_MESSAGES = (
+    os.environ.get("AZURE_COSMOSDB_EMBED_MESSAGES", "false").lower() == "true"
+)
+AZURE_COSMOSDB_EMBEDDED_MESSAGES_MAX_COUNT = os.environ.get(
+    "AZURE_COSMOSDB_EMBEDDED_MESSAGES_MAX_COUNT", 50
+)
+AZURE_COSMOSDB_EMBEDDED_MESSAGES_MAX_BYTES = os.environ.get(
+    "AZURE_COSMOSDB_EMBEDDED_MESSAGES_MAX_BYTES", 1024 * 1024
+)
+# New conversations and messages expire this many days after their last write
+# (0 keeps them); the container needs TTL enabled. tools/archive_history.py
+# exports them before they go.
+AZURE_COSMOSDB_HISTORY_TTL_DAYS = os.environ.get("AZURE_COSMOSDB_HISTORY_TTL_DAYS", 0)
+# New conversations are listed under this many characters of the first user
+# message until the generated title is stored
+PROVISIONAL_TITLE_MAX_LENGTH = 50
 
 # Elasticsearch Integration Settings
 ELASTICSEARCH_ENDPOINT = os.environ.get("ELASTICSEARCH_ENDPOINT")
@@ -257,9 +360,19 @@ FUNCTIONAPP_CITATIONS_FIELD_NAME = os.environ.get(
 )
 AZUREFUNCTION_ENDPOINT = os.environ.get("AZUREFUNCTION_ENDPOINT")
 STREAMING_AZUREFUNCTION_ENDPOINT = os.environ.get("STREAMING_AZUREFUNCTION_ENDPOINT")
+# Connection pool and buffering of the worker-wide Azure Function client
+AZUREFUNCTION_MAX_CONNECTIONS = os.environ.get("AZUREFUNCTION_MAX_CONNECTIONS", 100)
+AZUREFUNCTION_MAX_KEEPALIVE_CONNECTIONS = os.environ.get(
+    "AZUREFUNCTION_MAX_KEEPALIVE_CONNECTIONS", 20
+)
+AZUREFUNCTION_CONNECT_TIMEOUT = os.environ.get("AZUREFUNCTION_CONNECT_TIMEOUT", 10.0)
+AZUREFUNCTION_READ_CHUNK_SIZE = os.environ.get("AZUREFUNCTION_READ_CHUNK_SIZE", 4096)
+AZUREFUNCTION_VERIFY_SSL = (
+    os.environ.get("AZUREFUNCTION_VERIFY_SSL", "true").lower() == "true"
+)
 # Frontend Settings via Environment Variables
 AUTH_ENABLED = os.environ.get("AUTH_ENABLED", "true").lower() == "true"
-CHAT_HISTORY_ENABLED = (
+CHAT_HISTORY_ENABLED = CHAT_HISTORY_STORE in ("memory", "sqlite") or bool(
     AZURE_COSMOSDB_ACCOUNT
     and AZURE_COSMOSDB_DATABASE
     and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER
@@ -364,12 +477,22 @@ def init_openai_client(use_data=SHOULD_USE_DATA):
         # Default Headers
         default_headers = {"x-ms-useragent": USER_AGENT}
 
+        # Pooled HTTP client, so keep-alive connections survive across chat turns
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=int(AZURE_OPENAI_MAX_CONNECTIONS),
+                max_keepalive_connections=int(AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS),
+                keepalive_expiry=float(AZURE_OPENAI_KEEPALIVE_EXPIRY),
+            )
+        )
+
         azure_openai_client = AsyncAzureOpenAI(
             api_version=AZURE_OPENAI_PREVIEW_API_VERSION,
             api_key=aoai_api_key,
             azure_ad_token_provider=ad_token_provider,
             default_headers=default_headers,
             azure_endpoint=endpoint,
+            http_client=http_client,
         )
 
         return azure_openai_client
@@ -379,9 +502,34 @@ def init_openai_client(use_data=SHOULD_USE_DATA):
         raise e
 
 
+# Worker-wide Azure OpenAI client. It is created when the worker starts serving
+# and shared by all requests, so chat turns reuse warm keep-alive connections
+# and the cached AAD token instead of building a new client per request.
+shared_openai_client = None
+
+
+def get_openai_client():
+    global shared_openai_client
+    if shared_openai_client is None:
+        shared_openai_client = init_openai_client()
+    return shared_openai_client
+
+
+def init_local_history_store():
+    if CHAT_HISTORY_STORE == "memory":
+        return MemoryConversationStore(
+            enable_message_feedback=AZURE_COSMOSDB_ENABLE_FEEDBACK
+        )
+    return SqliteConversationStore(
+        CHAT_HISTORY_SQLITE_PATH, enable_message_feedback=AZURE_COSMOSDB_ENABLE_FEEDBACK
+    )
+
+
 def init_cosmosdb_client():
     cosmos_conversation_client = None
-    if CHAT_HISTORY_ENABLED:
+    if CHAT_HISTORY_STORE in ("memory", "sqlite"):
+        cosmos_conversation_client = init_local_history_store()
+    elif CHAT_HISTORY_ENABLED:
         try:
             cosmos_endpoint = (
                 f"https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/"
@@ -398,6 +546,20 @@ def init_cosmosdb_client():
                 database_name=AZURE_COSMOSDB_DATABASE,
                 container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER,
                 enable_message_feedback=AZURE_COSMOSDB_ENABLE_FEEDBACK,
+                delete_concurrency=int(AZURE_COSMOSDB_DELETE_CONCURRENCY),
+                use_conversation_index=AZURE_COSMOSDB_USE_CONVERSATION_INDEX,
+                conversation_index_size=int(AZURE_COSMOSDB_CONVERSATION_INDEX_SIZE),
+                cache_size=int(AZURE_COSMOSDB_CACHE_SIZE),
+                cache_ttl=float(AZURE_COSMOSDB_CACHE_TTL_SECONDS),
+                hierarchical_partition_key=AZURE_COSMOSDB_HIERARCHICAL_PARTITION_KEY,
+                embed_messages=AZURE_COSMOSDB_EMBED_MESSAGES,
+                embedded_messages_max_count=int(
+                    AZURE_COSMOSDB_EMBEDDED_MESSAGES_MAX_COUNT
+                ),
+                embedded_messages_max_bytes=int(
+                    AZURE_COSMOSDB_EMBEDDED_MESSAGES_MAX_BYTES
+                ),
+                item_ttl_days=int(AZURE_COSMOSDB_HISTORY_TTL_DAYS),
             )
         except Exception as e:
             logging.exception("Exception in CosmosDB initialization", e)
@@ -409,7 +571,114 @@ def init_cosmosdb_client():
     return cosmos_conversation_client
 
 
-def get_configured_data_source():
+def init_function_client():
+    # The Azure Function streams its answer, so reads have no timeout
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(float(AZUREFUNCTION_CONNECT_TIMEOUT), read=None),
+        limits=httpx.Limits(
+            max_connections=int(AZUREFUNCTION_MAX_CONNECTIONS),
+            max_keepalive_connections=int(AZUREFUNCTION_MAX_KEEPALIVE_CONNECTIONS),
+        ),
+        verify=AZUREFUNCTION_VERIFY_SSL,
+    )
+
+
+# Worker-wide HTTP client for the Azure Function, so one slow call does not
+# block the worker and calls reuse pooled connections
+shared_function_client = None
+
+
+def get_function_client():
+    global shared_function_client
+    if shared_function_client is None:
+        shared_function_client = init_function_client()
+    return shared_function_client
+
+
+# Worker-wide chat history client. Routes borrow it instead of building a new
+# CosmosClient (with its own account metadata discovery) and closing it again
+# on every call.
+shared_cosmos_client = None
+
+
+def get_cosmosdb_client():
+    global shared_cosmos_client
+    if shared_cosmos_client is None:
+        shared_cosmos_client = init_cosmosdb_client()
+    return shared_cosmos_client
+
+
+# Worker-wide queue of chat history writes when write-behind is enabled
+shared_history_writer = None
+
+
+def get_history_writer():
+    global shared_history_writer
+    if shared_history_writer is None:
+        shared_history_writer = WriteBehindQueue(
+            get_cosmosdb_client,
+            max_size=int(CHAT_HISTORY_WRITE_BEHIND_QUEUE_SIZE),
+            max_attempts=int(CHAT_HISTORY_WRITE_BEHIND_MAX_ATTEMPTS),
+            retry_delay=float(CHAT_HISTORY_WRITE_BEHIND_RETRY_DELAY_MS) / 1000,
+        )
+    return shared_history_writer
+
+
+@bp.before_app_serving
+async def init_shared_clients():
+    global shared_openai_client, shared_cosmos_client, shared_function_client
+    if USE_AZUREFUNCTION:
+        shared_function_client = init_function_client()
+
+    try:
+        shared_openai_client = init_openai_client()
+    except Exception:
+        logging.warning(
+            "Azure OpenAI client could not be created at startup, "
+            "it will be created on first use"
+        )
+
+    try:
+        shared_cosmos_client = init_cosmosdb_client()
+        if shared_cosmos_client:
+            # Warm up the connection and the database/container metadata caches
+            success, err = await shared_cosmos_client.ensure()
+            if not success:
+                logging.warning(f"CosmosDB warm-up failed: {err}")
+    except Exception:
+        logging.warning(
+            "CosmosDB client could not be created at startup, "
+            "it will be created on first use"
+        )
+
+
+@bp.after_app_serving
+async def close_shared_clients():
+    global shared_openai_client, shared_cosmos_client, shared_function_client
+    global shared_history_writer
+    if shared_history_writer is not None:
+        # queued history still needs the cosmos client, so it goes first
+        await shared_history_writer.close(
+            float(CHAT_HISTORY_WRITE_BEHIND_DRAIN_TIMEOUT_SECONDS)
+        )
+        shared_history_writer = None
+
+    if shared_function_client is not None:
+        await shared_function_client.aclose()
+        shared_function_client = None
+
+    await close_graph_client()
+
+    if shared_openai_client is not None:
+        await shared_openai_client.close()
+        shared_openai_client = None
+
+    if shared_cosmos_client is not None:
+        await shared_cosmos_client.close()
+        shared_cosmos_client = None
+
+
+def build_data_source_template():
     data_source = {}
     query_type = "simple"
     if DATASOURCE_TYPE == "AzureCognitiveSearch":
@@ -422,20 +691,6 @@ def get_configured_data_source():
         ):
             query_type = "semantic"
 
-        # Set filter
-        filter = None
-        userToken = None
-        if AZURE_SEARCH_PERMITTED_GROUPS_COLUMN:
-            userToken = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
-            logging.debug(f"USER TOKEN is {'present' if userToken else 'not present'}")
-            if not userToken:
-                raise Exception(
-                    "Document-level access control is enabled, but user access token could not be fetched."
-                )
-
-            filter = generateFilterString(userToken)
-            logging.debug(f"FILTER: {filter}")
-
         # Set authentication
         authentication = {}
         if AZURE_SEARCH_KEY:
@@ -486,7 +741,8 @@ def get_configured_data_source():
                     else ""
                 ),
                 "role_information": AZURE_OPENAI_SYSTEM_MESSAGE,
-                "filter": filter,
+                # Overlaid per request when document-level security is enabled
+                "filter": None,
                 "strictness": (
                     int(AZURE_SEARCH_STRICTNESS)
                     if AZURE_SEARCH_STRICTNESS
@@ -738,7 +994,74 @@ def get_configured_data_source():
     return data_source
 
 
-def prepare_model_args(request_body, request_headers):
+# The data source payload only depends on configuration, so it is built and
+# validated once when the module loads: a bad setting fails worker startup
+# instead of every chat request. The template is shared by all requests and
+# must not be mutated; per-request values are overlaid on shallow copies.
+DATA_SOURCE_TEMPLATE = build_data_source_template() if SHOULD_USE_DATA else None
+
+
+async def get_configured_data_source():
+    data_source = DATA_SOURCE_TEMPLATE or build_data_source_template()
+
+    # Set filter
+    if (
+        DATASOURCE_TYPE == "AzureCognitiveSearch"
+        and AZURE_SEARCH_PERMITTED_GROUPS_COLUMN
+    ):
+        userToken = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
+        logging.debug(f"USER TOKEN is {'present' if userToken else 'not present'}")
+        if not userToken:
+            raise Exception(
+                "Document-level access control is enabled, but user access token could not be fetched."
+            )
+
+        filter = await generateFilterString(userToken)
+        logging.debug(f"FILTER: {filter}")
+        data_source = {
+            **data_source,
+            "parameters": {**data_source["parameters"], "filter": filter},
+        }
+
+    return data_source
+
+
+SECRET_PARAMS = [
+    "key",
+    "connection_string",
+    "embedding_key",
+    "encoded_api_key",
+    "api_key",
+]
+
+
+def redact_data_source(data_source):
+    # Copy only the parts that hold secrets, the rest is shared with the template
+    parameters = dict(data_source["parameters"])
+    for secret_param in SECRET_PARAMS:
+        if parameters.get(secret_param):
+            parameters[secret_param] = "*****"
+
+    if "authentication" in parameters:
+        parameters["authentication"] = {
+            field: "*****" if field in SECRET_PARAMS else value
+            for field, value in parameters["authentication"].items()
+        }
+
+    embeddingDependency = parameters.get("embedding_dependency", {})
+    if "authentication" in embeddingDependency:
+        parameters["embedding_dependency"] = {
+            **embeddingDependency,
+            "authentication": {
+                field: "*****" if field in SECRET_PARAMS else value
+                for field, value in embeddingDependency["authentication"].items()
+            },
+        }
+
+    return {**data_source, "parameters": parameters}
+
+
+async def prepare_model_args(request_body, request_headers):
     request_messages = request_body.get("messages", [])
     messages = []
     if not SHOULD_USE_DATA:
@@ -780,43 +1103,20 @@ def prepare_model_args(request_body, request_headers):
     }
 
     if SHOULD_USE_DATA:
-        model_args["extra_body"] = {"data_sources": [get_configured_data_source()]}
-
-    model_args_clean = copy.deepcopy(model_args)
-    if model_args_clean.get("extra_body"):
-        secret_params = [
-            "key",
-            "connection_string",
-            "embedding_key",
-            "encoded_api_key",
-            "api_key",
-        ]
-        for secret_param in secret_params:
-            if model_args_clean["extra_body"]["data_sources"][0]["parameters"].get(
-                secret_param
-            ):
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    secret_param
-                ] = "*****"
-        authentication = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("authentication", {})
-        for field in authentication:
-            if field in secret_params:
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    "authentication"
-                ][field] = "*****"
-        embeddingDependency = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("embedding_dependency", {})
-        if "authentication" in embeddingDependency:
-            for field in embeddingDependency["authentication"]:
-                if field in secret_params:
-                    model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                        "embedding_dependency"
-                    ]["authentication"][field] = "*****"
-
-    logging.debug(f"REQUEST BODY: {json.dumps(model_args_clean, indent=4)}")
+        model_args["extra_body"] = {
+            "data_sources": [await get_configured_data_source()]
+        }
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        model_args_clean = dict(model_args)
+        if model_args.get("extra_body"):
+            model_args_clean["extra_body"] = {
+                "data_sources": [
+                    redact_data_source(data_source)
+                    for data_source in model_args["extra_body"]["data_sources"]
+                ]
+            }
+        logging.debug(f"REQUEST BODY: {json.dumps(model_args_clean, indent=4)}")
 
     return model_args
 
@@ -862,10 +1162,10 @@ async def send_chat_request(request_body, request_headers):
             filtered_messages.append(message)
 
     request_body["messages"] = filtered_messages
-    model_args = prepare_model_args(request_body, request_headers)
+    model_args = await prepare_model_args(request_body, request_headers)
 
     try:
-        azure_openai_client = init_openai_client()
+        azure_openai_client = get_openai_client()
         raw_response = (
             await azure_openai_client.chat.completions.with_raw_response.create(
                 **model_args
@@ -879,6 +1179,21 @@ async def send_chat_request(request_body, request_headers):
     return response, apim_request_id
 
 
+async def read_azure_function_response(endpoint):
+    # Collect the raw body on the shared client without blocking the event loop,
+    # then split it once instead of concatenating strings line by line
+    body = bytearray()
+    async with get_function_client().stream("GET", endpoint) as response:
+        async for chunk in response.aiter_bytes(
+            chunk_size=int(AZUREFUNCTION_READ_CHUNK_SIZE)
+        ):
+            body.extend(chunk)
+
+    lines = [line.decode("utf-8") for line in body.splitlines()]
+    # Every line is prefixed with a newline, as the line-by-line reader did
+    return "\n" + "\n".join(lines) if lines else ""
+
+
 async def complete_chat_request(request_body, request_headers):
     if USE_PROMPTFLOW and PROMPTFLOW_ENDPOINT and PROMPTFLOW_API_KEY:
         response = await promptflow_request(request_body)
@@ -890,47 +1205,22 @@ async def complete_chat_request(request_body, request_headers):
             PROMPTFLOW_CITATIONS_FIELD_NAME,
         )
     elif USE_AZUREFUNCTION:
-        request_body = await request.get_json()
         client_id = request_body.get("client_id")
-        print(request_body)
+        logging.debug(f"Client ID in complete_chat_request: {client_id}")
 
         if client_id is None:
             return jsonify({"error": "No client ID provided"}), 400
-        # client_id = '10005'
-        print("Client ID in complete_chat_request: ", client_id)
-        # answer = "Sample response from Azure Function"
-        # Construct the URL of your Azure Function endpoint
-        # function_url = STREAMING_AZUREFUNCTION_ENDPOINT
-
-        # request_headers = {
-        #     "Content-Type": "application/json",
-        #     # 'Authorization': 'Bearer YOUR_TOKEN_HERE'  # if applicable
-        # }
-        # print(request_body.get("messages")[-1].get("content"))
-        # print(request_body)
 
         query = request_body.get("messages")[-1].get("content")
-
-        print("Selected ClientId:", client_id)
-        # print("Selected ClientName:", selected_client_name)
-
-        # endpoint = STREAMING_AZUREFUNCTION_ENDPOINT + '?query=' + query + ' - for Client ' + selected_client_name + ':::' + selected_client_id
         endpoint = (
             STREAMING_AZUREFUNCTION_ENDPOINT + "?query=" + query + ":::" + client_id
         )
 
-        print("Endpoint: ", endpoint)
         query_response = ""
         try:
-            with requests.get(endpoint, stream=True) as r:
-                for line in r.iter_lines(chunk_size=10):
-                    # query_response += line.decode('utf-8')
-                    query_response = query_response + "\n" + line.decode("utf-8")
-                    # print(line.decode('utf-8'))
-        except Exception as e:
-            print(format_as_ndjson({"error" + str(e)}))
-
-        # print("query_response: " + query_response)
+            query_response = await read_azure_function_response(endpoint)
+        except Exception:
+            logging.exception("Exception while reading the Azure Function response")
 
         history_metadata = request_body.get("history_metadata", {})
         response = {
@@ -967,49 +1257,22 @@ async def stream_chat_request(request_body, request_headers):
         query = request_body.get("messages")[-1].get("content")
         query = query.strip()
 
+        query_url = function_url + "?query=" + query + ":::" + client_id
+        # Everything but the text is fixed for the whole answer, so it is
+        # serialized once here instead of once per chunk
+        format_frame = stream_text_frame_formatter(
+            str(uuid.uuid4()),
+            AZURE_OPENAI_MODEL_NAME,
+            int(time.time()),
+            history_metadata,
+            apim_request_id,
+        )
+
         async def generate():
-            deltaText = ""
-            # async for completionChunk in response:
-            timeout = httpx.Timeout(10.0, read=None)
-            async with httpx.AsyncClient(
-                verify=False, timeout=timeout
-            ) as client:  # verify=False for development purposes
-                query_url = function_url + "?query=" + query + ":::" + client_id
-                async with client.stream("GET", query_url) as response:
-                    async for chunk in response.aiter_text():
-                        deltaText = ""
-                        deltaText = chunk
-                        completionChunk1 = {
-                            "id": "",
-                            "model": "",
-                            "created": 0,
-                            "object": "",
-                            "choices": [{"messages": [], "delta": {}}],
-                            "apim-request-id": "",
-                            "history_metadata": history_metadata,
-                        }
-
-                        completionChunk1["id"] = str(uuid.uuid4())
-                        completionChunk1["model"] = AZURE_OPENAI_MODEL_NAME
-                        completionChunk1["created"] = int(time.time())
-                        completionChunk1["object"] = "extensions.chat.completion.chunk"
-                        completionChunk1["apim-request-id"] = request_headers.get(
-                            "apim-request-id"
-                        )
-                        completionChunk1["choices"][0]["messages"].append(
-                            {"role": "assistant", "content": deltaText}
-                        )
-                        completionChunk1["choices"][0]["delta"] = {
-                            "role": "assistant",
-                            "content": deltaText,
-                        }
-                        completionChunk2 = json.loads(
-                            json.dumps(completionChunk1),
-                            object_hook=lambda d: SimpleNamespace(**d),
-                        )
-                        yield format_stream_response(
-                            completionChunk2, history_metadata, apim_request_id
-                        )
+            async with get_function_client().stream("GET", query_url) as response:
+                async for chunk in response.aiter_text():
+                    if chunk:
+                        yield format_frame(chunk)
 
         return generate()
 
@@ -1032,7 +1295,13 @@ async def conversation_internal(request_body, request_headers):
     try:
         if SHOULD_STREAM:
             result = await stream_chat_request(request_body, request_headers)
-            response = await make_response(format_as_ndjson(result))
+            response = await make_response(
+                coalesce_ndjson(
+                    format_as_ndjson(result),
+                    int(STREAM_COALESCE_MAX_BYTES),
+                    float(STREAM_COALESCE_MAX_DELAY_MS) / 1000,
+                )
+            )
             response.timeout = None
             response.mimetype = "application/json-lines"
             return response
@@ -1078,20 +1347,28 @@ async def add_conversation():
 
     try:
         # make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmosdb_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
         # check for the conversation_id, if the conversation is not set, we will create a new one
         history_metadata = {}
         if not conversation_id:
-            title = await generate_title(request_json["messages"])
+            # start with a provisional title so the answer is not held up by a
+            # second model call; the generated one replaces it in the background
+            title = provisional_title(request_json["messages"])
             conversation_dict = await cosmos_conversation_client.create_conversation(
                 user_id=user_id, title=title
             )
             conversation_id = conversation_dict["id"]
             history_metadata["title"] = title
             history_metadata["date"] = conversation_dict["createdAt"]
+            current_app.add_background_task(
+                update_generated_title,
+                user_id,
+                conversation_id,
+                request_json["messages"],
+            )
 
         # Format the incoming message object in the "chat/completions" messages format
         # then write it to the conversation history in cosmos
@@ -1112,8 +1389,6 @@ async def add_conversation():
         else:
             raise Exception("No user message found")
 
-        await cosmos_conversation_client.cosmosdb_client.close()
-
         # Submit request to Chat Completions for response
         request_body = await request.get_json()
         history_metadata["conversation_id"] = conversation_id
@@ -1136,7 +1411,7 @@ async def update_conversation():
 
     try:
         # make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmosdb_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
@@ -1148,6 +1423,11 @@ async def update_conversation():
         # then write it to the conversation history in cosmos
         messages = request_json["messages"]
         if len(messages) > 0 and messages[-1]["role"] == "assistant":
+            if CHAT_HISTORY_WRITE_BEHIND and queue_history_messages(
+                user_id, conversation_id, messages
+            ):
+                return jsonify({"success": True, "queued": True}), 202
+
             if len(messages) > 1 and messages[-2].get("role", None) == "tool":
                 # write the tool message first
                 await cosmos_conversation_client.create_message(
@@ -1167,7 +1447,6 @@ async def update_conversation():
             raise Exception("No bot messages found")
 
         # Submit request to Chat Completions for response
-        await cosmos_conversation_client.cosmosdb_client.close()
         response = {"success": True}
         return jsonify(response), 200
 
@@ -1176,11 +1455,32 @@ async def update_conversation():
         return jsonify({"error": str(e)}), 500
 
 
+def queue_history_messages(user_id, conversation_id, messages):
+    # the tool message gets its id now, so a retried write does not duplicate
+    # it, and both get their createdAt now, so a write delayed by retries still
+    # sorts before the user's next message
+    pending = []
+    if len(messages) > 1 and messages[-2].get("role", None) == "tool":
+        pending.append(
+            {
+                **messages[-2],
+                "id": str(uuid.uuid4()),
+                "createdAt": datetime.utcnow().isoformat(),
+            }
+        )
+    pending.append({**messages[-1], "createdAt": datetime.utcnow().isoformat()})
+
+    if get_history_writer().enqueue(user_id, conversation_id, pending):
+        return True
+    logging.warning("Chat history write queue is full, writing directly")
+    return False
+
+
 @bp.route("/history/message_feedback", methods=["POST"])
 async def update_message():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmosdb_client()
 
     # check request for message_id
     request_json = await request.get_json()
@@ -1193,9 +1493,9 @@ async def update_message():
         if not message_feedback:
             return jsonify({"error": "message_feedback is required"}), 400
 
-        # update the message in cosmos
+        # update the message in cosmos, optionally only if it is unchanged
         updated_message = await cosmos_conversation_client.update_message_feedback(
-            user_id, message_id, message_feedback
+            user_id, message_id, message_feedback, etag=request.headers.get("If-Match")
         )
         if updated_message:
             return (
@@ -1217,6 +1517,11 @@ async def update_message():
                 404,
             )
 
+    except (exceptions.CosmosAccessConditionFailedError, PreconditionFailedError):
+        return (
+            jsonify({"error": f"Message {message_id} was modified concurrently."}),
+            412,
+        )
     except Exception as e:
         logging.exception("Exception in /history/message_feedback")
         return jsonify({"error": str(e)}), 500
@@ -1237,7 +1542,7 @@ async def delete_conversation():
             return jsonify({"error": "conversation_id is required"}), 400
 
         # make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmosdb_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
@@ -1247,8 +1552,6 @@ async def delete_conversation():
         # Now delete the conversation
         await cosmos_conversation_client.delete_conversation(user_id, conversation_id)
 
-        await cosmos_conversation_client.cosmosdb_client.close()
-
         return (
             jsonify(
                 {
@@ -1263,22 +1566,65 @@ async def delete_conversation():
         return jsonify({"error": str(e)}), 500
 
 
+def encode_cursor(continuation_token):
+    # continuation tokens are passed to the client as an opaque cursor
+    if not continuation_token:
+        return None
+    return base64.urlsafe_b64encode(continuation_token.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+    except (binascii.Error, UnicodeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
 @bp.route("/history/list", methods=["GET"])
 async def list_conversations():
     offset = request.args.get("offset", 0)
+    cursor = request.args.get("cursor", None)
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
 
     # make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmosdb_client()
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
+    # a cursor argument (empty for the first page) switches to continuation
+    # token paging; plain offset paging is kept for existing clients
+    if cursor is not None:
+        try:
+            conversations, continuation_token = (
+                await cosmos_conversation_client.get_conversations_page(
+                    user_id, limit=25, continuation_token=decode_cursor(cursor)
+                )
+            )
+        except ValueError:
+            return jsonify({"error": "cursor is invalid"}), 400
+        except exceptions.CosmosHttpResponseError as e:
+            # the cursor decoded but is not a token cosmos accepts
+            if e.status_code != 400:
+                raise
+            return jsonify({"error": "cursor is invalid"}), 400
+
+        return (
+            jsonify(
+                {
+                    "conversations": conversations,
+                    "next": encode_cursor(continuation_token),
+                }
+            ),
+            200,
+        )
+
     # get the conversations from cosmos
     conversations = await cosmos_conversation_client.get_conversations(
         user_id, offset=offset, limit=25
     )
-    await cosmos_conversation_client.cosmosdb_client.close()
     if not isinstance(conversations, list):
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
@@ -1300,7 +1646,7 @@ async def get_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
 
     # make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmosdb_client()
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
@@ -1319,27 +1665,111 @@ async def get_conversation():
             404,
         )
 
+    if request_json.get("stream"):
+        # one NDJSON line for the conversation, then one per message as cosmos
+        # pages them in
+        response = await make_response(
+            coalesce_ndjson(
+                format_as_ndjson(
+                    stream_conversation_messages(
+                        cosmos_conversation_client,
+                        user_id,
+                        conversation_id,
+                        conversation,
+                    )
+                ),
+                int(STREAM_COALESCE_MAX_BYTES),
+                float(STREAM_COALESCE_MAX_DELAY_MS) / 1000,
+            )
+        )
+        response.timeout = None
+        response.mimetype = "application/json-lines"
+        return response
+
     # get the messages for the conversation from cosmos
     conversation_messages = await cosmos_conversation_client.get_messages(
-        user_id, conversation_id
+        user_id, conversation_id, conversation
     )
 
     # format the messages in the bot frontend format
-    messages = [
-        {
-            "id": msg["id"],
-            "role": msg["role"],
-            "content": msg["content"],
-            "createdAt": msg["createdAt"],
-            "feedback": msg.get("feedback"),
-        }
-        for msg in conversation_messages
-    ]
+    messages = [format_history_message(msg) for msg in conversation_messages]
 
-    await cosmos_conversation_client.cosmosdb_client.close()
     return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
 
 
+def format_history_message(msg):
+    return {
+        "id": msg["id"],
+        "role": msg["role"],
+        "content": msg["content"],
+        "createdAt": msg["createdAt"],
+        "feedback": msg.get("feedback"),
+    }
+
+
+async def stream_conversation_messages(
+    cosmos_conversation_client, user_id, conversation_id, conversation=None
+):
+    yield {"conversation_id": conversation_id}
+    async for msg in cosmos_conversation_client.iter_messages(
+        user_id, conversation_id, conversation
+    ):
+        yield {"message": format_history_message(msg)}
+
+
+@bp.route("/history/export", methods=["GET"])
+async def export_history():
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user["user_principal_id"]
+
+    # make sure cosmos is configured
+    cosmos_conversation_client = get_cosmosdb_client()
+    if not cosmos_conversation_client:
+        raise Exception("CosmosDB is not configured or not working")
+
+    # the documents are compressed as cosmos pages them in, so the export
+    # holds about one page and one compressed chunk whatever the history size
+    response = await make_response(
+        gzip_ndjson(stream_history_export(cosmos_conversation_client, user_id))
+    )
+    response.timeout = None
+    response.mimetype = "application/gzip"
+    response.headers["Content-Disposition"] = (
+        'attachment; filename="chat-history.jsonl.gz"'
+    )
+    return response
+
+
+# Stored for embedding messages; they are exported as message lines instead
+EMBEDDED_MESSAGE_FIELDS = ("messages", "messagesSize", "messagesOverflow")
+
+
+def format_export_document(document):
+    # system properties (_rid, _etag, _ts, ...) are left out
+    return {
+        key: value
+        for key, value in document.items()
+        if not key.startswith("_") and key not in EMBEDDED_MESSAGE_FIELDS
+    }
+
+
+async def stream_history_export(cosmos_conversation_client, user_id):
+    # one line per conversation, followed by one per message in it
+    try:
+        async for conversation in cosmos_conversation_client.iter_conversations(
+            user_id
+        ):
+            yield {"conversation": format_export_document(conversation)}
+            async for msg in cosmos_conversation_client.iter_messages(
+                user_id, conversation["id"], conversation
+            ):
+                yield {"message": format_export_document(msg)}
+    except Exception as error:
+        # the response has started, so the error ends the export instead
+        logging.exception("Exception while exporting chat history")
+        yield {"error": str(error)}
+
+
 @bp.route("/history/rename", methods=["POST"])
 async def rename_conversation():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
@@ -1353,15 +1783,30 @@ async def rename_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
 
     # make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmosdb_client()
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
-    # get the conversation from cosmos
-    conversation = await cosmos_conversation_client.get_conversation(
-        user_id, conversation_id
-    )
-    if not conversation:
+    # update the title
+    title = request_json.get("title", None)
+    if not title:
+        return jsonify({"error": "title is required"}), 400
+
+    # patch the title in cosmos, optionally only if the conversation is unchanged
+    try:
+        updated_conversation = (
+            await cosmos_conversation_client.update_conversation_title(
+                user_id, conversation_id, title, etag=request.headers.get("If-Match")
+            )
+        )
+    except (exceptions.CosmosAccessConditionFailedError, PreconditionFailedError):
+        return (
+            jsonify(
+                {"error": f"Conversation {conversation_id} was modified concurrently."}
+            ),
+            412,
+        )
+    if not updated_conversation:
         return (
             jsonify(
                 {
@@ -1371,16 +1816,6 @@ async def rename_conversation():
             404,
         )
 
-    # update the title
-    title = request_json.get("title", None)
-    if not title:
-        return jsonify({"error": "title is required"}), 400
-    conversation["title"] = title
-    updated_conversation = await cosmos_conversation_client.upsert_conversation(
-        conversation
-    )
-
-    await cosmos_conversation_client.cosmosdb_client.close()
     return jsonify(updated_conversation), 200
 
 
@@ -1393,42 +1828,135 @@ async def delete_all_conversations():
     # get conversations for user
     try:
         # make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmosdb_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        conversations = await cosmos_conversation_client.get_conversations(
-            user_id, offset=0, limit=None
+        conversation_ids, _ = await cosmos_conversation_client.get_conversation_ids(
+            user_id, page_size=1
         )
-        if not conversations:
+        if not conversation_ids:
             return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
-        # delete each conversation
-        for conversation in conversations:
-            # delete the conversation messages from cosmos first
-            await cosmos_conversation_client.delete_messages(
-                conversation["id"], user_id
-            )
+        # deleting everything can outlast the request timeout, so it runs as a
+        # job whose progress is kept in cosmos for whichever worker is asked
+        job = await cosmos_conversation_client.create_job(user_id, "delete_all")
+        current_app.add_background_task(
+            delete_all_conversations_job, user_id, job["id"]
+        )
+        response = jsonify(
+            {
+                "message": f"Deleting conversations and messages for user {user_id}",
+                "job_id": job["id"],
+                "status": job["status"],
+            }
+        )
+        response.headers["Location"] = f"/history/delete_all/{job['id']}"
+        return response, 202
+
+    except Exception as e:
+        logging.exception("Exception in /history/delete_all")
+        return jsonify({"error": str(e)}), 500
+
+
+@bp.route("/history/delete_all/<job_id>", methods=["GET"])
+async def get_delete_all_status(job_id):
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user["user_principal_id"]
+
+    try:
+        # make sure cosmos is configured
+        cosmos_conversation_client = get_cosmosdb_client()
+        if not cosmos_conversation_client:
+            raise Exception("CosmosDB is not configured or not working")
+
+        job = await cosmos_conversation_client.get_job(user_id, job_id)
+        if not job or job.get("kind") != "delete_all":
+            return jsonify({"error": f"Job {job_id} was not found"}), 404
 
-            # Now delete the conversation
-            await cosmos_conversation_client.delete_conversation(
-                user_id, conversation["id"]
-            )
-        await cosmos_conversation_client.cosmosdb_client.close()
         return (
             jsonify(
                 {
-                    "message": f"Successfully deleted conversation and messages for user {user_id}"
+                    "job_id": job["id"],
+                    "status": job["status"],
+                    "deleted": job["deleted"],
+                    "failed": job["failed"],
+                    "error": job.get("error"),
+                    "createdAt": job["createdAt"],
+                    "updatedAt": job["updatedAt"],
                 }
             ),
             200,
         )
 
     except Exception as e:
-        logging.exception("Exception in /history/delete_all")
+        logging.exception("Exception in /history/delete_all/<job_id>")
         return jsonify({"error": str(e)}), 500
 
 
+async def delete_all_conversations_job(user_id, job_id):
+    cosmos_conversation_client = get_cosmosdb_client()
+    semaphore = asyncio.Semaphore(int(AZURE_COSMOSDB_DELETE_ALL_CONCURRENCY))
+    deleted = 0
+    failed = 0
+
+    async def delete_conversation(conversation_id):
+        async with semaphore:
+            try:
+                # delete the conversation messages from cosmos first
+                await cosmos_conversation_client.delete_messages(
+                    conversation_id, user_id
+                )
+
+                # Now delete the conversation
+                await cosmos_conversation_client.delete_conversation(
+                    user_id, conversation_id
+                )
+                return True
+            except Exception:
+                logging.exception(f"Exception deleting conversation {conversation_id}")
+                return False
+
+    try:
+        # deleted conversations do not shift later pages of this query, so the
+        # continuation token stays valid while the job deletes what it has read
+        continuation_token = None
+        while True:
+            conversation_ids, continuation_token = (
+                await cosmos_conversation_client.get_conversation_ids(
+                    user_id, DELETE_ALL_PAGE_SIZE, continuation_token
+                )
+            )
+            results = await asyncio.gather(
+                *(
+                    delete_conversation(conversation_id)
+                    for conversation_id in conversation_ids
+                )
+            )
+            deleted += results.count(True)
+            failed += results.count(False)
+            await cosmos_conversation_client.update_job(
+                user_id, job_id, deleted=deleted, failed=failed
+            )
+            if not continuation_token:
+                break
+
+        await cosmos_conversation_client.update_job(
+            user_id, job_id, status="failed" if failed else "succeeded"
+        )
+    except asyncio.CancelledError:
+        # the worker is shutting down; leave a status the client can act on
+        await cosmos_conversation_client.update_job(
+            user_id, job_id, status="interrupted"
+        )
+        raise
+    except Exception as e:
+        logging.exception("Exception in delete_all job")
+        await cosmos_conversation_client.update_job(
+            user_id, job_id, status="failed", error=str(e)
+        )
+
+
 @bp.route("/history/clear", methods=["POST"])
 async def clear_messages():
     # get the user id from the request headers
@@ -1444,7 +1972,7 @@ async def clear_messages():
             return jsonify({"error": "conversation_id is required"}), 400
 
         # make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmosdb_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
@@ -1467,18 +1995,17 @@ async def clear_messages():
 
 @bp.route("/history/ensure", methods=["GET"])
 async def ensure_cosmos():
-    if not AZURE_COSMOSDB_ACCOUNT:
+    if CHAT_HISTORY_STORE == "cosmosdb" and not AZURE_COSMOSDB_ACCOUNT:
         return jsonify({"error": "CosmosDB is not configured"}), 404
 
     try:
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmosdb_client()
         success, err = await cosmos_conversation_client.ensure()
         if not cosmos_conversation_client or not success:
             if err:
                 return jsonify({"error": err}), 422
             return jsonify({"error": "CosmosDB is not configured or not working"}), 500
 
-        await cosmos_conversation_client.cosmosdb_client.close()
         return jsonify({"message": "CosmosDB is configured and working"}), 200
     except Exception as e:
         logging.exception("Exception in /history/ensure")
@@ -1507,6 +2034,19 @@ async def ensure_cosmos():
             return jsonify({"error": "CosmosDB is not working"}), 500
 
 
+@bp.route("/history/cache_stats", methods=["GET"])
+async def get_cache_stats():
+    # hit and miss counters of this worker's conversation cache
+    cosmos_conversation_client = get_cosmosdb_client()
+    if not cosmos_conversation_client:
+        return jsonify({"error": "CosmosDB is not configured"}), 404
+
+    stats = cosmos_conversation_client.cache_stats()
+    if stats is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **stats}), 200
+
+
 async def generate_title(conversation_messages):
     # make sure the messages are sorted by _ts descending
     title_prompt = 'Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Respond with a json object in the format {{"title": string}}. Do not include any other commentary or description.'
@@ -1518,7 +2058,7 @@ async def generate_title(conversation_messages):
     messages.append({"role": "user", "content": title_prompt})
 
     try:
-        azure_openai_client = init_openai_client(use_data=False)
+        azure_openai_client = get_openai_client()
         response = await azure_openai_client.chat.completions.create(
             model=AZURE_OPENAI_MODEL, messages=messages, temperature=1, max_tokens=64
         )
@@ -1526,7 +2066,41 @@ async def generate_title(conversation_messages):
         title = json.loads(response.choices[0].message.content)["title"]
         return title
     except Exception:
-        return messages[-2]["content"]
+        logging.exception("Exception while generating the conversation title")
+        return None
+
+
+def provisional_title(conversation_messages):
+    # the first user message, cut at a word boundary
+    content = next(
+        (msg["content"] for msg in conversation_messages if msg["role"] == "user"),
+        "",
+    )
+    title = " ".join(str(content).split())
+    if len(title) > PROVISIONAL_TITLE_MAX_LENGTH:
+        title = title[:PROVISIONAL_TITLE_MAX_LENGTH].rsplit(" ", 1)[0] + "..."
+    return title or "New conversation"
+
+
+async def update_generated_title(user_id, conversation_id, conversation_messages):
+    title = await generate_title(conversation_messages)
+    if not title:
+        # the provisional title stays
+        return
+    try:
+        cosmos_conversation_client = get_cosmosdb_client()
+        if not cosmos_conversation_client:
+            raise Exception("CosmosDB is not configured or not working")
+
+        # unless the user renamed the conversation in the meantime
+        await cosmos_conversation_client.update_conversation_title(
+            user_id,
+            conversation_id,
+            title,
+            expected_title=provisional_title(conversation_messages),
+        )
+    except Exception:
+        logging.exception("Exception while storing the generated conversation title")
 
 
 @bp.route("/api/pbi", methods=["GET"])
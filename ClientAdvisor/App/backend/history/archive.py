@@ -0,0 +1,114 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import time
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from backend.utils import gzip_ndjson
+
+# Last cutoff (a _ts) an archive run completed, stored next to the archives
+CHECKPOINT_NAME = "checkpoint.json"
+
+
+class LocalArchiveTarget:
+    """Writes archive files to a directory, for testing and small setups."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    async def write(self, name, chunks):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        # written under a temporary name so a failed run leaves no partial file
+        try:
+            with open(path + ".partial", "wb") as file:
+                async for chunk in chunks:
+                    await asyncio.to_thread(file.write, chunk)
+        except BaseException:
+            os.remove(path + ".partial")
+            raise
+        os.replace(path + ".partial", path)
+
+    async def read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_NAME)) as file:
+                return json.load(file)["cutoff"]
+        except FileNotFoundError:
+            return 0
+
+    async def write_checkpoint(self, cutoff):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, CHECKPOINT_NAME), "w") as file:
+            json.dump({"cutoff": cutoff}, file)
+
+
+class BlobArchiveTarget:
+    """Writes archive files to a blob storage container.
+
+    container_client is an azure.storage.blob.aio.ContainerClient. Each chunk
+    is staged as a block and the blob is committed once all are staged, so a
+    failed run leaves no blob behind.
+    """
+
+    def __init__(self, container_client):
+        self.container_client = container_client
+
+    async def write(self, name, chunks):
+        blob_client = self.container_client.get_blob_client(name)
+        block_ids = []
+        async for chunk in chunks:
+            block_id = base64.b64encode(f"{len(block_ids):08d}".encode()).decode()
+            await blob_client.stage_block(block_id, chunk)
+            block_ids.append(block_id)
+        await blob_client.commit_block_list(block_ids)
+
+    async def read_checkpoint(self):
+        blob_client = self.container_client.get_blob_client(CHECKPOINT_NAME)
+        try:
+            downloader = await blob_client.download_blob()
+        except ResourceNotFoundError:
+            return 0
+        return json.loads(await downloader.readall())["cutoff"]
+
+    async def write_checkpoint(self, cutoff):
+        blob_client = self.container_client.get_blob_client(CHECKPOINT_NAME)
+        await blob_client.upload_blob(json.dumps({"cutoff": cutoff}), overwrite=True)
+
+
+async def archive_history(container_client, target, older_than_days, now=None):
+    """Export the conversations and messages last written before the cutoff.
+
+    Items are streamed from a cross-partition query into one gzip JSONL file,
+    so memory use does not depend on how many there are. Each run picks up
+    where the previous one stopped, so running it daily with older_than_days a
+    little under the item TTL archives every item once before it expires.
+    Returns the archive's name and the number of items in it.
+    """
+    since = await target.read_checkpoint()
+    cutoff = int(now or time.time()) - older_than_days * 24 * 60 * 60
+    if cutoff <= since:
+        return None, 0
+
+    parameters = [
+        {"name": "@since", "value": since},
+        {"name": "@cutoff", "value": cutoff},
+    ]
+    query = "SELECT * FROM c WHERE c._ts >= @since AND c._ts < @cutoff AND c.type IN ('conversation', 'message')"
+    count = 0
+
+    async def items():
+        nonlocal count
+        async for item in container_client.query_items(
+            query=query, parameters=parameters
+        ):
+            count += 1
+            yield item
+
+    name = f"history-{since}-{cutoff}.jsonl.gz"
+    await target.write(name, gzip_ndjson(items()))
+    await target.write_checkpoint(cutoff)
+    logging.info(f"Archived {count} chat history item(s) to {name}")
+    return name, count
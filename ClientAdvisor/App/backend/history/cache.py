@@ -0,0 +1,77 @@
+import time
+from collections import OrderedDict
+
+
+class CacheEntry:
+
+    def __init__(self, conversation, expires):
+        self.conversation = conversation
+        self.messages = None
+        self.expires = expires
+
+
+class ConversationCache:
+    """Bounded LRU cache of conversations and their messages for one worker.
+
+    Entries are keyed by (userId, conversationId). Within ttl seconds an entry
+    is served as is; after that the conversation is revalidated with its _etag.
+    The messages are dropped either way: feedback and clearing change message
+    items without touching the conversation, so an unchanged etag does not
+    mean unchanged messages. Writes made through this worker invalidate the
+    entry, writes made elsewhere are picked up once it expires.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # bumped by every invalidation, so a read that started before one does
+        # not store what it fetched
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def get(self, user_id, conversation_id):
+        entry = self.entries.get((user_id, conversation_id))
+        if entry is not None:
+            self.entries.move_to_end((user_id, conversation_id))
+        return entry
+
+    def is_fresh(self, entry):
+        return time.monotonic() < entry.expires
+
+    def refresh(self, entry):
+        # the conversation is still current; its messages are read again
+        entry.expires = time.monotonic() + self.ttl
+        entry.messages = None
+
+    def put(self, user_id, conversation_id, conversation, generation):
+        if generation != self.generation:
+            return None
+        entry = CacheEntry(conversation, time.monotonic() + self.ttl)
+        self.entries[(user_id, conversation_id)] = entry
+        self.entries.move_to_end((user_id, conversation_id))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return entry
+
+    def put_messages(self, user_id, conversation_id, messages, generation):
+        # messages are only kept next to the conversation they belong to
+        entry = self.entries.get((user_id, conversation_id))
+        if entry is not None and generation == self.generation:
+            entry.messages = messages
+
+    def invalidate(self, user_id, conversation_id):
+        self.generation += 1
+        self.entries.pop((user_id, conversation_id), None)
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+        }
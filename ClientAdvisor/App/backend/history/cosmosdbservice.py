@@ -1,11 +1,96 @@
+import asyncio
+import json
+import logging
+import time
 import uuid
 from datetime import datetime
 
+from azure.core import MatchConditions
 from azure.cosmos import exceptions
 from azure.cosmos.aio import CosmosClient
 
+from backend.history.cache import ConversationCache
+from backend.history.store import ConversationStore
 
-class CosmosConversationClient:
+# The history list only shows these, so listings skip the rest of the document
+# (system properties included). Served by the (userId, type, updatedAt)
+# composite index where the container has the history indexing policy.
+CONVERSATION_LIST_FIELDS = "c.id, c.title, c.createdAt, c.updatedAt"
+
+# Indexes only the paths the queries below filter and sort on. Message content
+# (long answers, citation JSON) and everything else stays out of the index,
+# which keeps the RU charge of writes down. id is always indexed. Once a
+# container has the composite indexes, the ORDER BY clauses lead with their
+# equality filters so those serve them, in either direction; without them Cosmos
+# DB rejects such clauses, so they are only used where ensure() found the
+# indexes. Applied by tools/apply_history_indexing_policy.py.
+HISTORY_INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "automatic": True,
+    "includedPaths": [
+        {"path": "/userId/?"},
+        {"path": "/type/?"},
+        {"path": "/conversationId/?"},
+        {"path": "/createdAt/?"},
+        {"path": "/updatedAt/?"},
+        {"path": "/messages/[]/id/?"},
+        # archive_history's range filter
+        {"path": "/_ts/?"},
+    ],
+    "excludedPaths": [{"path": "/*"}],
+    "compositeIndexes": [
+        [
+            {"path": "/userId", "order": "ascending"},
+            {"path": "/type", "order": "ascending"},
+            {"path": "/updatedAt", "order": "ascending"},
+        ],
+        [
+            {"path": "/userId", "order": "ascending"},
+            {"path": "/type", "order": "ascending"},
+            {"path": "/conversationId", "order": "ascending"},
+            {"path": "/createdAt", "order": "ascending"},
+        ],
+    ],
+}
+
+# Partition key paths of a container partitioned per conversation within each
+# user, so a conversation's items share a logical partition while a user's
+# items can still be queried by key prefix
+HIERARCHICAL_PARTITION_KEY = ["/userId", "/conversationId"]
+
+# Id of the optional per-user document that mirrors the list fields of every
+# conversation, so the history list is one point read
+CONVERSATION_INDEX_ID = "conversationIndex"
+
+
+def conversation_index_entry(conversation):
+    # _ts, the time of the conversation's last write, is what its TTL counts
+    # from; it is not served with the list
+    return {
+        "id": conversation["id"],
+        "title": conversation["title"],
+        "createdAt": conversation["createdAt"],
+        "updatedAt": conversation["updatedAt"],
+        "_ts": conversation.get("_ts"),
+    }
+
+
+# read_conversation's answer when the conversation still has the given etag
+NOT_MODIFIED = object()
+
+
+class DeleteItemsError(Exception):
+    """Raised once every delete was attempted and some of them failed."""
+
+    def __init__(self, failures: dict):
+        # item id -> exception raised while deleting it
+        self.failures = failures
+        super().__init__(
+            f"Failed to delete {len(failures)} item(s): {', '.join(failures)}"
+        )
+
+
+class CosmosConversationClient(ConversationStore):
 
     def __init__(
         self,
@@ -14,12 +99,42 @@ class CosmosConversationClient:
         database_name: str,
         container_name: str,
         enable_message_feedback: bool = False,
+        delete_concurrency: int = 10,
+        use_conversation_index: bool = False,
+        conversation_index_size: int = 1000,
+        cache_size: int = 0,
+        cache_ttl: float = 30,
+        hierarchical_partition_key: bool = False,
+        embed_messages: bool = False,
+        embedded_messages_max_count: int = 50,
+        embedded_messages_max_bytes: int = 1024 * 1024,
+        item_ttl_days: int = 0,
     ):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
+        self.delete_concurrency = delete_concurrency
+        self.use_conversation_index = use_conversation_index
+        self.conversation_index_size = conversation_index_size
+        # read-through cache for /history/read, off when cache_size is 0
+        self.cache = ConversationCache(cache_size, cache_ttl) if cache_size else None
+        # the container is partitioned on (userId, conversationId) instead of
+        # userId alone; every document carries a conversationId for it
+        self.hierarchical_partition_key = hierarchical_partition_key
+        # new messages go into the conversation document, up to a count and a
+        # size well below the 2 MB item limit; older ones move out to message
+        # items, so typical conversations are read and written as one item
+        self.embed_messages = embed_messages
+        self.embedded_messages_max_count = embedded_messages_max_count
+        self.embedded_messages_max_bytes = embedded_messages_max_bytes
+        # conversations and messages expire this long after their last write,
+        # where container TTL is enabled; None keeps them forever
+        self.item_ttl = item_ttl_days * 24 * 60 * 60 or None
+        # set by ensure() when the container has HISTORY_INDEXING_POLICY's
+        # composite indexes; until then the queries sort on a single field
+        self.composite_order_by = False
         try:
             self.cosmosdb_client = CosmosClient(
                 self.cosmosdb_endpoint, credential=credential
@@ -61,24 +176,93 @@ class CosmosConversationClient:
             )
 
         try:
-            await self.container_client.read()
+            container = await self.container_client.read()
         except Exception:
             return False, f"CosmosDB container {self.container_name} not found"
 
+        if self.hierarchical_partition_key and (
+            container["partitionKey"]["paths"] != HIERARCHICAL_PARTITION_KEY
+        ):
+            return (
+                False,
+                f"CosmosDB container {self.container_name} is not partitioned by /userId and /conversationId",
+            )
+
+        composite_indexes = [
+            [(path["path"], path.get("order", "ascending")) for path in index]
+            for index in container.get("indexingPolicy", {}).get("compositeIndexes", [])
+        ]
+        self.composite_order_by = all(
+            [(path["path"], path["order"]) for path in index] in composite_indexes
+            for index in HISTORY_INDEXING_POLICY["compositeIndexes"]
+        )
+
+        if self.item_ttl and container.get("defaultTtl") is None:
+            logging.warning(
+                f"CosmosDB container {self.container_name} does not have TTL enabled, chat history will not expire"
+            )
+
         return True, "CosmosDB client initialized successfully"
 
+    async def close(self):
+        await self.cosmosdb_client.close()
+
+    def partition_key(self, user_id, conversation_id):
+        # the full partition key of an item with this conversationId
+        if self.hierarchical_partition_key:
+            return [user_id, conversation_id]
+        return user_id
+
+    def conversations_order_by(self, sort_order):
+        if self.composite_order_by:
+            return (
+                f"c.userId {sort_order}, c.type {sort_order}, c.updatedAt {sort_order}"
+            )
+        return f"c.updatedAt {sort_order}"
+
+    def messages_order_by(self):
+        if self.composite_order_by:
+            return "c.userId, c.type, c.conversationId, c.createdAt"
+        return "c.createdAt"
+
+    def user_partition_key(self, user_id):
+        # all of the user's items: their partition, or a prefix of the key
+        if self.hierarchical_partition_key:
+            return [user_id]
+        return user_id
+
+    def invalidate_conversation(self, user_id, conversation_id):
+        if self.cache:
+            self.cache.invalidate(user_id, conversation_id)
+
+    def cache_stats(self):
+        if not self.cache:
+            return None
+        return self.cache.stats()
+
     async def create_conversation(self, user_id, title=""):
+        conversation_id = str(uuid.uuid4())
         conversation = {
-            "id": str(uuid.uuid4()),
+            "id": conversation_id,
             "type": "conversation",
             "createdAt": datetime.utcnow().isoformat(),
             "updatedAt": datetime.utcnow().isoformat(),
             "userId": user_id,
+            "conversationId": conversation_id,
             "title": title,
         }
+        if self.embed_messages:
+            conversation["messages"] = []
+            conversation["messagesSize"] = 0
+            conversation["messagesOverflow"] = False
+        if self.item_ttl:
+            conversation["ttl"] = self.item_ttl
         # TODO: add some error handling based on the output of the upsert_item call
         resp = await self.container_client.upsert_item(conversation)
         if resp:
+            await self.maintain_conversation_index(
+                user_id, lambda: self.index_conversation(user_id, resp)
+            )
             return resp
         else:
             return False
@@ -90,68 +274,532 @@ class CosmosConversationClient:
         else:
             return False
 
+    async def patch_item(
+        self,
+        user_id,
+        item_id,
+        item_type,
+        operations,
+        etag=None,
+        conversation_id=None,
+        condition=None,
+    ):
+        # a single partial update instead of a read followed by a full upsert.
+        # Returns None when there is no item of item_type with this id (that
+        # meets the extra condition); an etag that no longer matches raises
+        # CosmosAccessConditionFailedError. conversation_id defaults to item_id,
+        # as for conversations and jobs.
+        filter_predicate = f"from c where c.type = '{item_type}'"
+        if condition:
+            filter_predicate += f" and {condition}"
+        options = {}
+        if etag:
+            options = {"etag": etag, "match_condition": MatchConditions.IfNotModified}
+        try:
+            return await self.container_client.patch_item(
+                item=item_id,
+                partition_key=self.partition_key(user_id, conversation_id or item_id),
+                patch_operations=operations,
+                filter_predicate=filter_predicate,
+                **options,
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+        except exceptions.CosmosAccessConditionFailedError:
+            if etag:
+                raise
+            # only the filter predicate can have failed
+            return None
+
+    async def touch_conversation(self, user_id, conversation_id, updated_at):
+        conversation = await self.patch_item(
+            user_id,
+            conversation_id,
+            "conversation",
+            [{"op": "set", "path": "/updatedAt", "value": updated_at}],
+        )
+        self.invalidate_conversation(user_id, conversation_id)
+        if conversation:
+            await self.maintain_conversation_index(
+                user_id, lambda: self.index_conversation(user_id, conversation)
+            )
+        return conversation
+
+    async def update_conversation_title(
+        self, user_id, conversation_id, title, etag=None, expected_title=None
+    ):
+        condition = None
+        if expected_title is not None:
+            # a JSON string is also a string literal in the query language
+            condition = f"c.title = {json.dumps(expected_title)}"
+        conversation = await self.patch_item(
+            user_id,
+            conversation_id,
+            "conversation",
+            [{"op": "set", "path": "/title", "value": title}],
+            etag=etag,
+            condition=condition,
+        )
+        self.invalidate_conversation(user_id, conversation_id)
+        if conversation:
+            await self.reindex_conversation(user_id, conversation)
+        return conversation
+
     async def delete_conversation(self, user_id, conversation_id):
         conversation = await self.container_client.read_item(
-            item=conversation_id, partition_key=user_id
+            item=conversation_id,
+            partition_key=self.partition_key(user_id, conversation_id),
         )
         if conversation:
             resp = await self.container_client.delete_item(
-                item=conversation_id, partition_key=user_id
+                item=conversation_id,
+                partition_key=self.partition_key(user_id, conversation_id),
+            )
+            self.invalidate_conversation(user_id, conversation_id)
+            await self.maintain_conversation_index(
+                user_id,
+                lambda: self.patch_conversation_index(
+                    user_id,
+                    conversation_id,
+                    {"op": "remove", "path": f"/conversations/{conversation_id}"},
+                ),
             )
             return resp
         else:
             return True
 
+    async def maintain_conversation_index(self, user_id, update):
+        # the index must never fail the write it follows; if it cannot be kept
+        # in step it is dropped and rebuilt by the next listing
+        if not self.use_conversation_index:
+            return
+        try:
+            await update()
+        except Exception:
+            logging.exception("Exception updating the conversation index")
+            try:
+                await self.container_client.delete_item(
+                    item=CONVERSATION_INDEX_ID,
+                    partition_key=self.partition_key(user_id, CONVERSATION_INDEX_ID),
+                )
+            except exceptions.CosmosResourceNotFoundError:
+                pass
+
+    async def index_conversation(self, user_id, conversation):
+        # add or refresh the conversation's entry. A missing index is started
+        # incomplete, so the next listing rebuilds it instead of trusting it.
+        entry = conversation_index_entry(conversation)
+        operations = [
+            {"op": "set", "path": f"/conversations/{entry['id']}", "value": entry}
+        ]
+        try:
+            index = await self.container_client.patch_item(
+                item=CONVERSATION_INDEX_ID,
+                partition_key=self.partition_key(user_id, CONVERSATION_INDEX_ID),
+                patch_operations=operations,
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            try:
+                await self.container_client.create_item(
+                    {
+                        "id": CONVERSATION_INDEX_ID,
+                        "type": "conversationIndex",
+                        "userId": user_id,
+                        "conversationId": CONVERSATION_INDEX_ID,
+                        "complete": False,
+                        "overflow": False,
+                        "conversations": {entry["id"]: entry},
+                    }
+                )
+                return
+            except exceptions.CosmosResourceExistsError:
+                index = await self.container_client.patch_item(
+                    item=CONVERSATION_INDEX_ID,
+                    partition_key=self.partition_key(user_id, CONVERSATION_INDEX_ID),
+                    patch_operations=operations,
+                )
+
+        if index and len(index["conversations"]) > self.conversation_index_size:
+            await self.trim_conversation_index(index)
+
+    async def trim_conversation_index(self, index):
+        # keep the most recently updated conversations and spill the rest over
+        # to the query, so the index stays well below the item size limit
+        conversations = sorted(
+            index["conversations"].values(),
+            key=lambda conversation: conversation["updatedAt"],
+            reverse=True,
+        )
+        trimmed = dict(index)
+        trimmed["overflow"] = True
+        trimmed["conversations"] = {
+            conversation["id"]: conversation
+            for conversation in conversations[: self.conversation_index_size]
+        }
+        # a write since the patch changed the etag; that write trims it again
+        try:
+            await self.container_client.replace_item(
+                item=CONVERSATION_INDEX_ID,
+                body=trimmed,
+                etag=index["_etag"],
+                match_condition=MatchConditions.IfNotModified,
+            )
+        except exceptions.CosmosAccessConditionFailedError:
+            pass
+
+    async def reindex_conversation(self, user_id, conversation):
+        # refresh the entry of a conversation written without touching it, so
+        # its title and _ts stay current
+        await self.maintain_conversation_index(
+            user_id,
+            lambda: self.patch_conversation_index(
+                user_id,
+                conversation["id"],
+                {
+                    "op": "set",
+                    "path": f"/conversations/{conversation['id']}",
+                    "value": conversation_index_entry(conversation),
+                },
+            ),
+        )
+
+    async def patch_conversation_index(self, user_id, conversation_id, operation):
+        # change an existing entry; conversations the index does not hold (or a
+        # missing index) are left alone
+        try:
+            await self.container_client.patch_item(
+                item=CONVERSATION_INDEX_ID,
+                partition_key=self.partition_key(user_id, CONVERSATION_INDEX_ID),
+                patch_operations=[operation],
+                filter_predicate=f"from c where IS_DEFINED(c.conversations['{conversation_id}'])",
+            )
+        except (
+            exceptions.CosmosResourceNotFoundError,
+            exceptions.CosmosAccessConditionFailedError,
+        ):
+            pass
+
+    async def get_conversations_from_index(self, user_id, limit, sort_order, offset):
+        # None when the page has to come from a query instead
+        try:
+            index = await self.container_client.read_item(
+                item=CONVERSATION_INDEX_ID,
+                partition_key=self.partition_key(user_id, CONVERSATION_INDEX_ID),
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            index = None
+
+        if index is None or not index.get("complete"):
+            index = await self.rebuild_conversation_index(user_id, index)
+
+        conversations = index["conversations"].values()
+        if self.item_ttl:
+            # TTL removes conversations without touching the index, so entries
+            # last written longer ago than that are left out. Entries indexed
+            # before _ts was recorded are kept.
+            expired = time.time() - self.item_ttl
+            conversations = [
+                conversation
+                for conversation in conversations
+                if conversation.get("_ts") is None or conversation["_ts"] > expired
+            ]
+        conversations = [
+            {key: value for key, value in conversation.items() if key != "_ts"}
+            for conversation in conversations
+        ]
+        conversations = sorted(
+            conversations,
+            key=lambda conversation: conversation["updatedAt"],
+            reverse=sort_order.upper() == "DESC",
+        )
+        offset = int(offset)
+        if index["overflow"]:
+            # an overflowing index holds the most recently updated conversations,
+            # anything past them spills over to the query
+            if sort_order.upper() != "DESC" or limit is None:
+                return None
+            if offset + limit > len(conversations):
+                return None
+
+        if limit is None:
+            return conversations[offset:]
+        return conversations[offset : offset + limit]
+
+    async def rebuild_conversation_index(self, user_id, index):
+        conversations = await self.query_conversations(
+            user_id, None, "DESC", 0, fields=f"{CONVERSATION_LIST_FIELDS}, c._ts"
+        )
+        rebuilt = {
+            "id": CONVERSATION_INDEX_ID,
+            "type": "conversationIndex",
+            "userId": user_id,
+            "conversationId": CONVERSATION_INDEX_ID,
+            "complete": True,
+            "overflow": len(conversations) > self.conversation_index_size,
+            "conversations": {
+                conversation["id"]: conversation_index_entry(conversation)
+                for conversation in conversations[: self.conversation_index_size]
+            },
+        }
+        # a conversation write since the index was read changes its etag, so
+        # a rebuild that may have missed it is not stored
+        try:
+            if index is None:
+                await self.container_client.create_item(rebuilt)
+            else:
+                await self.container_client.replace_item(
+                    item=CONVERSATION_INDEX_ID,
+                    body=rebuilt,
+                    etag=index["_etag"],
+                    match_condition=MatchConditions.IfNotModified,
+                )
+        except (
+            exceptions.CosmosResourceExistsError,
+            exceptions.CosmosAccessConditionFailedError,
+        ):
+            pass
+        return rebuilt
+
+    async def delete_items(self, user_id, item_ids, conversation_id=None):
+        # delete items of one user concurrently, at most delete_concurrency at a
+        # time. Returns the delete responses in item order and a dict of the
+        # items that could not be deleted; items that are already gone count as
+        # deleted. conversation_id is that of all the items, if they share one.
+        semaphore = asyncio.Semaphore(self.delete_concurrency)
+        failures = {}
+
+        async def delete_item(item_id):
+            async with semaphore:
+                try:
+                    return await self.container_client.delete_item(
+                        item=item_id,
+                        partition_key=self.partition_key(
+                            user_id, conversation_id or item_id
+                        ),
+                    )
+                except exceptions.CosmosResourceNotFoundError:
+                    return None
+                except Exception as e:
+                    failures[item_id] = e
+                    return None
+
+        response_list = await asyncio.gather(
+            *(delete_item(item_id) for item_id in item_ids)
+        )
+        return response_list, failures
+
     async def delete_messages(self, conversation_id, user_id):
-        # get a list of all the messages in the conversation
-        messages = await self.get_messages(user_id, conversation_id)
-        response_list = []
+        if self.embed_messages:
+            conversation = await self.patch_item(
+                user_id,
+                conversation_id,
+                "conversation",
+                [
+                    {"op": "set", "path": "/messages", "value": []},
+                    {"op": "set", "path": "/messagesSize", "value": 0},
+                    {"op": "set", "path": "/messagesOverflow", "value": False},
+                ],
+            )
+            self.invalidate_conversation(user_id, conversation_id)
+            if conversation:
+                await self.reindex_conversation(user_id, conversation)
+
+        # list the message items from cosmos, never the cache: a cached list
+        # misses messages written through other workers
+        messages = [
+            message async for message in self.query_messages(user_id, conversation_id)
+        ]
         if messages:
-            for message in messages:
-                resp = await self.container_client.delete_item(
-                    item=message["id"], partition_key=user_id
-                )
-                response_list.append(resp)
+            response_list, failures = await self.delete_items(
+                user_id, [message["id"] for message in messages], conversation_id
+            )
+            self.invalidate_conversation(user_id, conversation_id)
+            if failures:
+                raise DeleteItemsError(failures)
             return response_list
 
     async def get_conversations(self, user_id, limit, sort_order="DESC", offset=0):
+        if self.use_conversation_index:
+            conversations = await self.get_conversations_from_index(
+                user_id, limit, sort_order, offset
+            )
+            if conversations is not None:
+                return conversations
+
+        return await self.query_conversations(user_id, limit, sort_order, offset)
+
+    async def query_conversations(
+        self, user_id, limit, sort_order, offset, fields=CONVERSATION_LIST_FIELDS
+    ):
         parameters = [{"name": "@userId", "value": user_id}]
-        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
+        query = f"SELECT {fields} FROM c where c.userId = @userId and c.type='conversation' order by {self.conversations_order_by(sort_order)}"
         if limit is not None:
             query += f" offset {offset} limit {limit}"
 
         conversations = []
         async for item in self.container_client.query_items(
-            query=query, parameters=parameters
+            query=query,
+            parameters=parameters,
+            partition_key=self.user_partition_key(user_id),
         ):
             conversations.append(item)
 
         return conversations
 
-    async def get_conversation(self, user_id, conversation_id):
-        parameters = [
-            {"name": "@conversationId", "value": conversation_id},
-            {"name": "@userId", "value": user_id},
-        ]
-        query = "SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
-        conversations = []
+    async def query_page(
+        self, query, parameters, user_id, page_size, continuation_token
+    ):
+        # one page of a query within the user's partition plus the token for the
+        # next page, which is None after the last one
+        pages = self.container_client.query_items(
+            query=query,
+            parameters=parameters,
+            partition_key=self.user_partition_key(user_id),
+            max_item_count=page_size,
+        ).by_page(continuation_token)
+
+        items = []
+        async for page in pages:
+            async for item in page:
+                items.append(item)
+            break
+
+        return items, pages.continuation_token
+
+    async def get_conversations_page(
+        self, user_id, limit, continuation_token=None, sort_order="DESC"
+    ):
+        # unlike OFFSET, resuming from a continuation token costs the same on
+        # every page
+        parameters = [{"name": "@userId", "value": user_id}]
+        query = f"SELECT {CONVERSATION_LIST_FIELDS} FROM c where c.userId = @userId and c.type='conversation' order by {self.conversations_order_by(sort_order)}"
+        return await self.query_page(
+            query, parameters, user_id, limit, continuation_token
+        )
+
+    async def iter_conversations(self, user_id):
+        # yields the conversations as the query pages them in
+        parameters = [{"name": "@userId", "value": user_id}]
+        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by {self.conversations_order_by('DESC')}"
         async for item in self.container_client.query_items(
-            query=query, parameters=parameters
+            query=query,
+            parameters=parameters,
+            partition_key=self.user_partition_key(user_id),
         ):
-            conversations.append(item)
+            yield item
 
-        # if no conversations are found, return None
-        if len(conversations) == 0:
+    async def get_conversation_ids(self, user_id, page_size, continuation_token=None):
+        parameters = [{"name": "@userId", "value": user_id}]
+        query = "SELECT c.id FROM c WHERE c.userId = @userId AND c.type='conversation'"
+        items, continuation_token = await self.query_page(
+            query, parameters, user_id, page_size, continuation_token
+        )
+        return [item["id"] for item in items], continuation_token
+
+    async def get_conversation(self, user_id, conversation_id):
+        if not self.cache:
+            return await self.read_conversation(user_id, conversation_id)
+
+        entry = self.cache.get(user_id, conversation_id)
+        if entry and self.cache.is_fresh(entry):
+            self.cache.hits += 1
+            return entry.conversation
+
+        generation = self.cache.generation
+        etag = entry.conversation.get("_etag") if entry else None
+        conversation = await self.read_conversation(user_id, conversation_id, etag=etag)
+        if conversation is NOT_MODIFIED:
+            # the conversation did not change
+            self.cache.hits += 1
+            self.cache.revalidations += 1
+            self.cache.refresh(entry)
+            return entry.conversation
+
+        self.cache.misses += 1
+        if not conversation:
+            self.cache.invalidate(user_id, conversation_id)
             return None
-        else:
-            return conversations[0]
+        self.cache.put(user_id, conversation_id, conversation, generation)
+        return conversation
 
-    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+    async def read_conversation(self, user_id, conversation_id, etag=None):
+        # id and partition key are both known, so a point read does it. With an
+        # etag, NOT_MODIFIED is returned while the conversation still has it.
+        options = {}
+        if etag:
+            options = {"etag": etag, "match_condition": MatchConditions.IfModified}
+        try:
+            conversation = await self.container_client.read_item(
+                item=conversation_id,
+                partition_key=self.partition_key(user_id, conversation_id),
+                **options,
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+        # a 304 comes back without a body
+        if etag and not conversation:
+            return NOT_MODIFIED
+
+        # if the document is not this user's conversation, return None
+        if (
+            conversation.get("type") != "conversation"
+            or conversation.get("userId") != user_id
+        ):
+            return None
+        return conversation
+
+    async def create_job(self, user_id, kind):
+        # jobs live next to the user's conversations so any worker can report on
+        # them; the ttl removes them after a day where container TTL is enabled
+        job_id = str(uuid.uuid4())
+        job = {
+            "id": job_id,
+            "type": "job",
+            "kind": kind,
+            "userId": user_id,
+            "conversationId": job_id,
+            "status": "running",
+            "deleted": 0,
+            "failed": 0,
+            "createdAt": datetime.utcnow().isoformat(),
+            "updatedAt": datetime.utcnow().isoformat(),
+            "ttl": 24 * 60 * 60,
+        }
+        return await self.container_client.create_item(job)
+
+    async def update_job(self, user_id, job_id, **fields):
+        fields["updatedAt"] = datetime.utcnow().isoformat()
+        return await self.patch_item(
+            user_id,
+            job_id,
+            "job",
+            [
+                {"op": "set", "path": f"/{name}", "value": value}
+                for name, value in fields.items()
+            ],
+        )
+
+    async def get_job(self, user_id, job_id):
+        try:
+            job = await self.container_client.read_item(
+                item=job_id, partition_key=self.partition_key(user_id, job_id)
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+        if job.get("type") != "job":
+            return None
+        return job
+
+    def new_message(
+        self, uuid, conversation_id, user_id, input_message, created_at=None
+    ):
         message = {
             "id": uuid,
             "type": "message",
             "userId": user_id,
-            "createdAt": datetime.utcnow().isoformat(),
+            "createdAt": created_at or datetime.utcnow().isoformat(),
             "updatedAt": datetime.utcnow().isoformat(),
             "conversationId": conversation_id,
             "role": input_message["role"],
@@ -160,40 +808,279 @@ class CosmosConversationClient:
 
         if self.enable_message_feedback:
             message["feedback"] = ""
+        if self.item_ttl:
+            message["ttl"] = self.item_ttl
+        return message
+
+    async def create_message(
+        self, uuid, conversation_id, user_id, input_message: dict, created_at=None
+    ):
+        message = self.new_message(
+            uuid, conversation_id, user_id, input_message, created_at
+        )
+        if self.embed_messages:
+            return await self.embed_message(user_id, conversation_id, message)
 
         resp = await self.container_client.upsert_item(message)
         if resp:
             # update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
+            conversation = await self.touch_conversation(
+                user_id, conversation_id, message["createdAt"]
+            )
             if not conversation:
                 return "Conversation not found"
-            conversation["updatedAt"] = message["createdAt"]
-            await self.upsert_conversation(conversation)
             return resp
         else:
             return False
 
-    async def update_message_feedback(self, user_id, message_id, feedback):
-        message = await self.container_client.read_item(
-            item=message_id, partition_key=user_id
+    async def create_messages(self, conversation_id, user_id, input_messages):
+        if self.embed_messages:
+            return await super().create_messages(
+                conversation_id, user_id, input_messages
+            )
+
+        # the messages are upserted in order and the conversation is touched
+        # once, with the createdAt of the last one
+        responses = []
+        for input_message in input_messages:
+            message = self.new_message(
+                input_message["id"],
+                conversation_id,
+                user_id,
+                input_message,
+                input_message["createdAt"],
+            )
+            responses.append(await self.container_client.upsert_item(message))
+
+        conversation = await self.touch_conversation(
+            user_id, conversation_id, message["createdAt"]
         )
-        if message:
-            message["feedback"] = feedback
-            resp = await self.container_client.upsert_item(message)
+        if not conversation:
+            return "Conversation not found"
+        return responses
+
+    async def update_message_feedback(self, user_id, message_id, feedback, etag=None):
+        resp = await self.update_message_item_feedback(
+            user_id, message_id, feedback, etag
+        )
+        if not resp and self.embed_messages:
+            resp = await self.update_embedded_message_feedback(
+                user_id, message_id, feedback, etag
+            )
+        if resp:
+            self.invalidate_conversation(user_id, resp.get("conversationId"))
             return resp
         else:
             return False
 
-    async def get_messages(self, user_id, conversation_id):
+    async def update_message_item_feedback(self, user_id, message_id, feedback, etag):
+        conversation_id = None
+        if self.hierarchical_partition_key:
+            # the message's partition key includes its conversation
+            conversation_id = await self.get_message_conversation_id(
+                user_id, message_id
+            )
+            if not conversation_id:
+                return None
+        return await self.patch_item(
+            user_id,
+            message_id,
+            "message",
+            [{"op": "set", "path": "/feedback", "value": feedback}],
+            etag=etag,
+            conversation_id=conversation_id,
+        )
+
+    async def update_embedded_message_feedback(
+        self, user_id, message_id, feedback, etag
+    ):
+        # embedded messages have no etag of their own, so an etag given for
+        # one is checked against its conversation. Without one, the etag the
+        # message was found under makes sure it has not moved since.
+        parameters = [{"name": "@message", "value": {"id": message_id}}]
+        query = "SELECT c.id, c._etag, ARRAY(SELECT VALUE m.id FROM m IN c.messages) AS messageIds FROM c WHERE c.type='conversation' AND ARRAY_CONTAINS(c.messages, @message, true)"
+        for _ in range(3):
+            found = None
+            async for item in self.container_client.query_items(
+                query=query,
+                parameters=parameters,
+                partition_key=self.user_partition_key(user_id),
+            ):
+                found = item
+                break
+            if not found:
+                return None
+
+            index = found["messageIds"].index(message_id)
+            try:
+                conversation = await self.patch_item(
+                    user_id,
+                    found["id"],
+                    "conversation",
+                    [
+                        {
+                            "op": "set",
+                            "path": f"/messages/{index}/feedback",
+                            "value": feedback,
+                        }
+                    ],
+                    etag=etag or found["_etag"],
+                )
+            except exceptions.CosmosAccessConditionFailedError:
+                if etag:
+                    raise
+                continue
+            if conversation:
+                await self.reindex_conversation(user_id, conversation)
+                return conversation["messages"][index]
+            return None
+        return None
+
+    async def embed_message(self, user_id, conversation_id, message):
+        size = len(json.dumps(message).encode("utf-8"))
+        conversation = None
+        if size <= self.embedded_messages_max_bytes:
+            # one patch appends the message while there is room for it, unless
+            # a retried write embedded it already. The id is written as a JSON
+            # literal, which is also valid in the query language.
+            embedded = json.dumps({"id": message["id"]})
+            conversation = await self.patch_item(
+                user_id,
+                conversation_id,
+                "conversation",
+                [
+                    {"op": "add", "path": "/messages/-", "value": message},
+                    {"op": "incr", "path": "/messagesSize", "value": size},
+                    {"op": "set", "path": "/updatedAt", "value": message["createdAt"]},
+                ],
+                condition=f"ARRAY_LENGTH(c.messages) < {self.embedded_messages_max_count} and c.messagesSize + {size} <= {self.embedded_messages_max_bytes} and NOT ARRAY_CONTAINS(c.messages, {embedded}, true)",
+            )
+        if not conversation:
+            conversation = await self.spill_embedded_messages(
+                user_id, conversation_id, message
+            )
+            if not conversation:
+                return "Conversation not found"
+
+        self.invalidate_conversation(user_id, conversation_id)
+        await self.maintain_conversation_index(
+            user_id, lambda: self.index_conversation(user_id, conversation)
+        )
+        return message
+
+    async def spill_embedded_messages(self, user_id, conversation_id, message):
+        # make room by moving the oldest embedded messages out to message
+        # items, then store the conversation only if nothing else changed it.
+        # Message items are always older than the embedded messages.
+        for _ in range(5):
+            conversation = await self.read_conversation(user_id, conversation_id)
+            if not conversation:
+                return None
+            if any(
+                item["id"] == message["id"] for item in conversation.get("messages", [])
+            ):
+                # a retry of a write that went through
+                return conversation
+
+            # conversations from before embedding keep their message items
+            overflow = conversation.get(
+                "messagesOverflow", "messages" not in conversation
+            )
+            embedded = conversation.get("messages", []) + [message]
+            sizes = [len(json.dumps(item).encode("utf-8")) for item in embedded]
+            evicted = 0
+            while evicted < len(embedded) and (
+                len(embedded) - evicted > self.embedded_messages_max_count
+                or sum(sizes[evicted:]) > self.embedded_messages_max_bytes
+            ):
+                evicted += 1
+
+            for item in embedded[:evicted]:
+                await self.container_client.upsert_item(item)
+
+            conversation["messages"] = embedded[evicted:]
+            conversation["messagesSize"] = sum(sizes[evicted:])
+            conversation["messagesOverflow"] = overflow or evicted > 0
+            conversation["updatedAt"] = message["createdAt"]
+            try:
+                return await self.container_client.replace_item(
+                    item=conversation_id,
+                    body=conversation,
+                    etag=conversation["_etag"],
+                    match_condition=MatchConditions.IfNotModified,
+                )
+            except exceptions.CosmosAccessConditionFailedError:
+                continue
+        raise Exception(f"Conversation {conversation_id} kept changing")
+
+    async def get_message_conversation_id(self, user_id, message_id):
+        parameters = [{"name": "@messageId", "value": message_id}]
+        query = "SELECT VALUE c.conversationId FROM c WHERE c.id = @messageId AND c.type='message'"
+        async for conversation_id in self.container_client.query_items(
+            query=query,
+            parameters=parameters,
+            partition_key=self.user_partition_key(user_id),
+        ):
+            return conversation_id
+        return None
+
+    async def iter_messages(self, user_id, conversation_id, conversation=None):
+        # yields the messages as the query pages them in, so callers can pass
+        # them on without holding the whole conversation
+        if self.embed_messages:
+            async for message in self.iter_embedded_messages(
+                user_id, conversation_id, conversation
+            ):
+                yield message
+            return
+
+        if not self.cache:
+            async for message in self.query_messages(user_id, conversation_id):
+                yield message
+            return
+
+        entry = self.cache.get(user_id, conversation_id)
+        if entry and entry.messages is not None and self.cache.is_fresh(entry):
+            self.cache.hits += 1
+            for message in entry.messages:
+                yield message
+            return
+
+        self.cache.misses += 1
+        generation = self.cache.generation
+        messages = []
+        async for message in self.query_messages(user_id, conversation_id):
+            messages.append(message)
+            yield message
+        self.cache.put_messages(user_id, conversation_id, messages, generation)
+
+    async def iter_embedded_messages(self, user_id, conversation_id, conversation):
+        if conversation is None:
+            conversation = await self.get_conversation(user_id, conversation_id)
+            if not conversation:
+                return
+
+        embedded = conversation.get("messages", [])
+        # older messages were moved out to message items; one that is also
+        # still embedded is mid-move and comes from the conversation
+        if conversation.get("messagesOverflow", "messages" not in conversation):
+            embedded_ids = {message["id"] for message in embedded}
+            async for message in self.query_messages(user_id, conversation_id):
+                if message["id"] not in embedded_ids:
+                    yield message
+
+        for message in embedded:
+            yield message
+
+    async def query_messages(self, user_id, conversation_id):
         parameters = [
             {"name": "@conversationId", "value": conversation_id},
             {"name": "@userId", "value": user_id},
         ]
-        query = "SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
-        messages = []
+        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY {self.messages_order_by()}"
         async for item in self.container_client.query_items(
-            query=query, parameters=parameters
+            query=query,
+            parameters=parameters,
+            partition_key=self.partition_key(user_id, conversation_id),
         ):
-            messages.append(item)
-
-        return messages
+            yield item
@@ -0,0 +1,447 @@
+import asyncio
+import copy
+import sqlite3
+import threading
+import uuid
+from abc import abstractmethod
+from datetime import datetime
+
+from backend.history.store import ConversationStore, PreconditionFailedError
+from backend.utils import json_dumps, json_loads
+
+# The fields the history list shows, as in the Cosmos DB listing query
+CONVERSATION_LIST_FIELDS = ("id", "title", "createdAt", "updatedAt")
+
+
+def encode_token(item, order_by):
+    # pages resume after the last item rather than at an offset, so deleting
+    # the items of one page does not skip any on the next
+    return json_dumps([item.get(order_by) or "", item["id"]])
+
+
+def decode_token(token):
+    try:
+        value, item_id = json_loads(token)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid continuation token")
+    return value, item_id
+
+
+class LocalConversationStore(ConversationStore):
+    """Chat history kept by the app itself rather than in Cosmos DB.
+
+    Subclasses only store and query the documents; the conversation, message
+    and job handling here mirrors CosmosConversationClient.
+    """
+
+    def __init__(self, enable_message_feedback: bool = False):
+        self.enable_message_feedback = enable_message_feedback
+        # serializes read-modify-write updates such as patches
+        self.lock = asyncio.Lock()
+
+    @abstractmethod
+    async def read_item(self, user_id, item_id):
+        pass
+
+    @abstractmethod
+    async def write_item(self, item):
+        pass
+
+    @abstractmethod
+    async def remove_item(self, user_id, item_id):
+        """Return whether there was an item to remove."""
+
+    @abstractmethod
+    async def query_items(
+        self,
+        user_id,
+        item_type,
+        conversation_id=None,
+        order_by="createdAt",
+        descending=False,
+        after=None,
+        offset=0,
+        limit=None,
+    ):
+        """Return the user's items of item_type ordered by (order_by, id).
+
+        after is an (order_by value, id) pair the items must come after.
+        """
+
+    async def ensure(self):
+        return True, "Chat history store initialized successfully"
+
+    async def save(self, item):
+        # every write gets a new etag, like a Cosmos DB document
+        item["_etag"] = str(uuid.uuid4())
+        await self.write_item(item)
+        return item
+
+    async def read_typed_item(self, user_id, item_id, item_type):
+        item = await self.read_item(user_id, item_id)
+        if not item or item.get("type") != item_type:
+            return None
+        return item
+
+    async def patch_item(
+        self, user_id, item_id, item_type, fields, etag=None, match=None
+    ):
+        # match holds field values the item must still have to be patched
+        async with self.lock:
+            item = await self.read_typed_item(user_id, item_id, item_type)
+            if not item:
+                return None
+            if match and any(item.get(key) != value for key, value in match.items()):
+                return None
+            if etag and item.get("_etag") != etag:
+                raise PreconditionFailedError(f"Item {item_id} was modified")
+            item.update(fields)
+            return await self.save(item)
+
+    async def create_conversation(self, user_id, title=""):
+        conversation = {
+            "id": str(uuid.uuid4()),
+            "type": "conversation",
+            "createdAt": datetime.utcnow().isoformat(),
+            "updatedAt": datetime.utcnow().isoformat(),
+            "userId": user_id,
+            "title": title,
+        }
+        return await self.save(conversation)
+
+    async def upsert_conversation(self, conversation):
+        return await self.save(dict(conversation))
+
+    async def update_conversation_title(
+        self, user_id, conversation_id, title, etag=None, expected_title=None
+    ):
+        match = {"title": expected_title} if expected_title is not None else None
+        return await self.patch_item(
+            user_id,
+            conversation_id,
+            "conversation",
+            {"title": title},
+            etag=etag,
+            match=match,
+        )
+
+    async def delete_conversation(self, user_id, conversation_id):
+        if await self.read_typed_item(user_id, conversation_id, "conversation"):
+            await self.remove_item(user_id, conversation_id)
+        return True
+
+    async def delete_messages(self, conversation_id, user_id):
+        messages = await self.get_messages(user_id, conversation_id)
+        if messages:
+            return [
+                await self.remove_item(user_id, message["id"]) for message in messages
+            ]
+
+    async def get_conversations(self, user_id, limit, sort_order="DESC", offset=0):
+        conversations = await self.query_items(
+            user_id,
+            "conversation",
+            order_by="updatedAt",
+            descending=sort_order.upper() == "DESC",
+            offset=int(offset),
+            limit=limit,
+        )
+        return [
+            {field: conversation.get(field) for field in CONVERSATION_LIST_FIELDS}
+            for conversation in conversations
+        ]
+
+    async def query_page(
+        self, user_id, item_type, order_by, descending, page_size, continuation_token
+    ):
+        # one more item than asked for tells whether there is a next page
+        items = await self.query_items(
+            user_id,
+            item_type,
+            order_by=order_by,
+            descending=descending,
+            after=decode_token(continuation_token) if continuation_token else None,
+            limit=page_size + 1,
+        )
+        if len(items) <= page_size:
+            return items, None
+        items = items[:page_size]
+        return items, encode_token(items[-1], order_by)
+
+    async def get_conversations_page(
+        self, user_id, limit, continuation_token=None, sort_order="DESC"
+    ):
+        conversations, continuation_token = await self.query_page(
+            user_id,
+            "conversation",
+            "updatedAt",
+            sort_order.upper() == "DESC",
+            limit,
+            continuation_token,
+        )
+        return [
+            {field: conversation.get(field) for field in CONVERSATION_LIST_FIELDS}
+            for conversation in conversations
+        ], continuation_token
+
+    async def get_conversation_ids(self, user_id, page_size, continuation_token=None):
+        conversations, continuation_token = await self.query_page(
+            user_id, "conversation", "id", False, page_size, continuation_token
+        )
+        conversation_ids = [conversation["id"] for conversation in conversations]
+        return conversation_ids, continuation_token
+
+    async def get_conversation(self, user_id, conversation_id):
+        return await self.read_typed_item(user_id, conversation_id, "conversation")
+
+    async def iter_conversations(self, user_id, page_size=100):
+        continuation_token = None
+        while True:
+            conversations, continuation_token = await self.query_page(
+                user_id,
+                "conversation",
+                "updatedAt",
+                True,
+                page_size,
+                continuation_token,
+            )
+            for conversation in conversations:
+                yield conversation
+            if not continuation_token:
+                return
+
+    async def create_job(self, user_id, kind):
+        job = {
+            "id": str(uuid.uuid4()),
+            "type": "job",
+            "kind": kind,
+            "userId": user_id,
+            "status": "running",
+            "deleted": 0,
+            "failed": 0,
+            "createdAt": datetime.utcnow().isoformat(),
+            "updatedAt": datetime.utcnow().isoformat(),
+        }
+        return await self.save(job)
+
+    async def update_job(self, user_id, job_id, **fields):
+        fields["updatedAt"] = datetime.utcnow().isoformat()
+        return await self.patch_item(user_id, job_id, "job", fields)
+
+    async def get_job(self, user_id, job_id):
+        return await self.read_typed_item(user_id, job_id, "job")
+
+    async def create_message(
+        self, uuid, conversation_id, user_id, input_message: dict, created_at=None
+    ):
+        if not await self.read_typed_item(user_id, conversation_id, "conversation"):
+            return "Conversation not found"
+
+        message = {
+            "id": uuid,
+            "type": "message",
+            "userId": user_id,
+            "createdAt": created_at or datetime.utcnow().isoformat(),
+            "updatedAt": datetime.utcnow().isoformat(),
+            "conversationId": conversation_id,
+            "role": input_message["role"],
+            "content": input_message["content"],
+        }
+
+        if self.enable_message_feedback:
+            message["feedback"] = ""
+
+        resp = await self.save(message)
+        # update the parent conversations's updatedAt field with the current message's createdAt datetime value
+        conversation = await self.patch_item(
+            user_id,
+            conversation_id,
+            "conversation",
+            {"updatedAt": message["createdAt"]},
+        )
+        if not conversation:
+            return "Conversation not found"
+        return resp
+
+    async def update_message_feedback(self, user_id, message_id, feedback, etag=None):
+        resp = await self.patch_item(
+            user_id, message_id, "message", {"feedback": feedback}, etag=etag
+        )
+        if resp:
+            return resp
+        else:
+            return False
+
+    async def iter_messages(self, user_id, conversation_id, conversation=None):
+        for message in await self.query_items(
+            user_id, "message", conversation_id=conversation_id
+        ):
+            yield message
+
+
+class MemoryConversationStore(LocalConversationStore):
+    """Keeps the documents in this worker's memory.
+
+    Nothing survives a restart and every worker has its own history, so this
+    is meant for local runs, tests and benchmarks.
+    """
+
+    def __init__(self, enable_message_feedback: bool = False):
+        super().__init__(enable_message_feedback)
+        # (userId, id) -> document
+        self.items = {}
+
+    async def read_item(self, user_id, item_id):
+        return copy.deepcopy(self.items.get((user_id, item_id)))
+
+    async def write_item(self, item):
+        self.items[(item["userId"], item["id"])] = copy.deepcopy(item)
+
+    async def remove_item(self, user_id, item_id):
+        return self.items.pop((user_id, item_id), None) is not None
+
+    async def query_items(
+        self,
+        user_id,
+        item_type,
+        conversation_id=None,
+        order_by="createdAt",
+        descending=False,
+        after=None,
+        offset=0,
+        limit=None,
+    ):
+        def sort_key(item):
+            return (item.get(order_by) or "", item["id"])
+
+        items = [
+            item
+            for (item_user_id, _), item in self.items.items()
+            if item_user_id == user_id
+            and item["type"] == item_type
+            and (
+                conversation_id is None or item.get("conversationId") == conversation_id
+            )
+        ]
+        items.sort(key=sort_key, reverse=descending)
+        if after is not None:
+            after = tuple(after)
+            items = [
+                item
+                for item in items
+                if (sort_key(item) < after if descending else sort_key(item) > after)
+            ]
+        end = None if limit is None else offset + limit
+        return copy.deepcopy(items[offset:end])
+
+
+class SqliteConversationStore(LocalConversationStore):
+    """Keeps the documents in a SQLite database file.
+
+    Statements run in a worker thread so the event loop is not blocked. The
+    columns the queries filter and sort on are stored next to the document.
+    """
+
+    ORDER_COLUMNS = {"id": "id", "createdAt": "created_at", "updatedAt": "updated_at"}
+
+    def __init__(self, path: str, enable_message_feedback: bool = False):
+        super().__init__(enable_message_feedback)
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection_lock = threading.Lock()
+        with self.connection:
+            # lets the workers of one host read while another one writes
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS items (
+                    user_id TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    conversation_id TEXT,
+                    created_at TEXT,
+                    updated_at TEXT,
+                    body TEXT NOT NULL,
+                    PRIMARY KEY (user_id, id)
+                )"""
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS items_by_type ON items (user_id, type, updated_at)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS items_by_conversation ON items (user_id, conversation_id, created_at)"
+            )
+
+    def execute_sync(self, sql, parameters):
+        with self.connection_lock, self.connection:
+            cursor = self.connection.execute(sql, parameters)
+            return cursor.fetchall(), cursor.rowcount
+
+    async def execute(self, sql, parameters=()):
+        return await asyncio.to_thread(self.execute_sync, sql, parameters)
+
+    async def ensure(self):
+        try:
+            await self.execute("SELECT 1")
+        except sqlite3.Error:
+            return False, f"SQLite database {self.path} is not usable"
+        return await super().ensure()
+
+    async def close(self):
+        await asyncio.to_thread(self.connection.close)
+
+    async def read_item(self, user_id, item_id):
+        rows, _ = await self.execute(
+            "SELECT body FROM items WHERE user_id = ? AND id = ?", (user_id, item_id)
+        )
+        if not rows:
+            return None
+        return json_loads(rows[0][0])
+
+    async def write_item(self, item):
+        await self.execute(
+            "INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                item["userId"],
+                item["id"],
+                item["type"],
+                item.get("conversationId"),
+                item.get("createdAt"),
+                item.get("updatedAt"),
+                json_dumps(item),
+            ),
+        )
+
+    async def remove_item(self, user_id, item_id):
+        _, rowcount = await self.execute(
+            "DELETE FROM items WHERE user_id = ? AND id = ?", (user_id, item_id)
+        )
+        return rowcount > 0
+
+    async def query_items(
+        self,
+        user_id,
+        item_type,
+        conversation_id=None,
+        order_by="createdAt",
+        descending=False,
+        after=None,
+        offset=0,
+        limit=None,
+    ):
+        column = self.ORDER_COLUMNS[order_by]
+        direction = "DESC" if descending else "ASC"
+        sql = "SELECT body FROM items WHERE user_id = ? AND type = ?"
+        parameters = [user_id, item_type]
+        if conversation_id is not None:
+            sql += " AND conversation_id = ?"
+            parameters.append(conversation_id)
+        if after is not None:
+            sql += f" AND ({column}, id) {'<' if descending else '>'} (?, ?)"
+            parameters.extend(after)
+        sql += f" ORDER BY {column} {direction}, id {direction}"
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            parameters.extend([-1 if limit is None else limit, offset])
+
+        rows, _ = await self.execute(sql, parameters)
+        return [json_loads(body) for body, in rows]
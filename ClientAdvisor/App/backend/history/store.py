@@ -0,0 +1,134 @@
+from abc import ABC, abstractmethod
+
+
+class PreconditionFailedError(Exception):
+    """Raised when a write made with an etag finds the item changed."""
+
+
+class ConversationStore(ABC):
+    """Chat history persistence used by the /history routes.
+
+    Conversations, messages and jobs are dicts shaped like the Cosmos DB
+    documents (id, type, userId, createdAt, updatedAt, _etag, ...). Paging
+    tokens are opaque strings; a token the store cannot use raises ValueError.
+    """
+
+    @abstractmethod
+    async def ensure(self):
+        """Return (success, message) describing whether the store works."""
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def create_conversation(self, user_id, title=""):
+        pass
+
+    @abstractmethod
+    async def upsert_conversation(self, conversation):
+        pass
+
+    @abstractmethod
+    async def update_conversation_title(
+        self, user_id, conversation_id, title, etag=None, expected_title=None
+    ):
+        """Return the conversation, or None if the user has no such one.
+
+        Given expected_title, the title is only replaced while it still is
+        that, and None is returned otherwise.
+        """
+
+    @abstractmethod
+    async def delete_conversation(self, user_id, conversation_id):
+        pass
+
+    @abstractmethod
+    async def delete_messages(self, conversation_id, user_id):
+        pass
+
+    @abstractmethod
+    async def get_conversations(self, user_id, limit, sort_order="DESC", offset=0):
+        pass
+
+    @abstractmethod
+    async def get_conversations_page(
+        self, user_id, limit, continuation_token=None, sort_order="DESC"
+    ):
+        """Return one page of conversations and the token of the next one."""
+
+    @abstractmethod
+    async def get_conversation_ids(self, user_id, page_size, continuation_token=None):
+        """Return one page of conversation ids and the token of the next one."""
+
+    @abstractmethod
+    async def get_conversation(self, user_id, conversation_id):
+        pass
+
+    @abstractmethod
+    def iter_conversations(self, user_id):
+        """Async generator of the user's conversations, most recent first."""
+
+    @abstractmethod
+    async def create_job(self, user_id, kind):
+        pass
+
+    @abstractmethod
+    async def update_job(self, user_id, job_id, **fields):
+        pass
+
+    @abstractmethod
+    async def get_job(self, user_id, job_id):
+        pass
+
+    @abstractmethod
+    async def create_message(
+        self, uuid, conversation_id, user_id, input_message: dict, created_at=None
+    ):
+        """Return the message, or "Conversation not found".
+
+        created_at defaults to now, as an ISO 8601 UTC string.
+        """
+
+    async def create_messages(self, conversation_id, user_id, input_messages):
+        """Write several messages of one conversation.
+
+        Each has an "id" and the "createdAt" it was sent at, which may be a
+        while before it is written. Returns the created messages, or
+        "Conversation not found".
+        """
+        responses = []
+        for input_message in input_messages:
+            resp = await self.create_message(
+                input_message["id"],
+                conversation_id,
+                user_id,
+                input_message,
+                created_at=input_message["createdAt"],
+            )
+            if resp == "Conversation not found":
+                return resp
+            responses.append(resp)
+        return responses
+
+    @abstractmethod
+    async def update_message_feedback(self, user_id, message_id, feedback, etag=None):
+        """Return the message, or False if the user has no such one."""
+
+    async def get_messages(self, user_id, conversation_id, conversation=None):
+        return [
+            message
+            async for message in self.iter_messages(
+                user_id, conversation_id, conversation
+            )
+        ]
+
+    @abstractmethod
+    def iter_messages(self, user_id, conversation_id, conversation=None):
+        """Async generator of the conversation's messages, oldest first.
+
+        conversation is the conversation document if the caller has read it
+        already, which saves stores that embed messages in it a read.
+        """
+
+    def cache_stats(self):
+        return None
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+
+
+class WriteBehindQueue:
+    """Persists chat history messages after the request that sent them.
+
+    Writes wait in a bounded queue in this worker. A single task takes
+    everything queued at once, merges it into one batch per conversation and
+    writes each batch with the store's create_messages, retrying failures with
+    exponential backoff. Message ids are fixed when they are queued, so a retry
+    overwrites rather than duplicates. close() waits for the queue to drain.
+    """
+
+    def __init__(self, get_store, max_size=1000, max_attempts=5, retry_delay=0.2):
+        # get_store returns the current history store when a batch is written
+        self.get_store = get_store
+        self.queue = asyncio.Queue(max_size)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.worker = None
+
+    def start(self):
+        if self.worker is None:
+            self.worker = asyncio.create_task(self.run())
+
+    def enqueue(self, user_id, conversation_id, messages):
+        # messages each carry their "id"; returns False when the queue is full
+        self.start()
+        try:
+            self.queue.put_nowait((user_id, conversation_id, messages))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def run(self):
+        while True:
+            writes = [await self.queue.get()]
+            while not self.queue.empty():
+                writes.append(self.queue.get_nowait())
+
+            # one batch per conversation, keeping the messages in queue order
+            batches = {}
+            for user_id, conversation_id, messages in writes:
+                batches.setdefault((user_id, conversation_id), []).extend(messages)
+
+            try:
+                await asyncio.gather(
+                    *(
+                        self.write(user_id, conversation_id, messages)
+                        for (user_id, conversation_id), messages in batches.items()
+                    )
+                )
+            finally:
+                for _ in writes:
+                    self.queue.task_done()
+
+    async def write(self, user_id, conversation_id, messages):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                response = await self.get_store().create_messages(
+                    conversation_id, user_id, messages
+                )
+                if response == "Conversation not found":
+                    # deleted since the messages were queued; retrying won't help
+                    logging.error(
+                        f"Dropping {len(messages)} chat history message(s) of missing conversation {conversation_id}"
+                    )
+                return
+            except Exception:
+                if attempt == self.max_attempts:
+                    logging.exception(
+                        f"Dropping {len(messages)} chat history message(s) of conversation {conversation_id}"
+                    )
+                    return
+                logging.warning(
+                    f"Writing chat history of conversation {conversation_id} failed, attempt {attempt} of {self.max_attempts}"
+                )
+                await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+
+    async def close(self, timeout):
+        if self.worker is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.error(
+                f"{self.queue.qsize()} chat history write(s) were not persisted before shutdown"
+            )
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.worker = None
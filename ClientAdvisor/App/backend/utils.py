@@ -1,9 +1,19 @@
+import asyncio
 import dataclasses
+import hashlib
 import json
 import logging
 import os
+import time
+import zlib
+from collections import OrderedDict
 
-import requests
+import httpx
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
@@ -12,6 +22,40 @@ if DEBUG.lower() == "true":
 AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get(
     "AZURE_SEARCH_PERMITTED_GROUPS_COLUMN"
 )
+# Seconds a user's group membership is reused before Graph is queried again
+AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL = float(
+    os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL", 300)
+)
+AZURE_SEARCH_PERMITTED_GROUPS_CACHE_SIZE = int(
+    os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_CACHE_SIZE", 1024)
+)
+
+GRAPH_USER_GROUPS_ENDPOINT = (
+    "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+)
+
+# sha256 of the user token -> (expiry, groups), least recently used first
+user_groups_cache = OrderedDict()
+# sha256 of the user token -> Graph lookup shared by concurrent requests
+user_groups_inflight = {}
+
+# Worker-wide HTTP client for Graph, so group lookups reuse pooled connections.
+# Opened on first use and closed with the app's other shared clients.
+shared_graph_client = None
+
+
+def get_graph_client():
+    global shared_graph_client
+    if shared_graph_client is None:
+        shared_graph_client = httpx.AsyncClient()
+    return shared_graph_client
+
+
+async def close_graph_client():
+    global shared_graph_client
+    if shared_graph_client is not None:
+        await shared_graph_client.aclose()
+        shared_graph_client = None
 
 
 class JSONEncoder(json.JSONEncoder):
@@ -21,13 +65,138 @@ class JSONEncoder(json.JSONEncoder):
         return super().default(o)
 
 
+# Keep the stdlib's acceptance of int/float dict keys; datetimes go through the
+# caller's default hook, as they would with json.dumps
+ORJSON_OPTIONS = (
+    orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME if orjson else 0
+)
+
+
+def json_dumps(obj, default=None):
+    """Serialize obj to a JSON string, with orjson when it is installed.
+
+    Falls back to json.dumps (with JSONEncoder unless a default hook is given)
+    when orjson is missing or cannot encode the value.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=default, option=ORJSON_OPTIONS).decode(
+                "utf-8"
+            )
+        except TypeError:
+            # e.g. integers wider than 64 bits, which only the stdlib encodes
+            pass
+    if default is not None:
+        return json.dumps(obj, default=default)
+    return json.dumps(obj, cls=JSONEncoder)
+
+
+def json_loads(s):
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
+
+
 async def format_as_ndjson(r):
     try:
         async for event in r:
-            yield json.dumps(event, cls=JSONEncoder) + "\n"
+            # Frames pre-rendered by a fast-path formatter are passed through as is
+            if isinstance(event, str):
+                yield event
+            else:
+                yield json_dumps(event) + "\n"
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
-        yield json.dumps({"error": str(error)})
+        yield json_dumps({"error": str(error)})
+
+
+async def gzip_ndjson(items, chunk_size=64 * 1024):
+    """Compress items as gzip NDJSON, yielding chunks of about chunk_size bytes.
+
+    Only the compressor state and one pending chunk are held, however many
+    items there are.
+    """
+    # wbits=31 writes the gzip header and trailer
+    compressor = zlib.compressobj(wbits=31)
+    buffer = bytearray()
+    async for item in items:
+        buffer += compressor.compress((json_dumps(item) + "\n").encode("utf-8"))
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    buffer += compressor.flush()
+    yield bytes(buffer)
+
+
+async def coalesce_ndjson(lines, max_bytes, max_delay, max_queued=64):
+    """Merge consecutive NDJSON lines into fewer, larger response chunks.
+
+    The first line is sent as soon as it arrives so the answer starts rendering
+    right away. After that, lines are buffered until either max_bytes are pending
+    or max_delay seconds have passed since the oldest pending line. A max_bytes
+    or max_delay of zero turns coalescing off. At most max_queued lines are read
+    ahead of the consumer, so a slow client slows the upstream down instead of
+    making it buffer.
+    """
+    if max_bytes <= 0 or max_delay <= 0:
+        async for line in lines:
+            yield line
+        return
+
+    # The upstream generator is drained by a single task, so the deadline can
+    # fire while it is still waiting for the next token
+    queue = asyncio.Queue(max_queued)
+    end = object()
+
+    async def pump():
+        try:
+            async for line in lines:
+                await queue.put(line)
+        except Exception as error:
+            await queue.put(error)
+            return
+        await queue.put(end)
+
+    producer = asyncio.ensure_future(pump())
+    loop = asyncio.get_running_loop()
+    buffer = []
+    size = 0
+    deadline = None
+    first = True
+    try:
+        while True:
+            timeout = None if deadline is None else deadline - loop.time()
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                yield "".join(buffer)
+                buffer, size, deadline = [], 0, None
+                continue
+
+            if item is end:
+                break
+            if isinstance(item, Exception):
+                if buffer:
+                    yield "".join(buffer)
+                raise item
+            if first:
+                first = False
+                yield item
+                continue
+
+            buffer.append(item)
+            # Counted in characters, which is close enough for a flush threshold
+            size += len(item)
+            if size >= max_bytes:
+                yield "".join(buffer)
+                buffer, size, deadline = [], 0, None
+            elif deadline is None:
+                deadline = loop.time() + max_delay
+
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        producer.cancel()
 
 
 def parse_multi_columns(columns: str) -> list:
@@ -37,34 +206,71 @@ def parse_multi_columns(columns: str) -> list:
         return columns.split(",")
 
 
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
-
+async def fetchUserGroups(userToken):
+    # Fetch group membership, following @odata.nextLink page by page.
+    # Returns None when Graph could not be queried.
+    endpoint = GRAPH_USER_GROUPS_ENDPOINT
     headers = {"Authorization": "bearer " + userToken}
+    groups = []
     try:
-        r = requests.get(endpoint, headers=headers)
-        if r.status_code != 200:
-            logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
-            return []
+        client = get_graph_client()
+        while endpoint:
+            r = await client.get(endpoint, headers=headers)
+            if r.status_code != 200:
+                logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
+                return None
 
-        r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r["value"].extend(nextLinkData)
+            r = r.json()
+            groups.extend(r["value"])
+            endpoint = r.get("@odata.nextLink")
 
-        return r["value"]
+        return groups
     except Exception as e:
         logging.error(f"Exception in fetchUserGroups: {e}")
-        return []
+        return None
+
+
+async def loadUserGroups(cacheKey, userToken):
+    try:
+        groups = await fetchUserGroups(userToken)
+        # Failed lookups are not cached so the next request retries Graph
+        if groups is not None and AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL > 0:
+            user_groups_cache[cacheKey] = (
+                time.monotonic() + AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL,
+                groups,
+            )
+            user_groups_cache.move_to_end(cacheKey)
+            while len(user_groups_cache) > AZURE_SEARCH_PERMITTED_GROUPS_CACHE_SIZE:
+                user_groups_cache.popitem(last=False)
+        return groups or []
+    finally:
+        user_groups_inflight.pop(cacheKey, None)
+
 
+async def getUserGroups(userToken):
+    # Serve group membership from the TTL cache, and let concurrent requests
+    # of the same user share a single in-flight Graph lookup
+    cacheKey = hashlib.sha256(userToken.encode("utf-8")).hexdigest()
+    cached = user_groups_cache.get(cacheKey)
+    if cached:
+        expiry, groups = cached
+        if expiry > time.monotonic():
+            user_groups_cache.move_to_end(cacheKey)
+            return groups
+        del user_groups_cache[cacheKey]
 
-def generateFilterString(userToken):
+    task = user_groups_inflight.get(cacheKey)
+    if task is None:
+        task = asyncio.ensure_future(loadUserGroups(cacheKey, userToken))
+        user_groups_inflight[cacheKey] = task
+
+    # Shield the shared lookup from cancellation of any single request
+    return await asyncio.shield(task)
+
+
+async def generateFilterString(userToken):
     # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
+    userGroups = await getUserGroups(userToken)
 
     # Construct filter string
     if not userGroups:
@@ -92,7 +298,7 @@ def format_non_streaming_response(chatCompletion, history_metadata, apim_request
                 response_obj["choices"][0]["messages"].append(
                     {
                         "role": "tool",
-                        "content": json.dumps(message.context),
+                        "content": json_dumps(message.context),
                     }
                 )
             response_obj["choices"][0]["messages"].append(
@@ -121,7 +327,7 @@ def format_stream_response(chatCompletionChunk, history_metadata, apim_request_i
         delta = chatCompletionChunk.choices[0].delta
         if delta:
             if hasattr(delta, "context"):
-                messageObj = {"role": "tool", "content": json.dumps(delta.context)}
+                messageObj = {"role": "tool", "content": json_dumps(delta.context)}
                 response_obj["choices"][0]["messages"].append(messageObj)
                 return response_obj
             if delta.role == "assistant" and hasattr(delta, "context"):
@@ -143,6 +349,39 @@ def format_stream_response(chatCompletionChunk, history_metadata, apim_request_i
     return {}
 
 
+# Stands in for the text while the rest of a stream frame is serialized
+STREAM_TEXT_MARKER = "\x00stream-text\x00"
+
+
+def stream_text_frame_formatter(id, model, created, history_metadata, apim_request_id):
+    """Build a formatter that turns a text chunk into a ready NDJSON frame.
+
+    Produces the same line as format_stream_response followed by format_as_ndjson
+    for an assistant text delta, but everything except the text is serialized once
+    per stream, so each chunk only costs one string encode.
+    """
+    frame = json_dumps(
+        {
+            "id": id,
+            "model": model,
+            "created": created,
+            "object": "extensions.chat.completion.chunk",
+            "choices": [
+                {"messages": [{"role": "assistant", "content": STREAM_TEXT_MARKER}]}
+            ],
+            "history_metadata": history_metadata,
+            "apim-request-id": apim_request_id,
+        }
+    )
+    prefix, suffix = frame.split(json_dumps(STREAM_TEXT_MARKER), 1)
+    suffix += "\n"
+
+    def format_frame(text):
+        return prefix + json_dumps(text) + suffix
+
+    return format_frame
+
+
 def format_pf_non_streaming_response(
     chatCompletion,
     history_metadata,
@@ -0,0 +1,98 @@
+import gzip
+import json
+import re
+from unittest.mock import MagicMock
+
+import pytest
+
+from backend.history.archive import LocalArchiveTarget, archive_history
+from backend.history.cosmosdbservice import HISTORY_INDEXING_POLICY
+
+
+class AsyncIterator:
+    def __init__(self, items):
+        self.items = iter(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.items)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+DAY = 24 * 60 * 60
+
+
+def read_archive(directory, name):
+    with gzip.open(directory / name, "rt") as file:
+        return [json.loads(line) for line in file]
+
+
+@pytest.mark.asyncio
+async def test_archive_history(tmp_path):
+    items = [
+        {"id": "conv_1", "type": "conversation", "_ts": 100},
+        {"id": "msg_1", "type": "message", "_ts": 200},
+    ]
+    container_client = MagicMock()
+    container_client.query_items = MagicMock(return_value=AsyncIterator(items))
+    target = LocalArchiveTarget(str(tmp_path))
+
+    name, count = await archive_history(
+        container_client, target, older_than_days=1, now=2 * DAY
+    )
+    assert name == f"history-0-{DAY}.jsonl.gz"
+    assert count == 2
+    assert read_archive(tmp_path, name) == items
+    parameters = container_client.query_items.call_args.kwargs["parameters"]
+    assert parameters == [
+        {"name": "@since", "value": 0},
+        {"name": "@cutoff", "value": DAY},
+    ]
+    assert await target.read_checkpoint() == DAY
+
+    # the next run starts at the previous cutoff
+    container_client.query_items = MagicMock(return_value=AsyncIterator([]))
+    name, count = await archive_history(
+        container_client, target, older_than_days=1, now=3 * DAY
+    )
+    assert name == f"history-{DAY}-{2 * DAY}.jsonl.gz"
+    assert count == 0
+    assert read_archive(tmp_path, name) == []
+
+    # and does nothing until the cutoff has moved on
+    assert await archive_history(
+        container_client, target, older_than_days=1, now=3 * DAY
+    ) == (None, 0)
+
+
+@pytest.mark.asyncio
+async def test_failed_archive_keeps_checkpoint(tmp_path):
+    async def failing_items():
+        yield {"id": "conv_1", "type": "conversation", "_ts": 100}
+        raise Exception("throttled")
+
+    container_client = MagicMock()
+    container_client.query_items = MagicMock(return_value=failing_items())
+    target = LocalArchiveTarget(str(tmp_path))
+
+    with pytest.raises(Exception):
+        await archive_history(container_client, target, older_than_days=1, now=2 * DAY)
+    assert await target.read_checkpoint() == 0
+    assert not list(tmp_path.glob("*.jsonl.gz"))
+
+
+@pytest.mark.asyncio
+async def test_archive_query_paths_are_indexed(tmp_path):
+    container_client = MagicMock()
+    container_client.query_items = MagicMock(return_value=AsyncIterator([]))
+    await archive_history(
+        container_client, LocalArchiveTarget(str(tmp_path)), 1, now=2 * DAY
+    )
+    query = container_client.query_items.call_args.kwargs["query"]
+    included = [path["path"] for path in HISTORY_INDEXING_POLICY["includedPaths"]]
+    for field in set(re.findall(r"c\.(\w+)", query.split("WHERE")[1])):
+        assert f"/{field}/?" in included
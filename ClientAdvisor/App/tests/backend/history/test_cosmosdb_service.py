@@ -1,9 +1,15 @@
+import asyncio
+import re
+import time
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
+from azure.core import MatchConditions
 from azure.cosmos import exceptions
 
-from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.cosmosdbservice import (HISTORY_INDEXING_POLICY,
+                                             CosmosConversationClient,
+                                             DeleteItemsError)
 
 
 # Helper function to create an async iterable
@@ -24,6 +30,13 @@ class AsyncIterator:
             raise StopAsyncIteration
 
 
+# Stands in for the page iterator returned by query_items(...).by_page()
+class AsyncPages(AsyncIterator):
+    def __init__(self, pages, continuation_token):
+        super().__init__([AsyncIterator(page) for page in pages])
+        self.continuation_token = continuation_token
+
+
 @pytest.fixture
 def cosmos_client():
     return CosmosConversationClient(
@@ -71,7 +84,7 @@ async def test_init_invalid_endpoint():
 @pytest.mark.asyncio
 async def test_ensure_success(cosmos_client):
     cosmos_client.database_client.read = AsyncMock()
-    cosmos_client.container_client.read = AsyncMock()
+    cosmos_client.container_client.read = AsyncMock(return_value={})
     success, message = await cosmos_client.ensure()
     assert success
     assert message == "CosmosDB client initialized successfully"
@@ -85,6 +98,13 @@ async def test_ensure_failure(cosmos_client):
     assert "CosmosDB database" in message
 
 
+@pytest.mark.asyncio
+async def test_close(cosmos_client):
+    cosmos_client.cosmosdb_client.close = AsyncMock()
+    await cosmos_client.close()
+    cosmos_client.cosmosdb_client.close.assert_awaited_once()
+
+
 @pytest.mark.asyncio
 async def test_create_conversation(cosmos_client):
     cosmos_client.container_client.upsert_item = AsyncMock(return_value={"id": "123"})
@@ -92,6 +112,24 @@ async def test_create_conversation(cosmos_client):
     assert response["id"] == "123"
 
 
+@pytest.mark.asyncio
+async def test_history_items_carry_ttl(cosmos_client):
+    cosmos_client.item_ttl = 90 * 24 * 60 * 60
+    cosmos_client.container_client.upsert_item = AsyncMock(
+        side_effect=lambda item: item
+    )
+    conversation = await cosmos_client.create_conversation("user_1")
+    assert conversation["ttl"] == 90 * 24 * 60 * 60
+    message = cosmos_client.new_message(
+        "msg_1", "conv_1", "user_1", {"role": "user", "content": "Hello"}
+    )
+    assert message["ttl"] == 90 * 24 * 60 * 60
+
+    cosmos_client.item_ttl = None
+    conversation = await cosmos_client.create_conversation("user_1")
+    assert "ttl" not in conversation
+
+
 @pytest.mark.asyncio
 async def test_create_conversation_failure(cosmos_client):
     cosmos_client.container_client.upsert_item = AsyncMock(return_value=None)
@@ -106,6 +144,65 @@ async def test_upsert_conversation(cosmos_client):
     assert response["id"] == "123"
 
 
+@pytest.mark.asyncio
+async def test_update_conversation_title(cosmos_client):
+    cosmos_client.container_client.patch_item = AsyncMock(
+        return_value={"id": "conv_1", "title": "New Title"}
+    )
+    response = await cosmos_client.update_conversation_title(
+        "user_1", "conv_1", "New Title"
+    )
+    assert response["title"] == "New Title"
+    cosmos_client.container_client.patch_item.assert_awaited_once_with(
+        item="conv_1",
+        partition_key="user_1",
+        patch_operations=[{"op": "set", "path": "/title", "value": "New Title"}],
+        filter_predicate="from c where c.type = 'conversation'",
+    )
+
+
+@pytest.mark.asyncio
+async def test_update_conversation_title_with_etag(cosmos_client):
+    cosmos_client.container_client.patch_item = AsyncMock(
+        side_effect=exceptions.CosmosAccessConditionFailedError
+    )
+    with pytest.raises(exceptions.CosmosAccessConditionFailedError):
+        await cosmos_client.update_conversation_title(
+            "user_1", "conv_1", "New Title", etag="etag_1"
+        )
+    kwargs = cosmos_client.container_client.patch_item.call_args.kwargs
+    assert kwargs["etag"] == "etag_1"
+    assert kwargs["match_condition"] == MatchConditions.IfNotModified
+
+
+@pytest.mark.asyncio
+async def test_update_conversation_title_if_unchanged(cosmos_client):
+    # the filter predicate fails once the title has changed
+    cosmos_client.container_client.patch_item = AsyncMock(
+        side_effect=exceptions.CosmosAccessConditionFailedError
+    )
+    response = await cosmos_client.update_conversation_title(
+        "user_1", "conv_1", "Generated", expected_title='Say "hi"'
+    )
+    assert response is None
+    kwargs = cosmos_client.container_client.patch_item.call_args.kwargs
+    assert (
+        kwargs["filter_predicate"]
+        == 'from c where c.type = \'conversation\' and c.title = "Say \\"hi\\""'
+    )
+
+
+@pytest.mark.asyncio
+async def test_update_conversation_title_not_found(cosmos_client):
+    cosmos_client.container_client.patch_item = AsyncMock(
+        side_effect=exceptions.CosmosResourceNotFoundError
+    )
+    response = await cosmos_client.update_conversation_title(
+        "user_1", "conv_1", "New Title"
+    )
+    assert response is None
+
+
 @pytest.mark.asyncio
 async def test_delete_conversation(cosmos_client):
     cosmos_client.container_client.read_item = AsyncMock(return_value={"id": "123"})
@@ -123,14 +220,59 @@ async def test_delete_conversation_not_found(cosmos_client):
 
 @pytest.mark.asyncio
 async def test_delete_messages(cosmos_client):
-    cosmos_client.get_messages = AsyncMock(
-        return_value=[{"id": "msg_1"}, {"id": "msg_2"}]
+    cosmos_client.container_client.query_items = MagicMock(
+        return_value=AsyncIterator([{"id": "msg_1"}, {"id": "msg_2"}])
     )
     cosmos_client.container_client.delete_item = AsyncMock(return_value=True)
     response = await cosmos_client.delete_messages("conv_1", "user_1")
     assert len(response) == 2
 
 
+@pytest.mark.asyncio
+async def test_delete_messages_bounded_concurrency(cosmos_client):
+    cosmos_client.delete_concurrency = 3
+    cosmos_client.container_client.query_items = MagicMock(
+        return_value=AsyncIterator([{"id": f"msg_{i}"} for i in range(10)])
+    )
+    in_flight = 0
+    max_in_flight = 0
+
+    async def delete_item(item, partition_key):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0)
+        in_flight -= 1
+
+    cosmos_client.container_client.delete_item = AsyncMock(side_effect=delete_item)
+    response = await cosmos_client.delete_messages("conv_1", "user_1")
+    assert len(response) == 10
+    assert cosmos_client.container_client.delete_item.await_count == 10
+    assert max_in_flight == 3
+
+
+@pytest.mark.asyncio
+async def test_delete_messages_reports_failures(cosmos_client):
+    cosmos_client.container_client.query_items = MagicMock(
+        return_value=AsyncIterator([{"id": "msg_1"}, {"id": "msg_2"}, {"id": "msg_3"}])
+    )
+    error = exceptions.CosmosHttpResponseError(status_code=429)
+
+    async def delete_item(item, partition_key):
+        if item == "msg_1":
+            raise exceptions.CosmosResourceNotFoundError
+        if item == "msg_2":
+            raise error
+
+    cosmos_client.container_client.delete_item = AsyncMock(side_effect=delete_item)
+    with pytest.raises(DeleteItemsError) as exc_info:
+        await cosmos_client.delete_messages("conv_1", "user_1")
+
+    # every delete is attempted; a message that is already gone is not a failure
+    assert cosmos_client.container_client.delete_item.await_count == 3
+    assert exc_info.value.failures == {"msg_2": error}
+
+
 @pytest.mark.asyncio
 async def test_get_conversations(cosmos_client):
     items = [{"id": "conv_1"}, {"id": "conv_2"}]
@@ -141,37 +283,1002 @@ async def test_get_conversations(cosmos_client):
     assert len(response) == 2
     assert response[0]["id"] == "conv_1"
     assert response[1]["id"] == "conv_2"
+    query = cosmos_client.container_client.query_items.call_args.kwargs["query"]
+    assert query.startswith("SELECT c.id, c.title, c.createdAt, c.updatedAt FROM c")
 
 
 @pytest.mark.asyncio
-async def test_get_conversation(cosmos_client):
-    items = [{"id": "conv_1"}]
+async def test_get_conversation_ids(cosmos_client):
+    pages = AsyncPages(
+        [[{"id": "conv_1"}, {"id": "conv_2"}], [{"id": "conv_3"}]], "next"
+    )
+    query_items = MagicMock()
+    query_items.return_value.by_page.return_value = pages
+    cosmos_client.container_client.query_items = query_items
+    conversation_ids, continuation_token = await cosmos_client.get_conversation_ids(
+        "user_1", 2, "token"
+    )
+    # only the first page is read
+    assert conversation_ids == ["conv_1", "conv_2"]
+    assert continuation_token == "next"
+    assert query_items.call_args.kwargs["partition_key"] == "user_1"
+    assert query_items.call_args.kwargs["max_item_count"] == 2
+    query_items.return_value.by_page.assert_called_once_with("token")
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_page(cosmos_client):
+    query_items = MagicMock()
+    query_items.return_value.by_page.return_value = AsyncPages(
+        [[{"id": "conv_1"}, {"id": "conv_2"}]], None
+    )
+    cosmos_client.container_client.query_items = query_items
+    conversations, continuation_token = await cosmos_client.get_conversations_page(
+        "user_1", 25
+    )
+    assert [c["id"] for c in conversations] == ["conv_1", "conv_2"]
+    assert continuation_token is None
+    assert "offset" not in query_items.call_args.kwargs["query"]
+    assert "SELECT *" not in query_items.call_args.kwargs["query"]
+    assert "order by c.updatedAt DESC" in query_items.call_args.kwargs["query"]
+    query_items.return_value.by_page.assert_called_once_with(None)
+
+
+@pytest.mark.asyncio
+async def test_order_by_queries_without_composite_indexes(cosmos_client):
+    # containers on the default indexing policy only sort on single fields
+    cosmos_client.database_client.read = AsyncMock()
+    cosmos_client.container_client.read = AsyncMock(
+        return_value={"indexingPolicy": {"compositeIndexes": []}}
+    )
+    success, _ = await cosmos_client.ensure()
+    assert success
+    assert not cosmos_client.composite_order_by
+
     cosmos_client.container_client.query_items = MagicMock(
-        return_value=AsyncIterator(items)
+        return_value=AsyncIterator([])
+    )
+    await cosmos_client.get_conversations("user_1", None, "ASC")
+    query = cosmos_client.container_client.query_items.call_args.kwargs["query"]
+    assert query.endswith("order by c.updatedAt ASC")
+
+    cosmos_client.container_client.query_items = MagicMock(
+        return_value=AsyncIterator([])
+    )
+    await cosmos_client.get_messages("user_1", "conv_1")
+    query = cosmos_client.container_client.query_items.call_args.kwargs["query"]
+    assert query.endswith("ORDER BY c.createdAt")
+
+
+@pytest.mark.asyncio
+async def test_order_by_queries_use_composite_indexes(cosmos_client):
+    cosmos_client.database_client.read = AsyncMock()
+    cosmos_client.container_client.read = AsyncMock(
+        return_value={"indexingPolicy": HISTORY_INDEXING_POLICY}
+    )
+    await cosmos_client.ensure()
+    assert cosmos_client.composite_order_by
+
+    composite_indexes = [
+        [index["path"] for index in composite]
+        for composite in HISTORY_INDEXING_POLICY["compositeIndexes"]
+    ]
+
+    def order_by_paths(query):
+        order_by = re.split("order by", query, flags=re.IGNORECASE)[1]
+        return [
+            "/" + term.split()[0].removeprefix("c.") for term in order_by.split(",")
+        ]
+
+    query_items = MagicMock()
+    query_items.return_value.by_page.return_value = AsyncPages([[]], None)
+    cosmos_client.container_client.query_items = query_items
+    await cosmos_client.get_conversations_page("user_1", 25)
+    assert order_by_paths(query_items.call_args.kwargs["query"]) in composite_indexes
+
+    cosmos_client.container_client.query_items = MagicMock(
+        return_value=AsyncIterator([])
+    )
+    await cosmos_client.get_messages("user_1", "conv_1")
+    query = cosmos_client.container_client.query_items.call_args.kwargs["query"]
+    assert order_by_paths(query) in composite_indexes
+
+    cosmos_client.container_client.query_items = MagicMock(
+        return_value=AsyncIterator([])
+    )
+    assert [c async for c in cosmos_client.iter_conversations("user_1")] == []
+    query = cosmos_client.container_client.query_items.call_args.kwargs["query"]
+    assert order_by_paths(query) in composite_indexes
+
+
+@pytest.mark.asyncio
+async def test_create_job(cosmos_client):
+    cosmos_client.container_client.create_item = AsyncMock(side_effect=lambda job: job)
+    job = await cosmos_client.create_job("user_1", "delete_all")
+    assert job["type"] == "job"
+    assert job["kind"] == "delete_all"
+    assert job["userId"] == "user_1"
+    assert job["status"] == "running"
+    assert job["deleted"] == 0
+    assert job["failed"] == 0
+
+
+@pytest.mark.asyncio
+async def test_update_job(cosmos_client):
+    cosmos_client.container_client.patch_item = AsyncMock(return_value={"id": "job_1"})
+    await cosmos_client.update_job("user_1", "job_1", deleted=3, failed=1)
+    kwargs = cosmos_client.container_client.patch_item.call_args.kwargs
+    operations = kwargs["patch_operations"]
+    assert operations[:2] == [
+        {"op": "set", "path": "/deleted", "value": 3},
+        {"op": "set", "path": "/failed", "value": 1},
+    ]
+    assert operations[2]["path"] == "/updatedAt"
+    assert kwargs["filter_predicate"] == "from c where c.type = 'job'"
+
+
+@pytest.mark.asyncio
+async def test_get_job(cosmos_client):
+    cosmos_client.container_client.read_item = AsyncMock(
+        return_value={"id": "job_1", "type": "job"}
+    )
+    assert await cosmos_client.get_job("user_1", "job_1") == {
+        "id": "job_1",
+        "type": "job",
+    }
+
+    # other documents of the user are not jobs
+    cosmos_client.container_client.read_item = AsyncMock(
+        return_value={"id": "conv_1", "type": "conversation"}
+    )
+    assert await cosmos_client.get_job("user_1", "conv_1") is None
+
+    cosmos_client.container_client.read_item = AsyncMock(
+        side_effect=exceptions.CosmosResourceNotFoundError
     )
+    assert await cosmos_client.get_job("user_1", "job_2") is None
+
+
+@pytest.fixture
+def indexed_cosmos_client(cosmos_client):
+    cosmos_client.use_conversation_index = True
+    cosmos_client.conversation_index_size = 2
+    return cosmos_client
+
+
+def conversation_entry(conversation_id, updated_at, ts=1704067200):
+    return {
+        "id": conversation_id,
+        "title": f"Title {conversation_id}",
+        "createdAt": "2024-01-01T00:00:00",
+        "updatedAt": updated_at,
+        "_ts": ts,
+    }
+
+
+def listed(entries):
+    # the index entries as the history list serves them
+    return [
+        {key: value for key, value in entry.items() if key != "_ts"}
+        for entry in entries
+    ]
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_from_index(indexed_cosmos_client):
+    entries = [
+        conversation_entry("conv_1", "2024-01-01T00:00:01"),
+        conversation_entry("conv_2", "2024-01-01T00:00:03"),
+        conversation_entry("conv_3", "2024-01-01T00:00:02"),
+    ]
+    container_client = indexed_cosmos_client.container_client
+    container_client.read_item = AsyncMock(
+        return_value={
+            "id": "conversationIndex",
+            "complete": True,
+            "overflow": False,
+            "conversations": {entry["id"]: entry for entry in entries},
+        }
+    )
+    container_client.query_items = MagicMock()
+
+    response = await indexed_cosmos_client.get_conversations("user_1", 2, offset=0)
+    assert [c["id"] for c in response] == ["conv_2", "conv_3"]
+    response = await indexed_cosmos_client.get_conversations("user_1", 2, offset="2")
+    assert [c["id"] for c in response] == ["conv_1"]
+    container_client.query_items.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_from_index_skips_expired(indexed_cosmos_client):
+    indexed_cosmos_client.item_ttl = 24 * 60 * 60
+    now = time.time()
+    entries = [
+        # last written two days ago
+        conversation_entry("conv_1", "2024-01-01T00:00:02", ts=now - 2 * 24 * 3600),
+        # updated long ago, but renamed an hour ago
+        conversation_entry("conv_2", "2024-01-01T00:00:01", ts=now - 3600),
+    ]
+    container_client = indexed_cosmos_client.container_client
+    container_client.read_item = AsyncMock(
+        return_value={
+            "id": "conversationIndex",
+            "complete": True,
+            "overflow": False,
+            "conversations": {entry["id"]: entry for entry in entries},
+        }
+    )
+    container_client.query_items = MagicMock()
+
+    response = await indexed_cosmos_client.get_conversations("user_1", 25)
+    assert [c["id"] for c in response] == ["conv_2"]
+    container_client.query_items.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_rebuilds_index(indexed_cosmos_client):
+    entries = [
+        conversation_entry("conv_2", "2024-01-01T00:00:03"),
+        conversation_entry("conv_1", "2024-01-01T00:00:01"),
+    ]
+    container_client = indexed_cosmos_client.container_client
+    container_client.read_item = AsyncMock(
+        side_effect=exceptions.CosmosResourceNotFoundError
+    )
+    container_client.query_items = MagicMock(return_value=AsyncIterator(entries))
+    container_client.create_item = AsyncMock()
+
+    response = await indexed_cosmos_client.get_conversations("user_1", 25)
+
+    assert response == listed(entries)
+    assert "c._ts" in container_client.query_items.call_args.kwargs["query"]
+    index = container_client.create_item.call_args[0][0]
+    assert index["complete"] is True
+    assert index["overflow"] is False
+    assert index["conversations"] == {entry["id"]: entry for entry in entries}
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_rebuild_loses_race(indexed_cosmos_client):
+    entries = [conversation_entry("conv_1", "2024-01-01T00:00:01")]
+    container_client = indexed_cosmos_client.container_client
+    container_client.read_item = AsyncMock(
+        return_value={"complete": False, "_etag": "etag_1", "conversations": {}}
+    )
+    container_client.query_items = MagicMock(return_value=AsyncIterator(entries))
+    container_client.replace_item = AsyncMock(
+        side_effect=exceptions.CosmosAccessConditionFailedError
+    )
+
+    # the rebuilt list is still served, only storing it is skipped
+    response = await indexed_cosmos_client.get_conversations("user_1", 25)
+    assert response == listed(entries)
+    assert container_client.replace_item.call_args.kwargs["etag"] == "etag_1"
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_index_overflow(indexed_cosmos_client):
+    entries = [
+        conversation_entry("conv_3", "2024-01-01T00:00:03"),
+        conversation_entry("conv_2", "2024-01-01T00:00:02"),
+    ]
+    container_client = indexed_cosmos_client.container_client
+    container_client.read_item = AsyncMock(
+        return_value={
+            "complete": True,
+            "overflow": True,
+            "conversations": {entry["id"]: entry for entry in entries},
+        }
+    )
+    container_client.query_items = MagicMock(return_value=AsyncIterator([]))
+
+    response = await indexed_cosmos_client.get_conversations("user_1", 1, offset=1)
+    assert [c["id"] for c in response] == ["conv_2"]
+    container_client.query_items.assert_not_called()
+
+    # the page reaches past the indexed conversations
+    await indexed_cosmos_client.get_conversations("user_1", 25, offset=0)
+    assert "offset 0 limit 25" in container_client.query_items.call_args.kwargs["query"]
+
+
+@pytest.mark.asyncio
+async def test_create_conversation_starts_index(indexed_cosmos_client):
+    container_client = indexed_cosmos_client.container_client
+    container_client.upsert_item = AsyncMock(side_effect=lambda item: item)
+    container_client.patch_item = AsyncMock(
+        side_effect=exceptions.CosmosResourceNotFoundError
+    )
+    container_client.create_item = AsyncMock()
+
+    conversation = await indexed_cosmos_client.create_conversation("user_1", "Title")
+
+    index = container_client.create_item.call_args[0][0]
+    assert index["complete"] is False
+    assert index["conversations"] == {
+        conversation["id"]: {
+            "id": conversation["id"],
+            "title": "Title",
+            "createdAt": conversation["createdAt"],
+            "updatedAt": conversation["updatedAt"],
+            "_ts": None,
+        }
+    }
+
+
+@pytest.mark.asyncio
+async def test_index_conversation_trims_index(indexed_cosmos_client):
+    entries = [
+        conversation_entry("conv_1", "2024-01-01T00:00:01"),
+        conversation_entry("conv_2", "2024-01-01T00:00:03"),
+        conversation_entry("conv_3", "2024-01-01T00:00:02"),
+    ]
+    container_client = indexed_cosmos_client.container_client
+    # the patched index holds one entry more than conversation_index_size
+    container_client.patch_item = AsyncMock(
+        return_value={
+            "id": "conversationIndex",
+            "_etag": "etag_1",
+            "complete": True,
+            "overflow": False,
+            "conversations": {entry["id"]: entry for entry in entries},
+        }
+    )
+    container_client.replace_item = AsyncMock()
+
+    await indexed_cosmos_client.index_conversation("user_1", entries[1])
+
+    kwargs = container_client.replace_item.call_args.kwargs
+    assert kwargs["etag"] == "etag_1"
+    assert kwargs["match_condition"] == MatchConditions.IfNotModified
+    assert kwargs["body"]["overflow"] is True
+    assert list(kwargs["body"]["conversations"]) == ["conv_2", "conv_3"]
+
+
+@pytest.mark.asyncio
+async def test_update_conversation_title_reindexes(indexed_cosmos_client):
+    # a rename moves the conversation's _ts, which its TTL counts from
+    renamed = {
+        **conversation_entry("conv_1", "2024-01-01T00:00:01", ts=2),
+        "messages": [],
+    }
+    container_client = indexed_cosmos_client.container_client
+    container_client.patch_item = AsyncMock(return_value=renamed)
+
+    await indexed_cosmos_client.update_conversation_title("user_1", "conv_1", "New")
+
+    kwargs = container_client.patch_item.call_args.kwargs
+    assert kwargs["item"] == "conversationIndex"
+    assert kwargs["patch_operations"] == [
+        {
+            "op": "set",
+            "path": "/conversations/conv_1",
+            "value": conversation_entry("conv_1", "2024-01-01T00:00:01", ts=2),
+        }
+    ]
+    assert "IS_DEFINED(c.conversations['conv_1'])" in kwargs["filter_predicate"]
+
+
+@pytest.mark.asyncio
+async def test_index_failure_drops_index(indexed_cosmos_client):
+    container_client = indexed_cosmos_client.container_client
+    container_client.upsert_item = AsyncMock(side_effect=lambda item: item)
+    container_client.patch_item = AsyncMock(
+        side_effect=exceptions.CosmosHttpResponseError(status_code=429)
+    )
+    container_client.delete_item = AsyncMock()
+
+    conversation = await indexed_cosmos_client.create_conversation("user_1", "Title")
+
+    assert conversation["title"] == "Title"
+    container_client.delete_item.assert_awaited_once_with(
+        item="conversationIndex", partition_key="user_1"
+    )
+
+
+@pytest.mark.asyncio
+async def test_delete_conversation_updates_index(indexed_cosmos_client):
+    container_client = indexed_cosmos_client.container_client
+    container_client.read_item = AsyncMock(return_value={"id": "conv_1"})
+    container_client.delete_item = AsyncMock()
+    container_client.patch_item = AsyncMock(
+        side_effect=exceptions.CosmosAccessConditionFailedError
+    )
+
+    await indexed_cosmos_client.delete_conversation("user_1", "conv_1")
+
+    kwargs = container_client.patch_item.call_args.kwargs
+    assert kwargs["item"] == "conversationIndex"
+    assert kwargs["patch_operations"] == [
+        {"op": "remove", "path": "/conversations/conv_1"}
+    ]
+    # a conversation the index does not hold is not an index failure
+    container_client.delete_item.assert_awaited_once_with(
+        item="conv_1", partition_key="user_1"
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_conversation(cosmos_client):
+    cosmos_client.container_client.read_item = AsyncMock(
+        return_value={"id": "conv_1", "type": "conversation", "userId": "user_1"}
+    )
+    cosmos_client.container_client.query_items = MagicMock()
     response = await cosmos_client.get_conversation("user_1", "conv_1")
     assert response["id"] == "conv_1"
+    cosmos_client.container_client.read_item.assert_awaited_once_with(
+        item="conv_1", partition_key="user_1"
+    )
+    cosmos_client.container_client.query_items.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_get_conversation_not_found(cosmos_client):
+    cosmos_client.container_client.read_item = AsyncMock(
+        side_effect=exceptions.CosmosResourceNotFoundError
+    )
+    assert await cosmos_client.get_conversation("user_1", "conv_1") is None
+
+
+@pytest.mark.asyncio
+async def test_get_conversation_wrong_document(cosmos_client):
+    # a message, or a document of another user, is not a conversation
+    cosmos_client.container_client.read_item = AsyncMock(
+        return_value={"id": "msg_1", "type": "message", "userId": "user_1"}
+    )
+    assert await cosmos_client.get_conversation("user_1", "msg_1") is None
+
+    cosmos_client.container_client.read_item = AsyncMock(
+        return_value={"id": "conv_1", "type": "conversation", "userId": "user_2"}
+    )
+    assert await cosmos_client.get_conversation("user_1", "conv_1") is None
+
+
+@pytest.fixture
+def cached_cosmos_client():
+    return CosmosConversationClient(
+        cosmosdb_endpoint="https://fake.endpoint",
+        credential="fake_credential",
+        database_name="test_db",
+        container_name="test_container",
+        cache_size=2,
+        cache_ttl=30,
+    )
+
+
+def mock_conversation_reads(client, etag="etag_1"):
+    client.container_client.read_item = AsyncMock(
+        return_value={
+            "id": "conv_1",
+            "type": "conversation",
+            "userId": "user_1",
+            "_etag": etag,
+        }
+    )
+    client.container_client.query_items = MagicMock(
+        side_effect=lambda **kwargs: AsyncIterator([{"id": "msg_1"}])
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_conversation_cached(cached_cosmos_client):
+    mock_conversation_reads(cached_cosmos_client)
+    for _ in range(2):
+        conversation = await cached_cosmos_client.get_conversation("user_1", "conv_1")
+        messages = await cached_cosmos_client.get_messages("user_1", "conv_1")
+        assert conversation["id"] == "conv_1"
+        assert messages == [{"id": "msg_1"}]
+
+    assert cached_cosmos_client.container_client.read_item.await_count == 1
+    assert cached_cosmos_client.container_client.query_items.call_count == 1
+    stats = cached_cosmos_client.cache_stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 2
+    assert stats["size"] == 1
+
+
+@pytest.mark.asyncio
+async def test_get_conversation_cache_revalidates_with_etag(cached_cosmos_client):
+    mock_conversation_reads(cached_cosmos_client)
+    await cached_cosmos_client.get_conversation("user_1", "conv_1")
+    await cached_cosmos_client.get_messages("user_1", "conv_1")
+
+    # expire the entry; the 304 keeps the conversation but not its messages,
+    # which can change without touching it
+    cached_cosmos_client.cache.ttl = 0
+    cached_cosmos_client.cache.refresh(
+        cached_cosmos_client.cache.get("user_1", "conv_1")
+    )
+    cached_cosmos_client.cache.ttl = 30
+    cached_cosmos_client.container_client.read_item = AsyncMock(return_value=None)
+    conversation = await cached_cosmos_client.get_conversation("user_1", "conv_1")
+    messages = await cached_cosmos_client.get_messages("user_1", "conv_1")
+
+    assert conversation["_etag"] == "etag_1"
+    assert messages == [{"id": "msg_1"}]
+    cached_cosmos_client.container_client.read_item.assert_awaited_once_with(
+        item="conv_1",
+        partition_key="user_1",
+        etag="etag_1",
+        match_condition=MatchConditions.IfModified,
+    )
+    assert cached_cosmos_client.container_client.query_items.call_count == 2
+    assert cached_cosmos_client.cache_stats()["revalidations"] == 1
+
+
+@pytest.mark.asyncio
+async def test_delete_messages_ignores_cached_messages(cached_cosmos_client):
+    mock_conversation_reads(cached_cosmos_client)
+    await cached_cosmos_client.get_conversation("user_1", "conv_1")
+    await cached_cosmos_client.get_messages("user_1", "conv_1")
+
+    # another worker added msg_2 since the messages were cached
+    cached_cosmos_client.container_client.query_items = MagicMock(
+        return_value=AsyncIterator([{"id": "msg_1"}, {"id": "msg_2"}])
+    )
+    cached_cosmos_client.container_client.delete_item = AsyncMock()
+    await cached_cosmos_client.delete_messages("conv_1", "user_1")
+
+    deleted = [
+        call.kwargs["item"]
+        for call in cached_cosmos_client.container_client.delete_item.await_args_list
+    ]
+    assert deleted == ["msg_1", "msg_2"]
+    assert cached_cosmos_client.cache.get("user_1", "conv_1") is None
+
+
+@pytest.mark.asyncio
+async def test_get_conversation_cache_invalidated_by_writes(cached_cosmos_client):
+    mock_conversation_reads(cached_cosmos_client)
+    await cached_cosmos_client.get_conversation("user_1", "conv_1")
+    await cached_cosmos_client.get_messages("user_1", "conv_1")
+
+    cached_cosmos_client.container_client.patch_item = AsyncMock(
+        return_value={"id": "msg_1", "conversationId": "conv_1"}
+    )
+    await cached_cosmos_client.update_message_feedback("user_1", "msg_1", "positive")
+    assert cached_cosmos_client.cache.get("user_1", "conv_1") is None
+
+    await cached_cosmos_client.get_conversation("user_1", "conv_1")
+    cached_cosmos_client.container_client.patch_item = AsyncMock(
+        return_value={"id": "conv_1", "title": "New title"}
+    )
+    await cached_cosmos_client.update_conversation_title(
+        "user_1", "conv_1", "New title"
+    )
+    assert cached_cosmos_client.cache.get("user_1", "conv_1") is None
+
+
+@pytest.mark.asyncio
+async def test_get_messages_cache_skips_stale_store(cached_cosmos_client):
+    mock_conversation_reads(cached_cosmos_client)
+    await cached_cosmos_client.get_conversation("user_1", "conv_1")
+
+    # a write lands while the messages are being read
+    generation = cached_cosmos_client.cache.generation
+    cached_cosmos_client.invalidate_conversation("user_1", "conv_2")
+    cached_cosmos_client.cache.put_messages("user_1", "conv_1", [], generation)
+    assert cached_cosmos_client.cache.get("user_1", "conv_1").messages is None
+
+
+@pytest.mark.asyncio
+async def test_iter_messages_fills_cache(cached_cosmos_client):
+    mock_conversation_reads(cached_cosmos_client)
+    await cached_cosmos_client.get_conversation("user_1", "conv_1")
+
+    streamed = [
+        message
+        async for message in cached_cosmos_client.iter_messages("user_1", "conv_1")
+    ]
+    assert streamed == [{"id": "msg_1"}]
+    assert cached_cosmos_client.cache.get("user_1", "conv_1").messages == streamed
+    assert await cached_cosmos_client.get_messages("user_1", "conv_1") == streamed
+    assert cached_cosmos_client.container_client.query_items.call_count == 1
+
+
+def test_conversation_cache_is_bounded(cached_cosmos_client):
+    cache = cached_cosmos_client.cache
+    for conversation_id in ["conv_1", "conv_2", "conv_3"]:
+        cache.put("user_1", conversation_id, {"id": conversation_id}, 0)
+        cache.get("user_1", "conv_1")
+
+    # conv_1 was used last, so conv_2 was evicted
+    assert cache.get("user_1", "conv_1") is not None
+    assert cache.get("user_1", "conv_2") is None
+    assert cache.get("user_1", "conv_3") is not None
+
+
+def test_cache_stats_disabled(cosmos_client):
+    assert cosmos_client.cache is None
+    assert cosmos_client.cache_stats() is None
+
+
+@pytest.fixture
+def hierarchical_cosmos_client():
+    return CosmosConversationClient(
+        cosmosdb_endpoint="https://fake.endpoint",
+        credential="fake_credential",
+        database_name="test_db",
+        container_name="test_container",
+        hierarchical_partition_key=True,
+    )
+
+
+@pytest.mark.asyncio
+async def test_ensure_hierarchical_partition_key(hierarchical_cosmos_client):
+    hierarchical_cosmos_client.database_client.read = AsyncMock()
+    hierarchical_cosmos_client.container_client.read = AsyncMock(
+        return_value={"partitionKey": {"paths": ["/userId"], "kind": "Hash"}}
+    )
+    success, message = await hierarchical_cosmos_client.ensure()
+    assert not success
+    assert "/userId and /conversationId" in message
+
+    hierarchical_cosmos_client.container_client.read = AsyncMock(
+        return_value={
+            "partitionKey": {
+                "paths": ["/userId", "/conversationId"],
+                "kind": "MultiHash",
+            }
+        }
+    )
+    success, _ = await hierarchical_cosmos_client.ensure()
+    assert success
+
+
+@pytest.mark.asyncio
+async def test_hierarchical_partition_key_reads(hierarchical_cosmos_client):
+    container_client = hierarchical_cosmos_client.container_client
+    container_client.read_item = AsyncMock(
+        return_value={"id": "conv_1", "type": "conversation", "userId": "user_1"}
+    )
+    container_client.query_items = MagicMock(return_value=AsyncIterator([]))
+
+    await hierarchical_cosmos_client.get_conversation("user_1", "conv_1")
+    container_client.read_item.assert_awaited_once_with(
+        item="conv_1", partition_key=["user_1", "conv_1"]
+    )
+
+    # a conversation's messages are in one logical partition
+    await hierarchical_cosmos_client.get_messages("user_1", "conv_1")
+    assert container_client.query_items.call_args.kwargs["partition_key"] == [
+        "user_1",
+        "conv_1",
+    ]
+
+    # the user's conversations are found by key prefix
+    query_items = MagicMock()
+    query_items.return_value.by_page.return_value = AsyncPages([[]], None)
+    container_client.query_items = query_items
+    await hierarchical_cosmos_client.get_conversations_page("user_1", 10)
+    assert query_items.call_args.kwargs["partition_key"] == ["user_1"]
+
+
+@pytest.mark.asyncio
+async def test_hierarchical_partition_key_writes(hierarchical_cosmos_client):
+    container_client = hierarchical_cosmos_client.container_client
+    container_client.upsert_item = AsyncMock(side_effect=lambda item: item)
+    conversation = await hierarchical_cosmos_client.create_conversation("user_1")
+    assert conversation["conversationId"] == conversation["id"]
+
+    container_client.create_item = AsyncMock(side_effect=lambda item: item)
+    job = await hierarchical_cosmos_client.create_job("user_1", "delete_all")
+    assert job["conversationId"] == job["id"]
+
+    # feedback looks up the message's conversation first
+    container_client.query_items = MagicMock(return_value=AsyncIterator(["conv_1"]))
+    container_client.patch_item = AsyncMock(
+        return_value={"id": "msg_1", "conversationId": "conv_1"}
+    )
+    await hierarchical_cosmos_client.update_message_feedback(
+        "user_1", "msg_1", "positive"
+    )
+    assert container_client.query_items.call_args.kwargs["partition_key"] == ["user_1"]
+    assert container_client.patch_item.call_args.kwargs["partition_key"] == [
+        "user_1",
+        "conv_1",
+    ]
+
+    container_client.query_items = MagicMock(return_value=AsyncIterator([]))
+    assert (
+        await hierarchical_cosmos_client.update_message_feedback(
+            "user_1", "missing", "positive"
+        )
+        is False
+    )
+
+    container_client.delete_item = AsyncMock()
+    await hierarchical_cosmos_client.delete_items("user_1", ["msg_1"], "conv_1")
+    container_client.delete_item.assert_awaited_once_with(
+        item="msg_1", partition_key=["user_1", "conv_1"]
+    )
+
+
+@pytest.mark.asyncio
+async def test_create_messages(cosmos_client):
+    cosmos_client.container_client.upsert_item = AsyncMock(
+        side_effect=lambda message: message
+    )
+    cosmos_client.container_client.patch_item = AsyncMock(return_value={"id": "conv_1"})
+    response = await cosmos_client.create_messages(
+        "conv_1",
+        "user_1",
+        [
+            {
+                "id": "msg_1",
+                "role": "tool",
+                "content": "citations",
+                "createdAt": "2024-01-01T00:00:00",
+            },
+            {
+                "id": "msg_2",
+                "role": "assistant",
+                "content": "answer",
+                "createdAt": "2024-01-01T00:00:01",
+            },
+        ],
+    )
+    assert [message["id"] for message in response] == ["msg_1", "msg_2"]
+    # the messages keep the createdAt they were queued with
+    assert [message["createdAt"] for message in response] == [
+        "2024-01-01T00:00:00",
+        "2024-01-01T00:00:01",
+    ]
+    # the conversation is touched once, for the last message
+    cosmos_client.container_client.patch_item.assert_awaited_once()
+    operations = cosmos_client.container_client.patch_item.call_args.kwargs[
+        "patch_operations"
+    ]
+    assert operations[0]["value"] == response[-1]["createdAt"]
+
+    cosmos_client.container_client.patch_item = AsyncMock(
+        side_effect=exceptions.CosmosResourceNotFoundError
+    )
+    response = await cosmos_client.create_messages(
+        "conv_1",
+        "user_1",
+        [
+            {
+                "id": "msg_3",
+                "role": "assistant",
+                "content": "x",
+                "createdAt": "2024-01-01T00:00:02",
+            }
+        ],
+    )
+    assert response == "Conversation not found"
+
+
+@pytest.fixture
+def embedded_cosmos_client():
+    return CosmosConversationClient(
+        cosmosdb_endpoint="https://fake.endpoint",
+        credential="fake_credential",
+        database_name="test_db",
+        container_name="test_container",
+        embed_messages=True,
+        embedded_messages_max_count=2,
+    )
+
+
+def embedded_message(message_id):
+    return {"id": message_id, "type": "message", "content": message_id}
+
+
+@pytest.mark.asyncio
+async def test_embedded_message_is_one_patch(embedded_cosmos_client):
+    container_client = embedded_cosmos_client.container_client
+    container_client.upsert_item = AsyncMock()
+    container_client.patch_item = AsyncMock(
+        return_value={"id": "conv_1", "messages": [embedded_message("msg_1")]}
+    )
+    response = await embedded_cosmos_client.create_message(
+        "msg_1", "conv_1", "user_1", {"role": "user", "content": "Hello"}
+    )
+    assert response["id"] == "msg_1"
+    container_client.upsert_item.assert_not_awaited()
+    kwargs = container_client.patch_item.call_args.kwargs
+    assert kwargs["item"] == "conv_1"
+    assert kwargs["patch_operations"][0] == {
+        "op": "add",
+        "path": "/messages/-",
+        "value": response,
+    }
+    assert "ARRAY_LENGTH(c.messages) < 2" in kwargs["filter_predicate"]
+
+
+@pytest.mark.asyncio
+async def test_embedded_messages_spill_when_full(embedded_cosmos_client):
+    container_client = embedded_cosmos_client.container_client
+    # the append patch finds no room
+    container_client.patch_item = AsyncMock(
+        side_effect=exceptions.CosmosAccessConditionFailedError
+    )
+    container_client.read_item = AsyncMock(
+        return_value={
+            "id": "conv_1",
+            "type": "conversation",
+            "userId": "user_1",
+            "_etag": "etag_1",
+            "messages": [embedded_message("msg_1"), embedded_message("msg_2")],
+            "messagesSize": 0,
+            "messagesOverflow": False,
+        }
+    )
+    container_client.upsert_item = AsyncMock()
+    container_client.replace_item = AsyncMock(
+        side_effect=lambda **kwargs: kwargs["body"]
+    )
+
+    response = await embedded_cosmos_client.create_message(
+        "msg_3", "conv_1", "user_1", {"role": "user", "content": "Hello"}
+    )
+    assert response["id"] == "msg_3"
+    # the oldest message moves out to an item of its own
+    container_client.upsert_item.assert_awaited_once_with(embedded_message("msg_1"))
+    kwargs = container_client.replace_item.call_args.kwargs
+    assert [message["id"] for message in kwargs["body"]["messages"]] == [
+        "msg_2",
+        "msg_3",
+    ]
+    assert kwargs["body"]["messagesOverflow"] is True
+    assert kwargs["etag"] == "etag_1"
+    assert kwargs["match_condition"] == MatchConditions.IfNotModified
+
+
+@pytest.mark.asyncio
+async def test_embedded_message_retry_does_not_duplicate(embedded_cosmos_client):
+    container_client = embedded_cosmos_client.container_client
+    # the first attempt's patch went through, so the retry's condition fails
+    container_client.patch_item = AsyncMock(
+        side_effect=exceptions.CosmosAccessConditionFailedError
+    )
+    container_client.read_item = AsyncMock(
+        return_value={
+            "id": "conv_1",
+            "type": "conversation",
+            "userId": "user_1",
+            "_etag": "etag_1",
+            "messages": [embedded_message("msg_1")],
+            "messagesSize": 0,
+            "messagesOverflow": False,
+        }
+    )
+    container_client.upsert_item = AsyncMock()
+    container_client.replace_item = AsyncMock()
+
+    response = await embedded_cosmos_client.create_messages(
+        "conv_1",
+        "user_1",
+        [
+            {
+                "id": "msg_1",
+                "role": "user",
+                "content": "Hello",
+                "createdAt": "2024-01-01T00:00:00",
+            }
+        ],
+    )
+    assert [message["id"] for message in response] == ["msg_1"]
+    condition = container_client.patch_item.call_args.kwargs["filter_predicate"]
+    assert 'NOT ARRAY_CONTAINS(c.messages, {"id": "msg_1"}, true)' in condition
+    container_client.upsert_item.assert_not_awaited()
+    container_client.replace_item.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_embedded_messages_read(embedded_cosmos_client):
+    container_client = embedded_cosmos_client.container_client
+    container_client.query_items = MagicMock(
+        return_value=AsyncIterator(
+            [embedded_message("msg_1"), embedded_message("msg_2")]
+        )
+    )
+    conversation = {
+        "id": "conv_1",
+        "messages": [embedded_message("msg_2"), embedded_message("msg_3")],
+        "messagesOverflow": True,
+    }
+    messages = await embedded_cosmos_client.get_messages(
+        "user_1", "conv_1", conversation
+    )
+    # msg_2 was being moved out; it is returned once
+    assert [message["id"] for message in messages] == ["msg_1", "msg_2", "msg_3"]
+
+    # without overflow the conversation holds every message
+    container_client.query_items.reset_mock()
+    conversation["messagesOverflow"] = False
+    messages = await embedded_cosmos_client.get_messages(
+        "user_1", "conv_1", conversation
+    )
+    assert [message["id"] for message in messages] == ["msg_2", "msg_3"]
+    container_client.query_items.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_embedded_message_feedback(embedded_cosmos_client):
+    container_client = embedded_cosmos_client.container_client
+    container_client.query_items = MagicMock(
+        return_value=AsyncIterator(
+            [{"id": "conv_1", "_etag": "etag_1", "messageIds": ["msg_1", "msg_2"]}]
+        )
+    )
+
+    async def patch_item(**kwargs):
+        if "'message'" in kwargs["filter_predicate"]:
+            raise exceptions.CosmosResourceNotFoundError
+        return {
+            "id": "conv_1",
+            "messages": [
+                embedded_message("msg_1"),
+                dict(embedded_message("msg_2"), feedback="positive"),
+            ],
+        }
+
+    container_client.patch_item = AsyncMock(side_effect=patch_item)
+    response = await embedded_cosmos_client.update_message_feedback(
+        "user_1", "msg_2", "positive"
+    )
+    assert response["feedback"] == "positive"
+    kwargs = container_client.patch_item.call_args.kwargs
+    assert kwargs["patch_operations"] == [
+        {"op": "set", "path": "/messages/1/feedback", "value": "positive"}
+    ]
+    assert kwargs["etag"] == "etag_1"
 
 
 @pytest.mark.asyncio
 async def test_create_message(cosmos_client):
     cosmos_client.container_client.upsert_item = AsyncMock(return_value={"id": "msg_1"})
-    cosmos_client.get_conversation = AsyncMock(return_value={"id": "conv_1"})
-    cosmos_client.upsert_conversation = AsyncMock()
+    cosmos_client.container_client.patch_item = AsyncMock(return_value={"id": "conv_1"})
     response = await cosmos_client.create_message(
         "msg_1", "conv_1", "user_1", {"role": "user", "content": "Hello"}
     )
     assert response["id"] == "msg_1"
+    # the conversation is touched with a single patch, not read and upserted
+    message = cosmos_client.container_client.upsert_item.call_args[0][0]
+    cosmos_client.container_client.upsert_item.assert_awaited_once()
+    kwargs = cosmos_client.container_client.patch_item.call_args.kwargs
+    assert kwargs["item"] == "conv_1"
+    assert kwargs["patch_operations"] == [
+        {"op": "set", "path": "/updatedAt", "value": message["createdAt"]}
+    ]
 
 
 @pytest.mark.asyncio
-async def test_update_message_feedback(cosmos_client):
-    cosmos_client.container_client.read_item = AsyncMock(return_value={"id": "msg_1"})
+async def test_create_message_conversation_not_found(cosmos_client):
     cosmos_client.container_client.upsert_item = AsyncMock(return_value={"id": "msg_1"})
+    cosmos_client.container_client.patch_item = AsyncMock(
+        side_effect=exceptions.CosmosAccessConditionFailedError
+    )
+    response = await cosmos_client.create_message(
+        "msg_1", "conv_1", "user_1", {"role": "user", "content": "Hello"}
+    )
+    assert response == "Conversation not found"
+
+
+@pytest.mark.asyncio
+async def test_update_message_feedback(cosmos_client):
+    cosmos_client.container_client.patch_item = AsyncMock(return_value={"id": "msg_1"})
     response = await cosmos_client.update_message_feedback(
         "user_1", "msg_1", "positive"
     )
     assert response["id"] == "msg_1"
+    kwargs = cosmos_client.container_client.patch_item.call_args.kwargs
+    assert kwargs["patch_operations"] == [
+        {"op": "set", "path": "/feedback", "value": "positive"}
+    ]
+    assert kwargs["filter_predicate"] == "from c where c.type = 'message'"
+
+
+@pytest.mark.asyncio
+async def test_update_message_feedback_not_found(cosmos_client):
+    cosmos_client.container_client.patch_item = AsyncMock(
+        side_effect=exceptions.CosmosResourceNotFoundError
+    )
+    response = await cosmos_client.update_message_feedback(
+        "user_1", "msg_1", "positive"
+    )
+    assert response is False
 
 
 @pytest.mark.asyncio
@@ -182,3 +1289,7 @@ async def test_get_messages(cosmos_client):
     )
     response = await cosmos_client.get_messages("user_1", "conv_1")
     assert len(response) == 2
+    assert (
+        cosmos_client.container_client.query_items.call_args.kwargs["partition_key"]
+        == "user_1"
+    )
@@ -0,0 +1,151 @@
+import pytest
+
+from backend.history.localstore import (MemoryConversationStore,
+                                        SqliteConversationStore)
+from backend.history.store import PreconditionFailedError
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        yield MemoryConversationStore(enable_message_feedback=True)
+    else:
+        store = SqliteConversationStore(
+            str(tmp_path / "history.db"), enable_message_feedback=True
+        )
+        yield store
+        store.connection.close()
+
+
+@pytest.mark.asyncio
+async def test_ensure(store):
+    success, _ = await store.ensure()
+    assert success
+
+
+@pytest.mark.asyncio
+async def test_conversation_lifecycle(store):
+    conversation = await store.create_conversation("user_1", title="First")
+    conversation_id = conversation["id"]
+
+    fetched = await store.get_conversation("user_1", conversation_id)
+    assert fetched == conversation
+    assert await store.get_conversation("user_2", conversation_id) is None
+
+    renamed = await store.update_conversation_title(
+        "user_1", conversation_id, "Renamed", etag=conversation["_etag"]
+    )
+    assert renamed["title"] == "Renamed"
+    assert renamed["_etag"] != conversation["_etag"]
+    with pytest.raises(PreconditionFailedError):
+        await store.update_conversation_title(
+            "user_1", conversation_id, "Stale", etag=conversation["_etag"]
+        )
+    assert await store.update_conversation_title("user_1", "missing", "x") is None
+    assert (
+        await store.update_conversation_title(
+            "user_1", conversation_id, "Generated", expected_title="First"
+        )
+        is None
+    )
+    assert (await store.get_conversation("user_1", conversation_id))["title"] == (
+        "Renamed"
+    )
+
+    await store.delete_conversation("user_1", conversation_id)
+    assert await store.get_conversation("user_1", conversation_id) is None
+
+
+@pytest.mark.asyncio
+async def test_messages(store):
+    conversation = await store.create_conversation("user_1")
+    conversation_id = conversation["id"]
+
+    for index, role in enumerate(["user", "assistant"]):
+        message = await store.create_message(
+            f"msg_{index}",
+            conversation_id,
+            "user_1",
+            {"role": role, "content": f"content {index}"},
+        )
+        assert message["feedback"] == ""
+    assert (
+        await store.create_message(
+            "msg_x", "missing", "user_1", {"role": "user", "content": "x"}
+        )
+        == "Conversation not found"
+    )
+
+    messages = await store.get_messages("user_1", conversation_id)
+    assert [message["id"] for message in messages] == ["msg_0", "msg_1"]
+    touched = await store.get_conversation("user_1", conversation_id)
+    assert touched["updatedAt"] == messages[-1]["createdAt"]
+
+    updated = await store.update_message_feedback("user_1", "msg_1", "positive")
+    assert updated["feedback"] == "positive"
+    assert await store.update_message_feedback("user_1", conversation_id, "x") is False
+
+    await store.delete_messages(conversation_id, "user_1")
+    assert await store.get_messages("user_1", conversation_id) == []
+
+
+@pytest.mark.asyncio
+async def test_list_conversations(store):
+    for title in ["a", "b", "c"]:
+        conversation = await store.create_conversation("user_1", title=title)
+        await store.create_message(
+            f"msg_{title}",
+            conversation["id"],
+            "user_1",
+            {"role": "user", "content": title},
+        )
+    await store.create_conversation("user_2", title="other")
+
+    conversations = await store.get_conversations("user_1", limit=2, offset="1")
+    assert [c["title"] for c in conversations] == ["b", "a"]
+    assert set(conversations[0]) == {"id", "title", "createdAt", "updatedAt"}
+
+    titles = []
+    continuation_token = None
+    while True:
+        page, continuation_token = await store.get_conversations_page(
+            "user_1", 2, continuation_token
+        )
+        titles += [c["title"] for c in page]
+        if not continuation_token:
+            break
+    assert titles == ["c", "b", "a"]
+
+    with pytest.raises(ValueError):
+        await store.get_conversations_page("user_1", 2, "not a token")
+
+
+@pytest.mark.asyncio
+async def test_conversation_ids_survive_deletes(store):
+    for _ in range(5):
+        await store.create_conversation("user_1")
+
+    # delete each page before asking for the next, as delete_all does
+    deleted = 0
+    continuation_token = None
+    while True:
+        conversation_ids, continuation_token = await store.get_conversation_ids(
+            "user_1", 2, continuation_token
+        )
+        for conversation_id in conversation_ids:
+            await store.delete_conversation("user_1", conversation_id)
+            deleted += 1
+        if not continuation_token:
+            break
+    assert deleted == 5
+
+
+@pytest.mark.asyncio
+async def test_jobs(store):
+    job = await store.create_job("user_1", "delete_all")
+    await store.update_job("user_1", job["id"], status="succeeded", deleted=3)
+
+    fetched = await store.get_job("user_1", job["id"])
+    assert fetched["status"] == "succeeded"
+    assert fetched["deleted"] == 3
+    assert await store.get_job("user_2", job["id"]) is None
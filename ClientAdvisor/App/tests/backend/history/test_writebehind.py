@@ -0,0 +1,105 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from backend.history.writebehind import WriteBehindQueue
+
+
+def message(message_id):
+    return {"id": message_id, "role": "assistant", "content": message_id}
+
+
+@pytest.mark.asyncio
+async def test_writes_are_batched_per_conversation():
+    store = MagicMock()
+    store.create_messages = AsyncMock()
+    queue = WriteBehindQueue(lambda: store)
+
+    assert queue.enqueue("user_1", "conv_1", [message("msg_1")])
+    assert queue.enqueue("user_1", "conv_2", [message("msg_2")])
+    assert queue.enqueue("user_1", "conv_1", [message("msg_3")])
+    await queue.close(timeout=1)
+
+    assert store.create_messages.await_count == 2
+    store.create_messages.assert_any_await(
+        "conv_1", "user_1", [message("msg_1"), message("msg_3")]
+    )
+    store.create_messages.assert_any_await("conv_2", "user_1", [message("msg_2")])
+    assert queue.worker is None
+
+
+@pytest.mark.asyncio
+async def test_failed_writes_are_retried():
+    store = MagicMock()
+    store.create_messages = AsyncMock(side_effect=[Exception("throttled"), None])
+    queue = WriteBehindQueue(lambda: store, retry_delay=0)
+
+    queue.enqueue("user_1", "conv_1", [message("msg_1")])
+    await queue.close(timeout=1)
+
+    assert store.create_messages.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_writes_are_dropped_after_max_attempts():
+    store = MagicMock()
+    store.create_messages = AsyncMock(side_effect=Exception("down"))
+    queue = WriteBehindQueue(lambda: store, max_attempts=3, retry_delay=0)
+
+    queue.enqueue("user_1", "conv_1", [message("msg_1")])
+    queue.enqueue("user_1", "conv_2", [message("msg_2")])
+    await queue.close(timeout=1)
+
+    # each conversation is tried max_attempts times, then the queue moves on
+    assert store.create_messages.await_count == 6
+    assert queue.queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_writes_to_missing_conversations_are_dropped(caplog):
+    store = MagicMock()
+    store.create_messages = AsyncMock(return_value="Conversation not found")
+    queue = WriteBehindQueue(lambda: store, retry_delay=0)
+
+    queue.enqueue("user_1", "conv_1", [message("msg_1")])
+    await queue.close(timeout=1)
+
+    assert store.create_messages.await_count == 1
+    assert "missing conversation conv_1" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_full_queue_rejects_writes():
+    blocked = asyncio.Event()
+
+    async def create_messages(*args):
+        await blocked.wait()
+
+    store = MagicMock()
+    store.create_messages = AsyncMock(side_effect=create_messages)
+    queue = WriteBehindQueue(lambda: store, max_size=1)
+
+    assert queue.enqueue("user_1", "conv_1", [message("msg_1")])
+    await asyncio.sleep(0)
+    assert queue.enqueue("user_1", "conv_1", [message("msg_2")])
+    assert not queue.enqueue("user_1", "conv_1", [message("msg_3")])
+
+    blocked.set()
+    await queue.close(timeout=1)
+    assert store.create_messages.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_close_gives_up_after_timeout():
+    async def create_messages(*args):
+        await asyncio.sleep(10)
+
+    store = MagicMock()
+    store.create_messages = AsyncMock(side_effect=create_messages)
+    queue = WriteBehindQueue(lambda: store)
+
+    queue.enqueue("user_1", "conv_1", [message("msg_1")])
+    await queue.close(timeout=0.01)
+
+    assert queue.worker is None
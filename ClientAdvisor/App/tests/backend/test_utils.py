@@ -1,14 +1,22 @@
+import asyncio
 import dataclasses
+import gzip
 import json
-from unittest.mock import MagicMock, patch
+import os
+from unittest.mock import AsyncMock, MagicMock, patch
 
+import orjson
 import pytest
 
-from backend.utils import (JSONEncoder, convert_to_pf_format, fetchUserGroups,
+from backend.utils import (JSONEncoder, close_graph_client, coalesce_ndjson,
+                           convert_to_pf_format, fetchUserGroups,
                            format_as_ndjson, format_non_streaming_response,
                            format_pf_non_streaming_response,
                            format_stream_response, generateFilterString,
-                           parse_multi_columns)
+                           get_graph_client, getUserGroups, gzip_ndjson,
+                           json_dumps, json_loads, parse_multi_columns,
+                           stream_text_frame_formatter, user_groups_cache,
+                           user_groups_inflight)
 
 
 @dataclasses.dataclass
@@ -37,34 +45,137 @@ def test_parse_multi_columns(input_str, expected):
     assert parse_multi_columns(input_str) == expected
 
 
-@patch("app.requests.get")
-def test_fetch_user_groups(mock_get):
+@pytest.fixture(autouse=True)
+def clear_user_groups_cache():
+    user_groups_cache.clear()
+    user_groups_inflight.clear()
+    yield
+    user_groups_cache.clear()
+    user_groups_inflight.clear()
+
+
+@pytest.mark.asyncio
+@patch("backend.utils.httpx.AsyncClient.get")
+async def test_fetch_user_groups(mock_get):
     mock_response = MagicMock()
     mock_response.status_code = 200
     mock_response.json.return_value = {"value": [{"id": "group1"}]}
     mock_get.return_value = mock_response
 
-    user_groups = fetchUserGroups("fake_token")
+    user_groups = await fetchUserGroups("fake_token")
     assert user_groups == [{"id": "group1"}]
 
     # Test with nextLink
+    next_page = MagicMock()
+    next_page.status_code = 200
+    next_page.json.return_value = {"value": [{"id": "group2"}]}
     mock_response.json.return_value = {
         "value": [{"id": "group1"}],
         "@odata.nextLink": "next_link",
     }
-    mock_get.side_effect = [mock_response, mock_response]
-    user_groups = fetchUserGroups("fake_token")
-    assert user_groups == [{"id": "group1"}, {"id": "group1"}]
+    mock_get.side_effect = [mock_response, next_page]
+    user_groups = await fetchUserGroups("fake_token")
+    assert user_groups == [{"id": "group1"}, {"id": "group2"}]
+    assert mock_get.call_args.args[0] == "next_link"
+
+
+@pytest.mark.asyncio
+@patch("backend.utils.httpx.AsyncClient.get")
+async def test_fetch_user_groups_shares_client(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {"value": []}
+    mock_get.return_value = mock_response
+
+    await fetchUserGroups("token_1")
+    client = get_graph_client()
+    await fetchUserGroups("token_2")
+    assert get_graph_client() is client
+
+    await close_graph_client()
+    assert client.is_closed
+    assert get_graph_client() is not client
+    await close_graph_client()
+
 
+@pytest.mark.asyncio
+@patch("backend.utils.httpx.AsyncClient.get")
+async def test_fetch_user_groups_error(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 401
+    mock_get.return_value = mock_response
+
+    assert await fetchUserGroups("fake_token") is None
+
+
+@pytest.mark.asyncio
+@patch("backend.utils.fetchUserGroups", new_callable=AsyncMock)
+async def test_get_user_groups_cached(mock_fetch_user_groups):
+    mock_fetch_user_groups.return_value = [{"id": "group1"}]
+
+    assert await getUserGroups("fake_token") == [{"id": "group1"}]
+    assert await getUserGroups("fake_token") == [{"id": "group1"}]
+    mock_fetch_user_groups.assert_awaited_once_with("fake_token")
+
+
+@pytest.mark.asyncio
+@patch("backend.utils.fetchUserGroups", new_callable=AsyncMock)
+async def test_get_user_groups_failure_not_cached(mock_fetch_user_groups):
+    mock_fetch_user_groups.side_effect = [None, [{"id": "group1"}]]
 
+    assert await getUserGroups("fake_token") == []
+    assert await getUserGroups("fake_token") == [{"id": "group1"}]
+    assert mock_fetch_user_groups.await_count == 2
+
+
+@pytest.mark.asyncio
 @patch("backend.utils.fetchUserGroups")
+async def test_get_user_groups_single_flight(mock_fetch_user_groups):
+    release = asyncio.Event()
+
+    async def slow_fetch(userToken):
+        await release.wait()
+        return [{"id": "group1"}]
+
+    mock_fetch_user_groups.side_effect = slow_fetch
+    pending = [asyncio.ensure_future(getUserGroups("fake_token")) for _ in range(3)]
+    await asyncio.sleep(0)
+    release.set()
+
+    results = await asyncio.gather(*pending)
+    assert results == [[{"id": "group1"}]] * 3
+    mock_fetch_user_groups.assert_called_once_with("fake_token")
+
+
+@pytest.mark.asyncio
+@patch("backend.utils.getUserGroups", new_callable=AsyncMock)
 @patch("backend.utils.AZURE_SEARCH_PERMITTED_GROUPS_COLUMN", "your_column")
-def test_generate_filter_string(mock_fetch_user_groups):
-    mock_fetch_user_groups.return_value = [{"id": "group1"}, {"id": "group2"}]
-    filter_string = generateFilterString("fake_token")
+async def test_generate_filter_string(mock_get_user_groups):
+    mock_get_user_groups.return_value = [{"id": "group1"}, {"id": "group2"}]
+    filter_string = await generateFilterString("fake_token")
     assert filter_string == "your_column/any(g:search.in(g, 'group1, group2'))"
 
 
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_json_dumps(use_orjson):
+    @dataclasses.dataclass
+    class Citation:
+        title: str
+        url: str
+
+    obj = {"text": "naïve", "citations": [Citation("Doc", "http://example.com")]}
+    with patch("backend.utils.orjson", orjson if use_orjson else None):
+        result = json_dumps(obj)
+        assert json_loads(result) == {
+            "text": "naïve",
+            "citations": [{"title": "Doc", "url": "http://example.com"}],
+        }
+
+
+def test_json_dumps_falls_back_for_unsupported_values():
+    assert json.loads(json_dumps({"big": 2**70})) == {"big": 2**70}
+
+
 @pytest.mark.asyncio
 async def test_format_as_ndjson():
     async def async_gen():
@@ -72,9 +183,100 @@ async def test_format_as_ndjson():
 
     r = async_gen()
     result = [item async for item in format_as_ndjson(r)]
+    assert len(result) == 1
+    assert result[0].endswith("\n")
+    assert json.loads(result[0]) == {"event": "test"}
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_passes_frames_through():
+    async def async_gen():
+        yield '{"event": "test"}\n'
+
+    result = [item async for item in format_as_ndjson(async_gen())]
     assert result == ['{"event": "test"}\n']
 
 
+@pytest.mark.asyncio
+async def test_gzip_ndjson():
+    async def async_gen():
+        for index in range(1000):
+            yield {"id": index, "content": os.urandom(64).hex()}
+
+    chunks = [chunk async for chunk in gzip_ndjson(async_gen(), chunk_size=1024)]
+    assert len(chunks) > 1
+    lines = gzip.decompress(b"".join(chunks)).decode("utf-8").splitlines()
+    assert [json.loads(line)["id"] for line in lines] == list(range(1000))
+
+
+@pytest.mark.asyncio
+async def test_coalesce_ndjson_flushes_first_line_and_by_size():
+    async def async_gen():
+        for line in ["a\n", "bb\n", "cc\n", "dd\n", "e\n"]:
+            yield line
+
+    result = [chunk async for chunk in coalesce_ndjson(async_gen(), 6, 10)]
+    assert result == ["a\n", "bb\ncc\n", "dd\ne\n"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_ndjson_does_not_read_ahead_of_a_slow_consumer():
+    pulled = 0
+
+    async def async_gen():
+        nonlocal pulled
+        for index in range(10000):
+            pulled += 1
+            yield f"{index}\n"
+
+    chunks = coalesce_ndjson(async_gen(), 4096, 10, max_queued=8)
+    assert await chunks.__anext__() == "0\n"
+    await asyncio.sleep(0.01)
+    # the first line, the queued ones and the one waiting to be queued
+    assert pulled <= 10
+    await chunks.aclose()
+
+
+@pytest.mark.asyncio
+async def test_coalesce_ndjson_flushes_by_time():
+    async def async_gen():
+        yield "a\n"
+        yield "b\n"
+        yield "c\n"
+        await asyncio.sleep(0.2)
+        yield "d\n"
+
+    chunks = coalesce_ndjson(async_gen(), 1024, 0.01)
+    assert await chunks.__anext__() == "a\n"
+    # The pending lines go out once the time budget is spent, not at the next line
+    assert await asyncio.wait_for(chunks.__anext__(), 0.1) == "b\nc\n"
+    assert [chunk async for chunk in chunks] == ["d\n"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_ndjson_disabled():
+    async def async_gen():
+        yield "a\n"
+        yield "b\n"
+
+    result = [chunk async for chunk in coalesce_ndjson(async_gen(), 0, 0.03)]
+    assert result == ["a\n", "b\n"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_ndjson_error():
+    async def async_gen():
+        yield "a\n"
+        yield "b\n"
+        raise ValueError("Test error")
+
+    chunks = coalesce_ndjson(async_gen(), 1024, 10)
+    assert await chunks.__anext__() == "a\n"
+    assert await chunks.__anext__() == "b\n"
+    with pytest.raises(ValueError):
+        await chunks.__anext__()
+
+
 def test_format_non_streaming_response():
     # Create a mock chatCompletion object with the necessary attributes
     chatCompletion = MagicMock()
@@ -97,7 +299,9 @@ def test_format_non_streaming_response():
 
     # Assert the response structure
     assert response["id"] == "id"
-    assert response["choices"][0]["messages"][0]["content"] == '{"key": "value"}'
+    assert json.loads(response["choices"][0]["messages"][0]["content"]) == {
+        "key": "value"
+    }
     assert response["choices"][0]["messages"][1]["content"] == "content"
 
 
@@ -125,7 +329,34 @@ def test_format_stream_response():
 
     # Assert the response structure
     assert response["id"] == "id"
-    assert response["choices"][0]["messages"][0]["content"] == '{"key": "value"}'
+    assert json.loads(response["choices"][0]["messages"][0]["content"]) == {
+        "key": "value"
+    }
+
+
+def test_stream_text_frame_formatter():
+    history_metadata = {"conversation_id": "conv_1", "title": 'Zoë\'s "plan"'}
+    format_frame = stream_text_frame_formatter(
+        "id", "model", 123, history_metadata, "request_id"
+    )
+
+    chatCompletionChunk = MagicMock()
+    chatCompletionChunk.id = "id"
+    chatCompletionChunk.model = "model"
+    chatCompletionChunk.created = 123
+    chatCompletionChunk.object = "extensions.chat.completion.chunk"
+    choice = MagicMock()
+    choice.delta = MagicMock(spec=["role", "content"])
+    choice.delta.role = "assistant"
+    choice.delta.content = 'Line "one"\nnaïve'
+    chatCompletionChunk.choices = [choice]
+    expected = format_stream_response(
+        chatCompletionChunk, history_metadata, "request_id"
+    )
+
+    frame = format_frame('Line "one"\nnaïve')
+
+    assert frame == json_dumps(expected) + "\n"
 
 
 # Test format_pf_non_streaming_response with edge cases
@@ -1,10 +1,23 @@
+import asyncio
+import gzip
 import json
-from unittest.mock import AsyncMock, MagicMock, patch
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, MagicMock, call, patch
 
+import httpx
 import pytest
-
-from app import (create_app, delete_all_conversations, generate_title,
-                 init_cosmosdb_client, init_openai_client, stream_chat_request)
+from azure.cosmos import exceptions
+
+from app import (build_data_source_template, complete_chat_request, create_app,
+                 decode_cursor, delete_all_conversations,
+                 delete_all_conversations_job, encode_cursor, generate_title,
+                 get_configured_data_source, get_conversation,
+                 get_cosmosdb_client, get_history_writer, get_openai_client,
+                 init_cosmosdb_client, init_openai_client, provisional_title,
+                 redact_data_source, stream_chat_request,
+                 stream_history_export, update_generated_title)
+from backend.history.localstore import (MemoryConversationStore,
+                                        SqliteConversationStore)
 
 # Constants for testing
 INVALID_API_VERSION = "2022-01-01"
@@ -69,6 +82,82 @@ def test_init_openai_client(mock_async_openai, mock_token_provider):
     mock_async_openai.assert_called_once()
 
 
+@pytest.mark.asyncio
+@patch("app.init_cosmosdb_client", return_value=None)
+@patch("app.init_openai_client")
+async def test_shared_openai_client_lifecycle(mock_init_openai_client, _):
+    mock_openai_client = AsyncMock()
+    mock_init_openai_client.return_value = mock_openai_client
+
+    app = create_app()
+    async with app.test_app():
+        assert get_openai_client() is mock_openai_client
+        assert get_openai_client() is mock_openai_client
+
+    mock_init_openai_client.assert_called_once()
+    mock_openai_client.close.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+@patch("app.init_cosmosdb_client", return_value=None)
+@patch("app.init_openai_client")
+async def test_shared_openai_client_startup_failure(mock_init_openai_client, _):
+    mock_openai_client = AsyncMock()
+    mock_init_openai_client.side_effect = [
+        Exception("Not configured"),
+        mock_openai_client,
+    ]
+
+    app = create_app()
+    async with app.test_app():
+        assert get_openai_client() is mock_openai_client
+
+    mock_openai_client.close.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+@patch("app.init_openai_client")
+@patch("app.init_cosmosdb_client")
+async def test_shared_cosmosdb_client_lifecycle(
+    mock_init_cosmosdb_client, mock_init_openai_client
+):
+    mock_init_openai_client.return_value = AsyncMock()
+    mock_cosmos_client = AsyncMock()
+    mock_cosmos_client.ensure.return_value = (True, None)
+    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+
+    app = create_app()
+    async with app.test_app():
+        assert get_cosmosdb_client() is mock_cosmos_client
+        assert get_cosmosdb_client() is mock_cosmos_client
+
+    mock_init_cosmosdb_client.assert_called_once()
+    mock_cosmos_client.ensure.assert_awaited_once()
+    mock_cosmos_client.close.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+@patch("app.init_openai_client")
+@patch("app.init_cosmosdb_client")
+async def test_history_writer_drained_on_shutdown(
+    mock_init_cosmosdb_client, mock_init_openai_client
+):
+    mock_init_openai_client.return_value = AsyncMock()
+    mock_cosmos_client = AsyncMock()
+    mock_cosmos_client.ensure.return_value = (True, None)
+    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+
+    app = create_app()
+    async with app.test_app():
+        get_history_writer().enqueue(
+            "user_1", "conv_1", [{"id": "msg_1", "role": "assistant", "content": ""}]
+        )
+
+    # the queued write lands before the cosmos client is closed
+    mock_cosmos_client.create_messages.assert_awaited_once()
+    mock_cosmos_client.close.assert_awaited_once()
+
+
 @patch("app.CosmosConversationClient")
 def test_init_cosmosdb_client(mock_cosmos_client):
     mock_cosmos_client.return_value = MagicMock()
@@ -78,6 +167,218 @@ def test_init_cosmosdb_client(mock_cosmos_client):
     mock_cosmos_client.assert_called_once()
 
 
+@pytest.mark.parametrize(
+    "store, store_class",
+    [("memory", MemoryConversationStore), ("sqlite", SqliteConversationStore)],
+)
+def test_init_cosmosdb_client_local_store(store, store_class, tmp_path):
+    with patch("app.CHAT_HISTORY_STORE", store), patch(
+        "app.CHAT_HISTORY_SQLITE_PATH", str(tmp_path / "history.db")
+    ), patch("app.CosmosConversationClient") as mock_cosmos_client:
+        client = init_cosmosdb_client()
+
+    assert isinstance(client, store_class)
+    mock_cosmos_client.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("app.get_cosmosdb_client")
+async def test_history_routes_with_memory_store(mock_get_cosmosdb_client, client):
+    store = MemoryConversationStore()
+    mock_get_cosmosdb_client.return_value = store
+    conversation = await store.create_conversation(
+        "00000000-0000-0000-0000-000000000000"
+    )
+    conversation_id = conversation["id"]
+
+    response = await client.post(
+        "/history/rename",
+        json={"conversation_id": conversation_id, "title": "Renamed"},
+        headers={"If-Match": "stale"},
+    )
+    assert response.status_code == 412
+
+    response = await client.post(
+        "/history/rename",
+        json={"conversation_id": conversation_id, "title": "Renamed"},
+        headers={"If-Match": conversation["_etag"]},
+    )
+    assert response.status_code == 200
+
+    response = await client.get("/history/list?cursor=")
+    response_json = await response.get_json()
+    assert [c["title"] for c in response_json["conversations"]] == ["Renamed"]
+    assert response_json["next"] is None
+
+    response = await client.get("/history/list?cursor=bm90LWpzb24")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+@patch("app.get_cosmosdb_client")
+async def test_export_history(mock_get_cosmosdb_client, client):
+    store = MemoryConversationStore()
+    mock_get_cosmosdb_client.return_value = store
+    user_id = "00000000-0000-0000-0000-000000000000"
+    for title in ["first", "second"]:
+        conversation = await store.create_conversation(user_id, title=title)
+        await store.create_message(
+            f"msg_{title}",
+            conversation["id"],
+            user_id,
+            {"role": "user", "content": title},
+        )
+    await store.create_conversation("other_user", title="other")
+
+    response = await client.get("/history/export")
+    assert response.status_code == 200
+    assert response.mimetype == "application/gzip"
+    assert "attachment" in response.headers["Content-Disposition"]
+    data = gzip.decompress(await response.get_data())
+    lines = [json.loads(line) for line in data.decode("utf-8").splitlines()]
+    assert [
+        (
+            line["conversation"]["title"]
+            if "conversation" in line
+            else line["message"]["id"]
+        )
+        for line in lines
+    ] == ["second", "msg_second", "first", "msg_first"]
+    assert "_etag" not in lines[0]["conversation"]
+
+
+@pytest.mark.asyncio
+async def test_stream_history_export_reports_errors():
+    async def iter_conversations(user_id):
+        yield {"id": "conv_1", "_etag": "etag_1", "messages": []}
+        raise Exception("throttled")
+
+    async def iter_messages(user_id, conversation_id, conversation):
+        yield {"id": "msg_1"}
+
+    cosmos_client = MagicMock()
+    cosmos_client.iter_conversations = MagicMock(side_effect=iter_conversations)
+    cosmos_client.iter_messages = MagicMock(side_effect=iter_messages)
+
+    lines = [line async for line in stream_history_export(cosmos_client, "user_1")]
+    assert lines == [
+        {"conversation": {"id": "conv_1"}},
+        {"message": {"id": "msg_1"}},
+        {"error": "throttled"},
+    ]
+
+
+def test_build_data_source_template():
+    with patch.multiple(
+        "app",
+        DATASOURCE_TYPE="AzureCognitiveSearch",
+        AZURE_SEARCH_SERVICE="search",
+        AZURE_SEARCH_INDEX="index",
+        AZURE_SEARCH_KEY="search_key",
+        AZURE_SEARCH_CONTENT_COLUMNS="content|summary",
+        AZURE_SEARCH_TOP_K="7",
+    ):
+        template = build_data_source_template()
+
+    assert template["type"] == "azure_search"
+    assert template["parameters"]["fields_mapping"]["content_fields"] == [
+        "content",
+        "summary",
+    ]
+    assert template["parameters"]["top_n_documents"] == 7
+    assert template["parameters"]["filter"] is None
+
+
+def test_build_data_source_template_invalid_config():
+    with patch.multiple(
+        "app",
+        DATASOURCE_TYPE="Pinecone",
+        PINECONE_TOP_K="not_a_number",
+    ):
+        with pytest.raises(ValueError):
+            build_data_source_template()
+
+
+@pytest.mark.asyncio
+async def test_get_configured_data_source_reuses_template():
+    template = {"type": "azure_search", "parameters": {"filter": None}}
+    with patch.multiple(
+        "app",
+        DATA_SOURCE_TEMPLATE=template,
+        DATASOURCE_TYPE="AzureCognitiveSearch",
+        AZURE_SEARCH_PERMITTED_GROUPS_COLUMN=None,
+    ):
+        assert await get_configured_data_source() is template
+
+
+@pytest.mark.asyncio
+@patch("app.generateFilterString", new_callable=AsyncMock)
+async def test_get_configured_data_source_overlays_filter(mock_generate_filter):
+    mock_generate_filter.return_value = "group_filter"
+    template = {
+        "type": "azure_search",
+        "parameters": {"index_name": "index", "filter": None},
+    }
+    with patch.multiple(
+        "app",
+        DATA_SOURCE_TEMPLATE=template,
+        DATASOURCE_TYPE="AzureCognitiveSearch",
+        AZURE_SEARCH_PERMITTED_GROUPS_COLUMN="groups",
+    ):
+        async with create_app().test_request_context(
+            "/conversation",
+            method="POST",
+            headers={"X-MS-TOKEN-AAD-ACCESS-TOKEN": "user_token"},
+        ):
+            data_source = await get_configured_data_source()
+
+    assert data_source["parameters"] == {
+        "index_name": "index",
+        "filter": "group_filter",
+    }
+    assert template["parameters"]["filter"] is None
+    mock_generate_filter.assert_awaited_once_with("user_token")
+
+
+def test_redact_data_source():
+    data_source = {
+        "type": "elasticsearch",
+        "parameters": {
+            "authentication": {"type": "encoded_api_key", "encoded_api_key": "secret"},
+            "embedding_dependency": {
+                "type": "endpoint",
+                "authentication": {"type": "api_key", "key": "embedding_secret"},
+            },
+        },
+    }
+
+    redacted = redact_data_source(data_source)
+
+    assert redacted["parameters"]["authentication"]["encoded_api_key"] == "*****"
+    assert (
+        redacted["parameters"]["embedding_dependency"]["authentication"]["key"]
+        == "*****"
+    )
+    assert data_source["parameters"]["authentication"]["encoded_api_key"] == "secret"
+
+
+@pytest.mark.asyncio
+async def test_json_provider():
+    app = create_app()
+    payload = {
+        "created": datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+        "title": "naïve",
+    }
+
+    async with app.app_context():
+        body = app.json.dumps(payload)
+
+    assert app.json.loads(body) == {
+        "created": "Tue, 02 Jan 2024 03:04:05 GMT",
+        "title": "naïve",
+    }
+
+
 @pytest.mark.asyncio
 @patch("app.render_template")
 async def test_index(mock_render_template, client):
@@ -117,25 +418,25 @@ async def test_ensure_cosmos_not_configured(client):
 
 
 @pytest.mark.asyncio
-@patch("app.init_cosmosdb_client")
-async def test_ensure_cosmos_success(mock_init_cosmosdb_client, client):
+@patch("app.get_cosmosdb_client")
+async def test_ensure_cosmos_success(mock_get_cosmosdb_client, client):
     mock_client = AsyncMock()
     mock_client.ensure.return_value = (True, None)
-    mock_init_cosmosdb_client.return_value = mock_client
+    mock_get_cosmosdb_client.return_value = mock_client
 
     response = await client.get("/history/ensure")
     res_text = await response.get_data(as_text=True)
     assert response.status_code == 200
     assert json.loads(res_text) == {"message": "CosmosDB is configured and working"}
-    mock_client.cosmosdb_client.close.assert_called_once()
+    mock_client.close.assert_not_called()
 
 
 @pytest.mark.asyncio
-@patch("app.init_cosmosdb_client")
-async def test_ensure_cosmos_failure(mock_init_cosmosdb_client, client):
+@patch("app.get_cosmosdb_client")
+async def test_ensure_cosmos_failure(mock_get_cosmosdb_client, client):
     mock_client = AsyncMock()
     mock_client.ensure.return_value = (False, "Some error")
-    mock_init_cosmosdb_client.return_value = mock_client
+    mock_get_cosmosdb_client.return_value = mock_client
 
     response = await client.get("/history/ensure")
     res_text = await response.get_data(as_text=True)
@@ -144,9 +445,9 @@ async def test_ensure_cosmos_failure(mock_init_cosmosdb_client, client):
 
 
 @pytest.mark.asyncio
-@patch("app.init_cosmosdb_client")
-async def test_ensure_cosmos_exception(mock_init_cosmosdb_client, client):
-    mock_init_cosmosdb_client.side_effect = Exception("Invalid credentials")
+@patch("app.get_cosmosdb_client")
+async def test_ensure_cosmos_exception(mock_get_cosmosdb_client, client):
+    mock_get_cosmosdb_client.side_effect = Exception("Invalid credentials")
 
     response = await client.get("/history/ensure")
     assert response.status_code == 401
@@ -155,12 +456,28 @@ async def test_ensure_cosmos_exception(mock_init_cosmosdb_client, client):
 
 
 @pytest.mark.asyncio
-@patch("app.init_cosmosdb_client")
-async def test_ensure_cosmos_invalid_db_name(mock_init_cosmosdb_client, client):
+@patch("app.get_cosmosdb_client")
+async def test_get_cache_stats(mock_get_cosmosdb_client, client):
+    mock_client = MagicMock()
+    mock_client.cache_stats.return_value = {"hits": 3, "misses": 1}
+    mock_get_cosmosdb_client.return_value = mock_client
+
+    response = await client.get("/history/cache_stats")
+    assert response.status_code == 200
+    assert await response.get_json() == {"enabled": True, "hits": 3, "misses": 1}
+
+    mock_client.cache_stats.return_value = None
+    response = await client.get("/history/cache_stats")
+    assert await response.get_json() == {"enabled": False}
+
+
+@pytest.mark.asyncio
+@patch("app.get_cosmosdb_client")
+async def test_ensure_cosmos_invalid_db_name(mock_get_cosmosdb_client, client):
     with patch("app.AZURE_COSMOSDB_DATABASE", "your_db_name"), patch(
         "app.AZURE_COSMOSDB_ACCOUNT", "your_account"
     ):
-        mock_init_cosmosdb_client.side_effect = Exception(
+        mock_get_cosmosdb_client.side_effect = Exception(
             "Invalid CosmosDB database name"
         )
 
@@ -173,10 +490,10 @@ async def test_ensure_cosmos_invalid_db_name(mock_init_cosmosdb_client, client):
 
 
 @pytest.mark.asyncio
-@patch("app.init_cosmosdb_client")
-async def test_ensure_cosmos_invalid_container_name(mock_init_cosmosdb_client, client):
+@patch("app.get_cosmosdb_client")
+async def test_ensure_cosmos_invalid_container_name(mock_get_cosmosdb_client, client):
     with patch("app.AZURE_COSMOSDB_CONVERSATIONS_CONTAINER", "your_container_name"):
-        mock_init_cosmosdb_client.side_effect = Exception(
+        mock_get_cosmosdb_client.side_effect = Exception(
             "Invalid CosmosDB container name"
         )
 
@@ -189,9 +506,9 @@ async def test_ensure_cosmos_invalid_container_name(mock_init_cosmosdb_client, c
 
 
 @pytest.mark.asyncio
-@patch("app.init_cosmosdb_client")
-async def test_ensure_cosmos_generic_exception(mock_init_cosmosdb_client, client):
-    mock_init_cosmosdb_client.side_effect = Exception("Some other error")
+@patch("app.get_cosmosdb_client")
+async def test_ensure_cosmos_generic_exception(mock_get_cosmosdb_client, client):
+    mock_get_cosmosdb_client.side_effect = Exception("Some other error")
 
     response = await client.get("/history/ensure")
     assert response.status_code == 500
@@ -277,9 +594,9 @@ def mock_request_headers():
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_clear_messages_success(
-    mock_init_cosmosdb_client,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     mock_request_headers,
     client,
@@ -290,7 +607,7 @@ async def test_clear_messages_success(
     # Mocking CosmosDB client
     mock_cosmos_client = MagicMock()
     mock_cosmos_client.delete_messages = AsyncMock(return_value=None)
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     async with create_app().test_request_context(
         "/history/clear", method="POST", headers=mock_request_headers
@@ -307,9 +624,9 @@ async def test_clear_messages_success(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_clear_messages_missing_conversation_id(
-    mock_init_cosmosdb_client,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     mock_request_headers,
     client,
@@ -326,10 +643,10 @@ async def test_clear_messages_missing_conversation_id(
 
 
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 @pytest.mark.asyncio
 async def test_clear_messages_cosmos_not_configured(
-    mock_init_cosmosdb_client,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     mock_request_headers,
     client,
@@ -338,7 +655,7 @@ async def test_clear_messages_cosmos_not_configured(
     mock_get_authenticated_user_details.return_value = {"user_principal_id": "user123"}
 
     # Mocking CosmosDB client to return None
-    mock_init_cosmosdb_client.return_value = None
+    mock_get_cosmosdb_client.return_value = None
 
     async with create_app().test_request_context(
         "/history/clear", method="POST", headers=mock_request_headers
@@ -352,10 +669,10 @@ async def test_clear_messages_cosmos_not_configured(
 
 
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 @pytest.mark.asyncio
 async def test_clear_messages_exception(
-    mock_init_cosmosdb_client,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     mock_request_headers,
     client,
@@ -366,7 +683,7 @@ async def test_clear_messages_exception(
     # Mocking CosmosDB client to raise an exception
     mock_cosmos_client = MagicMock()
     mock_cosmos_client.delete_messages = AsyncMock(side_effect=Exception("Some error"))
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     async with create_app().test_request_context(
         "/history/clear", method="POST", headers=mock_request_headers
@@ -383,9 +700,13 @@ async def test_clear_messages_exception(
 def mock_cosmos_conversation_client():
     client = MagicMock()
     client.get_conversations = AsyncMock()
+    client.get_conversation_ids = AsyncMock()
     client.delete_messages = AsyncMock()
     client.delete_conversation = AsyncMock()
-    client.cosmosdb_client.close = AsyncMock()
+    client.create_job = AsyncMock()
+    client.update_job = AsyncMock()
+    client.get_job = AsyncMock()
+    client.close = AsyncMock()
     return client
 
 
@@ -395,63 +716,66 @@ def mock_authenticated_user():
 
 
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
+@patch("app.delete_all_conversations_job")
 @pytest.mark.asyncio
 async def test_delete_all_conversations_success(
-    mock_init_cosmosdb_client,
+    mock_delete_all_conversations_job,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     mock_request_headers,
     mock_authenticated_user,
     mock_cosmos_conversation_client,
 ):
     mock_get_authenticated_user_details.return_value = mock_authenticated_user
-    mock_init_cosmosdb_client.return_value = mock_cosmos_conversation_client
-    mock_cosmos_conversation_client.get_conversations.return_value = [
-        {"id": "conv1"},
-        {"id": "conv2"},
-    ]
+    mock_get_cosmosdb_client.return_value = mock_cosmos_conversation_client
+    mock_cosmos_conversation_client.get_conversation_ids.return_value = (
+        ["conv1"],
+        "token",
+    )
+    mock_cosmos_conversation_client.create_job.return_value = {
+        "id": "job1",
+        "status": "running",
+    }
 
-    async with create_app().test_request_context(
+    app = create_app()
+    async with app.test_request_context(
         "/history/delete_all", method="DELETE", headers=mock_request_headers
     ):
         response, status_code = await delete_all_conversations()
         response_json = await response.get_json()
+    await asyncio.gather(*app.background_tasks)
 
-    assert status_code == 200
+    assert status_code == 202
     assert response_json == {
-        "message": "Successfully deleted conversation and messages for user test_user_id"
+        "message": "Deleting conversations and messages for user test_user_id",
+        "job_id": "job1",
+        "status": "running",
     }
-    mock_cosmos_conversation_client.get_conversations.assert_called_once_with(
-        "test_user_id", offset=0, limit=None
-    )
-    mock_cosmos_conversation_client.delete_messages.assert_any_await(
-        "conv1", "test_user_id"
-    )
-    mock_cosmos_conversation_client.delete_messages.assert_any_await(
-        "conv2", "test_user_id"
-    )
-    mock_cosmos_conversation_client.delete_conversation.assert_any_await(
-        "test_user_id", "conv1"
+    assert response.headers["Location"] == "/history/delete_all/job1"
+    mock_cosmos_conversation_client.create_job.assert_awaited_once_with(
+        "test_user_id", "delete_all"
     )
-    mock_cosmos_conversation_client.delete_conversation.assert_any_await(
-        "test_user_id", "conv2"
-    )
-    mock_cosmos_conversation_client.cosmosdb_client.close.assert_awaited_once()
+    mock_delete_all_conversations_job.assert_awaited_once_with("test_user_id", "job1")
+    # nothing is deleted while the request is open
+    mock_cosmos_conversation_client.delete_messages.assert_not_called()
+    mock_cosmos_conversation_client.delete_conversation.assert_not_called()
+    mock_cosmos_conversation_client.close.assert_not_called()
 
 
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 @pytest.mark.asyncio
 async def test_delete_all_conversations_no_conversations(
-    mock_init_cosmosdb_client,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     mock_request_headers,
     mock_authenticated_user,
     mock_cosmos_conversation_client,
 ):
     mock_get_authenticated_user_details.return_value = mock_authenticated_user
-    mock_init_cosmosdb_client.return_value = mock_cosmos_conversation_client
-    mock_cosmos_conversation_client.get_conversations.return_value = []
+    mock_get_cosmosdb_client.return_value = mock_cosmos_conversation_client
+    mock_cosmos_conversation_client.get_conversation_ids.return_value = ([], None)
 
     async with create_app().test_request_context(
         "/history/delete_all", method="DELETE", headers=mock_request_headers
@@ -461,24 +785,162 @@ async def test_delete_all_conversations_no_conversations(
 
     assert status_code == 404
     assert response_json == {"error": "No conversations for test_user_id were found"}
-    mock_cosmos_conversation_client.get_conversations.assert_called_once_with(
-        "test_user_id", offset=0, limit=None
-    )
+    mock_cosmos_conversation_client.create_job.assert_not_called()
     mock_cosmos_conversation_client.delete_messages.assert_not_called()
     mock_cosmos_conversation_client.delete_conversation.assert_not_called()
 
 
+@patch("app.get_cosmosdb_client")
+@pytest.mark.asyncio
+async def test_delete_all_conversations_job(
+    mock_get_cosmosdb_client, mock_cosmos_conversation_client
+):
+    mock_get_cosmosdb_client.return_value = mock_cosmos_conversation_client
+    mock_cosmos_conversation_client.get_conversation_ids.side_effect = [
+        (["conv1", "conv2"], "token"),
+        (["conv3"], None),
+    ]
+
+    with patch("app.DELETE_ALL_PAGE_SIZE", 2):
+        await delete_all_conversations_job("test_user_id", "job1")
+
+    assert mock_cosmos_conversation_client.get_conversation_ids.await_args_list == [
+        call("test_user_id", 2, None),
+        call("test_user_id", 2, "token"),
+    ]
+    for conversation_id in ["conv1", "conv2", "conv3"]:
+        mock_cosmos_conversation_client.delete_messages.assert_any_await(
+            conversation_id, "test_user_id"
+        )
+        mock_cosmos_conversation_client.delete_conversation.assert_any_await(
+            "test_user_id", conversation_id
+        )
+    assert mock_cosmos_conversation_client.update_job.await_args_list == [
+        call("test_user_id", "job1", deleted=2, failed=0),
+        call("test_user_id", "job1", deleted=3, failed=0),
+        call("test_user_id", "job1", status="succeeded"),
+    ]
+
+
+@patch("app.get_cosmosdb_client")
+@pytest.mark.asyncio
+async def test_delete_all_conversations_job_partial_failure(
+    mock_get_cosmosdb_client, mock_cosmos_conversation_client
+):
+    mock_get_cosmosdb_client.return_value = mock_cosmos_conversation_client
+    mock_cosmos_conversation_client.get_conversation_ids.return_value = (
+        ["conv1", "conv2"],
+        None,
+    )
+
+    async def delete_messages(conversation_id, user_id):
+        if conversation_id == "conv1":
+            raise Exception("Some error")
+
+    mock_cosmos_conversation_client.delete_messages.side_effect = delete_messages
+
+    await delete_all_conversations_job("test_user_id", "job1")
+
+    # a conversation whose messages could not be deleted is kept
+    mock_cosmos_conversation_client.delete_conversation.assert_awaited_once_with(
+        "test_user_id", "conv2"
+    )
+    assert mock_cosmos_conversation_client.update_job.await_args_list == [
+        call("test_user_id", "job1", deleted=1, failed=1),
+        call("test_user_id", "job1", status="failed"),
+    ]
+
+
+@patch("app.get_cosmosdb_client")
+@pytest.mark.asyncio
+async def test_delete_all_conversations_job_error(
+    mock_get_cosmosdb_client, mock_cosmos_conversation_client
+):
+    mock_get_cosmosdb_client.return_value = mock_cosmos_conversation_client
+    mock_cosmos_conversation_client.get_conversation_ids.side_effect = Exception(
+        "Query failed"
+    )
+
+    await delete_all_conversations_job("test_user_id", "job1")
+
+    mock_cosmos_conversation_client.update_job.assert_awaited_once_with(
+        "test_user_id", "job1", status="failed", error="Query failed"
+    )
+
+
+@pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
+async def test_get_delete_all_status(
+    mock_get_cosmosdb_client,
+    mock_get_authenticated_user_details,
+    mock_authenticated_user,
+    mock_cosmos_conversation_client,
+    client,
+):
+    mock_get_authenticated_user_details.return_value = mock_authenticated_user
+    mock_get_cosmosdb_client.return_value = mock_cosmos_conversation_client
+    mock_cosmos_conversation_client.get_job.return_value = {
+        "id": "job1",
+        "type": "job",
+        "kind": "delete_all",
+        "userId": "test_user_id",
+        "status": "running",
+        "deleted": 200,
+        "failed": 0,
+        "createdAt": "2024-10-01T00:00:00",
+        "updatedAt": "2024-10-01T00:00:05",
+        "_etag": "etag",
+    }
+
+    response = await client.get("/history/delete_all/job1")
+
+    assert response.status_code == 200
+    assert await response.get_json() == {
+        "job_id": "job1",
+        "status": "running",
+        "deleted": 200,
+        "failed": 0,
+        "error": None,
+        "createdAt": "2024-10-01T00:00:00",
+        "updatedAt": "2024-10-01T00:00:05",
+    }
+    mock_cosmos_conversation_client.get_job.assert_awaited_once_with(
+        "test_user_id", "job1"
+    )
+
+
+@pytest.mark.asyncio
+@patch("app.get_authenticated_user_details")
+@patch("app.get_cosmosdb_client")
+async def test_get_delete_all_status_not_found(
+    mock_get_cosmosdb_client,
+    mock_get_authenticated_user_details,
+    mock_authenticated_user,
+    mock_cosmos_conversation_client,
+    client,
+):
+    mock_get_authenticated_user_details.return_value = mock_authenticated_user
+    mock_get_cosmosdb_client.return_value = mock_cosmos_conversation_client
+    mock_cosmos_conversation_client.get_job.return_value = None
+
+    response = await client.get("/history/delete_all/job1")
+
+    assert response.status_code == 404
+    assert await response.get_json() == {"error": "Job job1 was not found"}
+
+
+@patch("app.get_authenticated_user_details")
+@patch("app.get_cosmosdb_client")
 @pytest.mark.asyncio
 async def test_delete_all_conversations_cosmos_not_configured(
-    mock_init_cosmosdb_client,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     mock_request_headers,
     mock_authenticated_user,
 ):
     mock_get_authenticated_user_details.return_value = mock_authenticated_user
-    mock_init_cosmosdb_client.return_value = None
+    mock_get_cosmosdb_client.return_value = None
 
     async with create_app().test_request_context(
         "/history/delete_all", method="DELETE", headers=mock_request_headers
@@ -488,14 +950,14 @@ async def test_delete_all_conversations_cosmos_not_configured(
 
     assert status_code == 500
     assert response_json == {"error": "CosmosDB is not configured or not working"}
-    mock_init_cosmosdb_client.assert_called_once()
+    mock_get_cosmosdb_client.assert_called_once()
 
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_rename_conversation(
-    mock_init_cosmosdb_client,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     mock_request_headers,
     client,
@@ -506,13 +968,10 @@ async def test_rename_conversation(
 
     # Mocking CosmosDB client and its methods
     mock_cosmos_conversation_client = AsyncMock()
-    mock_cosmos_conversation_client.get_conversation = AsyncMock(
-        return_value={"id": "123", "title": "Old Title"}
-    )
-    mock_cosmos_conversation_client.upsert_conversation = AsyncMock(
+    mock_cosmos_conversation_client.update_conversation_title = AsyncMock(
         return_value={"id": "123", "title": "New Title"}
     )
-    mock_init_cosmosdb_client.return_value = mock_cosmos_conversation_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_conversation_client
 
     async with create_app().test_request_context(
         "/history/rename", method="POST", headers=mock_request_headers
@@ -527,13 +986,37 @@ async def test_rename_conversation(
     assert response_json == {"id": "123", "title": "New Title"}
 
     # Ensure the CosmosDB client methods were called correctly
-    mock_cosmos_conversation_client.get_conversation.assert_called_once_with(
-        "user_123", "123"
+    mock_cosmos_conversation_client.update_conversation_title.assert_called_once_with(
+        "user_123", "123", "New Title", etag=None
     )
-    mock_cosmos_conversation_client.upsert_conversation.assert_called_once_with(
-        {"id": "123", "title": "New Title"}
+    mock_cosmos_conversation_client.get_conversation.assert_not_called()
+    mock_cosmos_conversation_client.upsert_conversation.assert_not_called()
+    mock_cosmos_conversation_client.close.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("app.get_authenticated_user_details")
+@patch("app.get_cosmosdb_client")
+async def test_rename_conversation_etag_mismatch(
+    mock_get_cosmosdb_client, mock_get_authenticated_user_details, client
+):
+    mock_get_authenticated_user_details.return_value = {"user_principal_id": "user_123"}
+    mock_cosmos_conversation_client = AsyncMock()
+    mock_cosmos_conversation_client.update_conversation_title.side_effect = (
+        exceptions.CosmosAccessConditionFailedError()
+    )
+    mock_get_cosmosdb_client.return_value = mock_cosmos_conversation_client
+
+    response = await client.post(
+        "/history/rename",
+        json={"conversation_id": "123", "title": "New Title"},
+        headers={"If-Match": '"etag_1"'},
+    )
+
+    assert response.status_code == 412
+    mock_cosmos_conversation_client.update_conversation_title.assert_called_once_with(
+        "user_123", "123", "New Title", etag='"etag_1"'
     )
-    mock_cosmos_conversation_client.cosmosdb_client.close.assert_called_once()
 
 
 @pytest.mark.asyncio
@@ -553,9 +1036,9 @@ async def test_rename_conversation_missing_conversation_id(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_rename_conversation_missing_title(
-    mock_init_cosmosdb_client,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     mock_request_headers,
     client,
@@ -565,13 +1048,10 @@ async def test_rename_conversation_missing_title(
 
     # Mocking CosmosDB client and its methods
     mock_cosmos_client = MagicMock()
-    mock_cosmos_client.get_conversation = AsyncMock(
-        return_value={"id": "123", "title": "Old Title"}
-    )
-    mock_cosmos_client.upsert_conversation = AsyncMock(
+    mock_cosmos_client.update_conversation_title = AsyncMock(
         return_value={"id": "123", "title": "New Title"}
     )
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     async with create_app().test_request_context(
         "/history/rename", method="POST", headers=mock_request_headers
@@ -585,9 +1065,9 @@ async def test_rename_conversation_missing_title(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_rename_conversation_not_found(
-    mock_init_cosmosdb_client,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     mock_request_headers,
     client,
@@ -595,8 +1075,8 @@ async def test_rename_conversation_not_found(
     mock_get_authenticated_user_details.return_value = {"user_principal_id": "user123"}
 
     mock_cosmos_client = MagicMock()
-    mock_cosmos_client.get_conversation = AsyncMock(return_value=None)
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_cosmos_client.update_conversation_title = AsyncMock(return_value=None)
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     async with create_app().test_request_context(
         "/history/rename", method="POST", headers=mock_request_headers
@@ -614,9 +1094,9 @@ async def test_rename_conversation_not_found(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_get_conversation_success(
-    mock_init_cosmosdb_client,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     mock_request_headers,
     client,
@@ -635,7 +1115,7 @@ async def test_get_conversation_success(
             "createdAt": "2024-10-01T00:00:00Z",
         }
     ]
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     async with create_app().test_request_context(
         "/history/read", method="POST", headers=mock_request_headers
@@ -658,6 +1138,94 @@ async def test_get_conversation_success(
     }
 
 
+@pytest.mark.asyncio
+@patch("app.make_response", new_callable=AsyncMock)
+@patch("app.get_authenticated_user_details")
+@patch("app.get_cosmosdb_client")
+async def test_get_conversation_stream_follows_the_client(
+    mock_get_cosmosdb_client,
+    mock_get_authenticated_user_details,
+    mock_make_response,
+    client,
+):
+    mock_get_authenticated_user_details.return_value = {"user_principal_id": "user123"}
+    pulled = 0
+
+    async def iter_messages(user_id, conversation_id, conversation):
+        # messages come in as cosmos pages them in
+        nonlocal pulled
+        for index in range(10000):
+            pulled += 1
+            yield {
+                "id": f"msg{index}",
+                "role": "user",
+                "content": "Hello",
+                "createdAt": "2024-10-01T00:00:00Z",
+            }
+
+    mock_cosmos_client = AsyncMock()
+    mock_cosmos_client.get_conversation.return_value = {"id": "12345"}
+    mock_cosmos_client.iter_messages = MagicMock(side_effect=iter_messages)
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
+
+    async with create_app().test_request_context(
+        "/history/read",
+        method="POST",
+        json={"conversation_id": "12345", "stream": True},
+    ):
+        await get_conversation()
+    body = mock_make_response.await_args.args[0]
+
+    # a client that has read one chunk holds the messages back
+    assert json.loads(await body.__anext__()) == {"conversation_id": "12345"}
+    await asyncio.sleep(0.1)
+    assert pulled < 100
+    await body.aclose()
+
+
+@pytest.mark.asyncio
+@patch("app.get_authenticated_user_details")
+@patch("app.get_cosmosdb_client")
+async def test_get_conversation_stream(
+    mock_get_cosmosdb_client,
+    mock_get_authenticated_user_details,
+    mock_request_headers,
+    client,
+):
+    mock_get_authenticated_user_details.return_value = {"user_principal_id": "user123"}
+
+    async def iter_messages(user_id, conversation_id, conversation):
+        for index in range(2):
+            yield {
+                "id": f"msg{index}",
+                "role": "user",
+                "content": "Hello",
+                "createdAt": "2024-10-01T00:00:00Z",
+            }
+
+    mock_cosmos_client = AsyncMock()
+    mock_cosmos_client.get_conversation.return_value = {"id": "12345"}
+    mock_cosmos_client.iter_messages = MagicMock(side_effect=iter_messages)
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
+
+    response = await client.post(
+        "/history/read", json={"conversation_id": "12345", "stream": True}
+    )
+    res_text = await response.get_data(as_text=True)
+
+    assert response.status_code == 200
+    assert response.mimetype == "application/json-lines"
+    lines = [json.loads(line) for line in res_text.splitlines()]
+    assert lines[0] == {"conversation_id": "12345"}
+    assert [line["message"]["id"] for line in lines[1:]] == ["msg0", "msg1"]
+    assert lines[1]["message"]["feedback"] is None
+    # the conversation already read is passed on, saving embedded messages a read
+    mock_cosmos_client.iter_messages.assert_called_once_with(
+        "user123", "12345", {"id": "12345"}
+    )
+    mock_cosmos_client.get_messages.assert_not_called()
+
+
 @pytest.mark.asyncio
 async def test_get_conversation_missing_conversation_id(
     mock_request_headers,
@@ -675,9 +1243,9 @@ async def test_get_conversation_missing_conversation_id(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_get_conversation_not_found(
-    mock_init_cosmosdb_client,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     mock_request_headers,
     client,
@@ -686,7 +1254,7 @@ async def test_get_conversation_not_found(
 
     mock_cosmos_client = AsyncMock()
     mock_cosmos_client.get_conversation.return_value = None
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     async with create_app().test_request_context(
         "/history/read", method="POST", headers=mock_request_headers
@@ -701,15 +1269,15 @@ async def test_get_conversation_not_found(
 
 
 @pytest.mark.asyncio
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 @patch("app.get_authenticated_user_details")
 async def test_list_conversations_success(
-    mock_get_user_details, mock_init_cosmosdb_client, client
+    mock_get_user_details, mock_get_cosmosdb_client, client
 ):
     mock_get_user_details.return_value = {"user_principal_id": "test_user"}
     mock_cosmos_client = AsyncMock()
     mock_cosmos_client.get_conversations.return_value = [{"id": "1"}, {"id": "2"}]
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     response = await client.get("/history/list")
     assert response.status_code == 200
@@ -717,28 +1285,99 @@ async def test_list_conversations_success(
 
 
 @pytest.mark.asyncio
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
+@patch("app.get_authenticated_user_details")
+async def test_list_conversations_with_cursor(
+    mock_get_user_details, mock_get_cosmosdb_client, client
+):
+    mock_get_user_details.return_value = {"user_principal_id": "test_user"}
+    mock_cosmos_client = AsyncMock()
+    mock_cosmos_client.get_conversations_page.return_value = (
+        [{"id": "1"}, {"id": "2"}],
+        '{"token":"abc"}',
+    )
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
+
+    # an empty cursor asks for the first page
+    response = await client.get("/history/list?cursor=")
+    assert response.status_code == 200
+    response_json = await response.get_json()
+    assert response_json["conversations"] == [{"id": "1"}, {"id": "2"}]
+    assert response_json["next"] == encode_cursor('{"token":"abc"}')
+    mock_cosmos_client.get_conversations_page.assert_awaited_once_with(
+        "test_user", limit=25, continuation_token=None
+    )
+    mock_cosmos_client.get_conversations.assert_not_called()
+
+    # the cursor is handed back to cosmos as the continuation token
+    mock_cosmos_client.get_conversations_page.reset_mock()
+    mock_cosmos_client.get_conversations_page.return_value = ([{"id": "3"}], None)
+    response = await client.get(
+        "/history/list", query_string={"cursor": response_json["next"]}
+    )
+    assert await response.get_json() == {"conversations": [{"id": "3"}], "next": None}
+    mock_cosmos_client.get_conversations_page.assert_awaited_once_with(
+        "test_user", limit=25, continuation_token='{"token":"abc"}'
+    )
+
+
+@pytest.mark.asyncio
+@patch("app.get_cosmosdb_client")
+@patch("app.get_authenticated_user_details")
+async def test_list_conversations_invalid_cursor(
+    mock_get_user_details, mock_get_cosmosdb_client, client
+):
+    mock_get_user_details.return_value = {"user_principal_id": "test_user"}
+    mock_cosmos_client = AsyncMock()
+    mock_cosmos_client.get_conversations_page.side_effect = (
+        exceptions.CosmosHttpResponseError(status_code=400)
+    )
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
+
+    response = await client.get("/history/list?cursor=not*base64")
+    assert response.status_code == 400
+
+    response = await client.get(
+        "/history/list", query_string={"cursor": encode_cursor("garbage")}
+    )
+    assert response.status_code == 400
+    assert await response.get_json() == {"error": "cursor is invalid"}
+
+
+def test_cursor_round_trip():
+    token = '[{"compositeToken":"+RID:~abc==#RT:1#TRC:25","orderByItems":[]}]'
+    cursor = encode_cursor(token)
+    assert "+" not in cursor and "/" not in cursor
+    assert decode_cursor(cursor) == token
+    assert encode_cursor(None) is None
+    assert decode_cursor("") is None
+    with pytest.raises(ValueError):
+        decode_cursor("not*base64")
+
+
+@pytest.mark.asyncio
+@patch("app.get_cosmosdb_client")
 @patch("app.get_authenticated_user_details")
 async def test_list_conversations_no_cosmos_client(
-    mock_get_user_details, mock_init_cosmosdb_client, client
+    mock_get_user_details, mock_get_cosmosdb_client, client
 ):
     mock_get_user_details.return_value = {"user_principal_id": "test_user"}
-    mock_init_cosmosdb_client.return_value = None
+    mock_get_cosmosdb_client.return_value = None
 
     response = await client.get("/history/list")
     assert response.status_code == 500
 
 
 @pytest.mark.asyncio
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 @patch("app.get_authenticated_user_details")
 async def test_list_conversations_no_conversations(
-    mock_get_user_details, mock_init_cosmosdb_client, client
+    mock_get_user_details, mock_get_cosmosdb_client, client
 ):
     mock_get_user_details.return_value = {"user_principal_id": "test_user"}
     mock_cosmos_client = AsyncMock()
     mock_cosmos_client.get_conversations.return_value = None
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     response = await client.get("/history/list")
     assert response.status_code == 404
@@ -748,15 +1387,15 @@ async def test_list_conversations_no_conversations(
 
 
 @pytest.mark.asyncio
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 @patch("app.get_authenticated_user_details")
 async def test_list_conversations_invalid_response(
-    mock_get_user_details, mock_init_cosmosdb_client, client
+    mock_get_user_details, mock_get_cosmosdb_client, client
 ):
     mock_get_user_details.return_value = {"user_principal_id": "test_user"}
     mock_cosmos_client = AsyncMock()
     mock_cosmos_client.get_conversations.return_value = None
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     response = await client.get("/history/list")
     assert response.status_code == 404
@@ -767,9 +1406,9 @@ async def test_list_conversations_invalid_response(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_delete_conversation_success(
-    mock_init_cosmosdb_client,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     mock_request_headers,
     client,
@@ -781,8 +1420,8 @@ async def test_delete_conversation_success(
     mock_cosmos_client = MagicMock()
     mock_cosmos_client.delete_messages = AsyncMock()
     mock_cosmos_client.delete_conversation = AsyncMock()
-    mock_cosmos_client.cosmosdb_client.close = AsyncMock()
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_cosmos_client.close = AsyncMock()
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     async with create_app().test_request_context(
         "/history/delete", method="DELETE", headers=mock_request_headers
@@ -799,7 +1438,7 @@ async def test_delete_conversation_success(
     }
     mock_cosmos_client.delete_messages.assert_called_once_with("12345", "user123")
     mock_cosmos_client.delete_conversation.assert_called_once_with("user123", "12345")
-    mock_cosmos_client.cosmosdb_client.close.assert_called_once()
+    mock_cosmos_client.close.assert_not_called()
 
 
 @pytest.mark.asyncio
@@ -824,9 +1463,9 @@ async def test_delete_conversation_missing_conversation_id(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_delete_conversation_cosmos_not_configured(
-    mock_init_cosmosdb_client,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     mock_request_headers,
     client,
@@ -835,7 +1474,7 @@ async def test_delete_conversation_cosmos_not_configured(
     mock_get_authenticated_user_details.return_value = {"user_principal_id": "user123"}
 
     # Mocking CosmosDB client not being configured
-    mock_init_cosmosdb_client.return_value = None
+    mock_get_cosmosdb_client.return_value = None
 
     async with create_app().test_request_context(
         "/history/delete", method="DELETE", headers=mock_request_headers
@@ -851,9 +1490,9 @@ async def test_delete_conversation_cosmos_not_configured(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_delete_conversation_exception(
-    mock_init_cosmosdb_client,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     mock_request_headers,
     client,
@@ -866,7 +1505,7 @@ async def test_delete_conversation_exception(
     mock_cosmos_client.delete_messages = AsyncMock(
         side_effect=Exception("Test exception")
     )
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     async with create_app().test_request_context(
         "/history/delete", method="DELETE", headers=mock_request_headers
@@ -882,16 +1521,16 @@ async def test_delete_conversation_exception(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_update_message_success(
-    mock_init_cosmosdb_client, mock_get_authenticated_user_details, client
+    mock_get_cosmosdb_client, mock_get_authenticated_user_details, client
 ):
     mock_get_authenticated_user_details.return_value = {
         "user_principal_id": "test_user"
     }
     mock_cosmos_client = AsyncMock()
     mock_cosmos_client.update_message_feedback.return_value = True
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     response = await client.post(
         "/history/message_feedback",
@@ -903,13 +1542,40 @@ async def test_update_message_success(
         "message": "Successfully updated message with feedback positive",
         "message_id": "123",
     }
+    mock_cosmos_client.update_message_feedback.assert_awaited_once_with(
+        "test_user", "123", "positive", etag=None
+    )
 
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
+async def test_update_message_etag_mismatch(
+    mock_get_cosmosdb_client, mock_get_authenticated_user_details, client
+):
+    mock_get_authenticated_user_details.return_value = {
+        "user_principal_id": "test_user"
+    }
+    mock_cosmos_client = AsyncMock()
+    mock_cosmos_client.update_message_feedback.side_effect = (
+        exceptions.CosmosAccessConditionFailedError()
+    )
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
+
+    response = await client.post(
+        "/history/message_feedback",
+        json={"message_id": "123", "message_feedback": "positive"},
+        headers={"If-Match": '"etag_1"'},
+    )
+
+    assert response.status_code == 412
+
+
+@pytest.mark.asyncio
+@patch("app.get_authenticated_user_details")
+@patch("app.get_cosmosdb_client")
 async def test_update_message_missing_message_id(
-    mock_init_cosmosdb_client, mock_get_authenticated_user_details, client
+    mock_get_cosmosdb_client, mock_get_authenticated_user_details, client
 ):
     response = await client.post(
         "/history/message_feedback", json={"message_feedback": "positive"}
@@ -921,9 +1587,9 @@ async def test_update_message_missing_message_id(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_update_message_missing_message_feedback(
-    mock_init_cosmosdb_client, mock_get_authenticated_user_details, client
+    mock_get_cosmosdb_client, mock_get_authenticated_user_details, client
 ):
     response = await client.post(
         "/history/message_feedback", json={"message_id": "123"}
@@ -935,16 +1601,16 @@ async def test_update_message_missing_message_feedback(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_update_message_not_found(
-    mock_init_cosmosdb_client, mock_get_authenticated_user_details, client
+    mock_get_cosmosdb_client, mock_get_authenticated_user_details, client
 ):
     mock_get_authenticated_user_details.return_value = {
         "user_principal_id": "test_user"
     }
     mock_cosmos_client = AsyncMock()
     mock_cosmos_client.update_message_feedback.return_value = False
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     response = await client.post(
         "/history/message_feedback",
@@ -959,16 +1625,16 @@ async def test_update_message_not_found(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_update_message_exception(
-    mock_init_cosmosdb_client, mock_get_authenticated_user_details, client
+    mock_get_cosmosdb_client, mock_get_authenticated_user_details, client
 ):
     mock_get_authenticated_user_details.return_value = {
         "user_principal_id": "test_user"
     }
     mock_cosmos_client = AsyncMock()
     mock_cosmos_client.update_message_feedback.side_effect = Exception("Test exception")
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     response = await client.post(
         "/history/message_feedback",
@@ -981,9 +1647,9 @@ async def test_update_message_exception(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_update_conversation_success(
-    mock_init_cosmosdb_client, mock_get_authenticated_user_details, client
+    mock_get_cosmosdb_client, mock_get_authenticated_user_details, client
 ):
     mock_get_authenticated_user_details.return_value = {
         "user_principal_id": "test_user_id"
@@ -1001,7 +1667,7 @@ async def test_update_conversation_success(
     }
 
     mock_cosmos_client = AsyncMock()
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     response = await client.post("/history/update", json=mock_request_json)
     res_json = await response.get_json()
@@ -1011,10 +1677,63 @@ async def test_update_conversation_success(
 
 
 @pytest.mark.asyncio
+@patch("app.get_history_writer")
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
+async def test_update_conversation_write_behind(
+    mock_get_cosmosdb_client,
+    mock_get_authenticated_user_details,
+    mock_get_history_writer,
+    client,
+):
+    mock_get_authenticated_user_details.return_value = {
+        "user_principal_id": "test_user_id"
+    }
+    mock_request_json = {
+        "conversation_id": "test_conversation_id",
+        "messages": [
+            {"role": "tool", "content": "tool message"},
+            {
+                "role": "assistant",
+                "id": "assistant_message_id",
+                "content": "assistant message",
+            },
+        ],
+    }
+    mock_cosmos_client = AsyncMock()
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
+    mock_writer = MagicMock()
+    mock_writer.enqueue.return_value = True
+    mock_get_history_writer.return_value = mock_writer
+
+    with patch("app.CHAT_HISTORY_WRITE_BEHIND", True):
+        response = await client.post("/history/update", json=mock_request_json)
+
+    assert response.status_code == 202
+    assert await response.get_json() == {"success": True, "queued": True}
+    mock_cosmos_client.create_message.assert_not_called()
+    user_id, conversation_id, pending = mock_writer.enqueue.call_args.args
+    assert (user_id, conversation_id) == ("test_user_id", "test_conversation_id")
+    assert [message["role"] for message in pending] == ["tool", "assistant"]
+    assert pending[0]["id"]
+    assert pending[1]["id"] == "assistant_message_id"
+    # stamped when queued, not when the background write gets to them
+    assert pending[0]["createdAt"] <= pending[1]["createdAt"]
+
+    # a full queue falls back to writing before answering
+    mock_writer.enqueue.return_value = False
+    with patch("app.CHAT_HISTORY_WRITE_BEHIND", True):
+        response = await client.post("/history/update", json=mock_request_json)
+
+    assert response.status_code == 200
+    assert mock_cosmos_client.create_message.await_count == 2
+
+
+@pytest.mark.asyncio
+@patch("app.get_authenticated_user_details")
+@patch("app.get_cosmosdb_client")
 async def test_update_conversation_no_conversation_id(
-    mock_init_cosmosdb_client, mock_get_authenticated_user_details, client
+    mock_get_cosmosdb_client, mock_get_authenticated_user_details, client
 ):
     mock_get_authenticated_user_details.return_value = {
         "user_principal_id": "test_user_id"
@@ -1038,9 +1757,9 @@ async def test_update_conversation_no_conversation_id(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_update_conversation_no_bot_messages(
-    mock_init_cosmosdb_client, mock_get_authenticated_user_details, client
+    mock_get_cosmosdb_client, mock_get_authenticated_user_details, client
 ):
     mock_get_authenticated_user_details.return_value = {
         "user_principal_id": "test_user_id"
@@ -1057,9 +1776,9 @@ async def test_update_conversation_no_bot_messages(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_update_conversation_cosmos_not_configured(
-    mock_init_cosmosdb_client, mock_get_authenticated_user_details, client
+    mock_get_cosmosdb_client, mock_get_authenticated_user_details, client
 ):
     mock_get_authenticated_user_details.return_value = {
         "user_principal_id": "test_user_id"
@@ -1076,7 +1795,7 @@ async def test_update_conversation_cosmos_not_configured(
         ],
     }
 
-    mock_init_cosmosdb_client.return_value = None
+    mock_get_cosmosdb_client.return_value = None
     response = await client.post("/history/update", json=mock_request_json)
     res_json = await response.get_json()
     assert response.status_code == 500
@@ -1085,46 +1804,121 @@ async def test_update_conversation_cosmos_not_configured(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
+@patch("app.update_generated_title")
 @patch("app.generate_title")
 @patch("app.conversation_internal")
 async def test_add_conversation_success(
     mock_conversation_internal,
     mock_generate_title,
-    mock_init_cosmosdb_client,
+    mock_update_generated_title,
+    mock_get_cosmosdb_client,
     mock_get_authenticated_user_details,
     client,
 ):
     mock_get_authenticated_user_details.return_value = {
         "user_principal_id": "test_user"
     }
-    mock_generate_title.return_value = "Test Title"
     mock_cosmos_client = AsyncMock()
     mock_cosmos_client.create_conversation.return_value = {
         "id": "test_conversation_id",
         "createdAt": "2024-10-01T00:00:00Z",
     }
     mock_cosmos_client.create_message.return_value = "Message Created"
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
     mock_conversation_internal.return_value = "Chat response"
+    messages = [{"role": "user", "content": "Hello"}]
 
-    response = await client.post(
-        "/history/generate", json={"messages": [{"role": "user", "content": "Hello"}]}
-    )
+    response = await client.post("/history/generate", json={"messages": messages})
 
     assert response.status_code == 200
+    # the title is not generated before answering
+    mock_generate_title.assert_not_called()
+    mock_cosmos_client.create_conversation.assert_awaited_once_with(
+        user_id="test_user", title="Hello"
+    )
+    request_body = mock_conversation_internal.call_args[0][0]
+    assert request_body["history_metadata"]["title"] == "Hello"
+    mock_update_generated_title.assert_called_once_with(
+        "test_user", "test_conversation_id", messages
+    )
+
+
+def test_provisional_title():
+    messages = [
+        {
+            "role": "user",
+            "content": "  What is   the outlook for my portfolio this "
+            "quarter given the recent changes in interest rates?",
+        },
+    ]
+    assert (
+        provisional_title(messages)
+        == "What is the outlook for my portfolio this quarter..."
+    )
+    assert provisional_title([{"role": "user", "content": ""}]) == "New conversation"
+
+
+@pytest.mark.asyncio
+@patch("app.get_cosmosdb_client")
+@patch("app.generate_title")
+async def test_update_generated_title(mock_generate_title, mock_get_cosmosdb_client):
+    mock_generate_title.return_value = "Portfolio Outlook"
+    mock_cosmos_client = AsyncMock()
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
+    messages = [{"role": "user", "content": "Hello"}]
+
+    await update_generated_title("test_user", "conv_1", messages)
+
+    mock_generate_title.assert_awaited_once_with(messages)
+    mock_cosmos_client.update_conversation_title.assert_awaited_once_with(
+        "test_user", "conv_1", "Portfolio Outlook", expected_title="Hello"
+    )
+
+
+@pytest.mark.asyncio
+@patch("app.get_cosmosdb_client")
+@patch("app.generate_title")
+async def test_update_generated_title_keeps_provisional_title(
+    mock_generate_title, mock_get_cosmosdb_client
+):
+    # generation failed
+    mock_generate_title.return_value = None
+    mock_cosmos_client = AsyncMock()
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
+
+    await update_generated_title(
+        "test_user", "conv_1", [{"role": "user", "content": "Hello"}]
+    )
+
+    mock_cosmos_client.update_conversation_title.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+@patch("app.get_cosmosdb_client")
+@patch("app.generate_title")
+async def test_update_generated_title_failure(
+    mock_generate_title, mock_get_cosmosdb_client
+):
+    mock_generate_title.return_value = "Portfolio Outlook"
+    mock_cosmos_client = AsyncMock()
+    mock_cosmos_client.update_conversation_title.side_effect = Exception("Test error")
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
+
+    # errors are logged, not raised into the background task runner
+    await update_generated_title("test_user", "conv_1", [])
 
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_add_conversation_no_cosmos_config(
-    mock_init_cosmosdb_client, mock_get_authenticated_user_details, client
+    mock_get_cosmosdb_client, mock_get_authenticated_user_details, client
 ):
     mock_get_authenticated_user_details.return_value = {
         "user_principal_id": "test_user"
     }
-    mock_init_cosmosdb_client.return_value = None
+    mock_get_cosmosdb_client.return_value = None
 
     response = await client.post(
         "/history/generate", json={"messages": [{"role": "user", "content": "Hello"}]}
@@ -1137,16 +1931,16 @@ async def test_add_conversation_no_cosmos_config(
 
 @pytest.mark.asyncio
 @patch("app.get_authenticated_user_details")
-@patch("app.init_cosmosdb_client")
+@patch("app.get_cosmosdb_client")
 async def test_add_conversation_conversation_not_found(
-    mock_init_cosmosdb_client, mock_get_authenticated_user_details, client
+    mock_get_cosmosdb_client, mock_get_authenticated_user_details, client
 ):
     mock_get_authenticated_user_details.return_value = {
         "user_principal_id": "test_user"
     }
     mock_cosmos_client = AsyncMock()
     mock_cosmos_client.create_message.return_value = "Conversation not found"
-    mock_init_cosmosdb_client.return_value = mock_cosmos_client
+    mock_get_cosmosdb_client.return_value = mock_cosmos_client
 
     response = await client.post(
         "/history/generate",
@@ -1164,7 +1958,7 @@ async def test_add_conversation_conversation_not_found(
 
 
 @pytest.mark.asyncio
-@patch("app.init_openai_client")
+@patch("app.get_openai_client")
 async def test_generate_title_success(mock_init_openai_client):
     mock_openai_client = AsyncMock()
     mock_openai_client.chat.completions.create.return_value = MagicMock(
@@ -1180,7 +1974,7 @@ async def test_generate_title_success(mock_init_openai_client):
 
 
 @pytest.mark.asyncio
-@patch("app.init_openai_client")
+@patch("app.get_openai_client")
 async def test_generate_title_exception(mock_init_openai_client):
     mock_openai_client = AsyncMock()
     mock_openai_client.chat.completions.create.side_effect = Exception("API error")
@@ -1188,7 +1982,7 @@ async def test_generate_title_exception(mock_init_openai_client):
 
     conversation_messages = [{"role": "user", "content": "Hello"}]
     title = await generate_title(conversation_messages)
-    assert title == "Hello"
+    assert title is None
 
 
 @pytest.mark.asyncio
@@ -1304,24 +2098,80 @@ async def test_stream_chat_request_with_azurefunction():
     }
     request_headers = {"apim-request-id": "test_id"}
 
+    def handler(request):
+        assert request.url.params["query"] == "test query:::test_client"
+        return httpx.Response(200, content=async_generator([b"chunk1", b"", b"chunk2"]))
+
+    function_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
     async with create_app().app_context():
         with patch.multiple(
             "app",
             USE_AZUREFUNCTION=True,
             STREAMING_AZUREFUNCTION_ENDPOINT="http://example.com",
-        ):
-            with patch("httpx.AsyncClient.stream") as mock_stream:
-                mock_response = AsyncMock()
-                mock_response.__aenter__.return_value.aiter_text = (
-                    lambda: async_generator(["chunk1", "chunk2"])
-                )
-                mock_stream.return_value = mock_response
-
-                generator = await stream_chat_request(request_body, request_headers)
-                chunks = [chunk async for chunk in generator]
-
-                assert len(chunks) == 2
-                assert "apim-request-id" in chunks[0]
+        ), patch("app.get_function_client", return_value=function_client):
+            generator = await stream_chat_request(request_body, request_headers)
+            chunks = [chunk async for chunk in generator]
+
+    assert len(chunks) == 2
+    frames = [json.loads(chunk) for chunk in chunks]
+    assert "apim-request-id" in frames[0]
+    assert frames[0]["id"] == frames[1]["id"]
+    assert frames[0]["object"] == "extensions.chat.completion.chunk"
+    assert [frame["choices"][0]["messages"] for frame in frames] == [
+        [{"role": "assistant", "content": "chunk1"}],
+        [{"role": "assistant", "content": "chunk2"}],
+    ]
+    assert all(chunk.endswith("\n") for chunk in chunks)
+
+
+@pytest.mark.asyncio
+async def test_complete_chat_request_with_azurefunction():
+    request_body = {
+        "history_metadata": {"conversation_id": "conv_1"},
+        "client_id": "test_client",
+        "messages": [{"content": "test query"}],
+    }
+
+    def handler(request):
+        assert request.url.params["query"] == "test query:::test_client"
+        return httpx.Response(200, content=b"line1\nline2\r\nline3\n")
+
+    function_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    with patch.multiple(
+        "app",
+        USE_PROMPTFLOW=False,
+        USE_AZUREFUNCTION=True,
+        STREAMING_AZUREFUNCTION_ENDPOINT="http://example.com/api",
+    ), patch("app.get_function_client", return_value=function_client):
+        response = await complete_chat_request(request_body, {})
+
+    assert response["history_metadata"] == {"conversation_id": "conv_1"}
+    assert response["choices"][0]["messages"] == [
+        {"role": "assistant", "content": "\nline1\nline2\nline3"}
+    ]
+
+
+@pytest.mark.asyncio
+async def test_complete_chat_request_with_azurefunction_error():
+    request_body = {
+        "history_metadata": {},
+        "client_id": "test_client",
+        "messages": [{"content": "test query"}],
+    }
+
+    def handler(request):
+        raise httpx.ConnectError("Connection refused")
+
+    function_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    with patch.multiple(
+        "app",
+        USE_PROMPTFLOW=False,
+        USE_AZUREFUNCTION=True,
+        STREAMING_AZUREFUNCTION_ENDPOINT="http://example.com/api",
+    ), patch("app.get_function_client", return_value=function_client):
+        response = await complete_chat_request(request_body, {})
+
+    assert response["choices"][0]["messages"] == [{"role": "assistant", "content": ""}]
 
 
 @pytest.mark.asyncio
@@ -0,0 +1,96 @@
+"""
+Apply the chat history indexing policy to an existing container.
+
+The policy indexes only the paths the history queries filter and sort on, plus
+composite indexes for their ORDER BY clauses; message content is not indexed.
+Cosmos DB rebuilds the index in the background and keeps serving requests while
+it does. Queries that need the new composite indexes may cost more RUs until
+the transformation finishes; the progress is printed with --wait.
+
+Containers created before the policy existed need this run once as an upgrade
+step. Until they have the composite indexes the app sorts the history on single
+fields; it switches to the ORDER BY clauses the composite indexes serve when it
+next starts (or /history/ensure is called) after the policy is applied.
+
+    python tools/apply_history_indexing_policy.py conversations --wait
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import CosmosClient
+from azure.identity.aio import DefaultAzureCredential
+from dotenv import load_dotenv
+
+# Add parent directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from backend.history.cosmosdbservice import HISTORY_INDEXING_POLICY  # noqa: E402, isort:skip
+
+
+async def wait_for_transformation(container, poll_interval):
+    while True:
+        await container.read(populate_quota_info=True)
+        progress = container.client_connection.last_response_headers.get(
+            "x-ms-documentdb-collection-index-transformation-progress"
+        )
+        print(f"Index transformation {progress}% done")
+        if progress is None or int(progress) >= 100:
+            return
+        await asyncio.sleep(poll_interval)
+
+
+async def main(args):
+    load_dotenv()
+    account = os.environ["AZURE_COSMOSDB_ACCOUNT"]
+    credential = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
+    if not credential:
+        credential = DefaultAzureCredential()
+
+    async with CosmosClient(
+        f"https://{account}.documents.azure.com:443/", credential=credential
+    ) as client:
+        database = client.get_database_client(os.environ["AZURE_COSMOSDB_DATABASE"])
+        properties = await database.get_container_client(args.container).read()
+        print("Current indexing policy:")
+        print(json.dumps(properties["indexingPolicy"], indent=2))
+
+        if args.dry_run:
+            print("New indexing policy:")
+            print(json.dumps(HISTORY_INDEXING_POLICY, indent=2))
+        else:
+            # replacing a container keeps its partition key and data
+            container = await database.replace_container(
+                args.container,
+                partition_key=PartitionKey(
+                    path=properties["partitionKey"]["paths"],
+                    kind=properties["partitionKey"]["kind"],
+                ),
+                indexing_policy=HISTORY_INDEXING_POLICY,
+                default_ttl=properties.get("defaultTtl"),
+            )
+            print(f"Applied the indexing policy to {args.container}")
+            if args.wait:
+                await wait_for_transformation(container, args.poll_interval)
+
+    if isinstance(credential, DefaultAzureCredential):
+        await credential.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("container", help="chat history container to update")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="print the policies, change nothing"
+    )
+    parser.add_argument(
+        "--wait", action="store_true", help="wait for the index to be rebuilt"
+    )
+    parser.add_argument(
+        "--poll-interval", type=float, default=10, help="seconds between checks"
+    )
+    asyncio.run(main(parser.parse_args()))
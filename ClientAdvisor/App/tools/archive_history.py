@@ -0,0 +1,78 @@
+"""
+Archive chat history items to gzip JSONL before their TTL removes them.
+
+Exports the conversations and messages last written more than --older-than-days
+ago and not archived by a previous run, to blob storage or to a local
+directory. Run it daily with --older-than-days a little under
+AZURE_COSMOSDB_HISTORY_TTL_DAYS, so every item is exported once before it
+expires; an item written again later is exported again.
+
+    python tools/archive_history.py --older-than-days 89 --blob-container-url https://<account>.blob.core.windows.net/history-archive
+    python tools/archive_history.py --older-than-days 89 --output-dir ./archive
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+
+from azure.cosmos.aio import CosmosClient
+from azure.identity.aio import DefaultAzureCredential
+from dotenv import load_dotenv
+
+# Add parent directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from backend.history.archive import BlobArchiveTarget, LocalArchiveTarget, archive_history  # noqa: E402, isort:skip
+
+
+async def main(args):
+    load_dotenv()
+    account = os.environ["AZURE_COSMOSDB_ACCOUNT"]
+    default_credential = DefaultAzureCredential()
+    credential = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY") or default_credential
+
+    container_client = None
+    if args.blob_container_url:
+        from azure.storage.blob.aio import ContainerClient
+
+        container_client = ContainerClient.from_container_url(
+            args.blob_container_url, credential=default_credential
+        )
+        target = BlobArchiveTarget(container_client)
+    else:
+        target = LocalArchiveTarget(args.output_dir)
+
+    try:
+        async with CosmosClient(
+            f"https://{account}.documents.azure.com:443/", credential=credential
+        ) as client:
+            container = client.get_database_client(
+                os.environ["AZURE_COSMOSDB_DATABASE"]
+            ).get_container_client(os.environ["AZURE_COSMOSDB_CONVERSATIONS_CONTAINER"])
+            name, count = await archive_history(container, target, args.older_than_days)
+    finally:
+        if container_client:
+            await container_client.close()
+        await default_credential.close()
+
+    if name:
+        print(f"Archived {count} item(s) to {name}")
+    else:
+        print("Nothing new to archive since the last run")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--older-than-days",
+        type=int,
+        required=True,
+        help="archive items last written more than this many days ago",
+    )
+    destination = parser.add_mutually_exclusive_group(required=True)
+    destination.add_argument(
+        "--blob-container-url", help="blob container to write the archives to"
+    )
+    destination.add_argument("--output-dir", help="directory to write the archives to")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,190 @@
+"""
+Compare the RU charge of chat history operations under two indexing policies.
+
+Two temporary containers are created in the chat history database, one with
+the default policy (every path indexed) and one with the history indexing
+policy. The same conversations, with user questions, long assistant answers
+and tool messages carrying citation JSON, are written to both, then the
+history list and message queries are run against both. The containers are
+deleted afterwards unless --keep is given.
+
+    python tools/benchmark_history_indexing.py --conversations 20 --messages 10
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import CosmosClient
+from azure.identity.aio import DefaultAzureCredential
+from dotenv import load_dotenv
+
+# Add parent directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from backend.history.cosmosdbservice import CONVERSATION_LIST_FIELDS  # noqa: E402, isort:skip
+from backend.history.cosmosdbservice import HISTORY_INDEXING_POLICY  # noqa: E402, isort:skip
+
+USER_ID = "benchmark-user"
+
+
+def request_charge(container):
+    return float(
+        container.client_connection.last_response_headers["x-ms-request-charge"]
+    )
+
+
+def sample_items(conversations, messages):
+    # shaped like the documents the app writes, with the long contents that
+    # make up most of a message's size
+    start = datetime(2024, 1, 1)
+    citations = {
+        "citations": [
+            {
+                "content": "Client meeting notes. " * 40,
+                "title": f"Document {index}",
+                "url": f"https://example.com/documents/{index}",
+                "chunk_id": str(index),
+            }
+            for index in range(5)
+        ]
+    }
+    roles = ["user", "tool", "assistant"]
+    for conversation_index in range(conversations):
+        conversation_id = str(uuid.uuid4())
+        created_at = start + timedelta(hours=conversation_index)
+        yield {
+            "id": conversation_id,
+            "type": "conversation",
+            "userId": USER_ID,
+            "conversationId": conversation_id,
+            "createdAt": created_at.isoformat(),
+            "updatedAt": created_at.isoformat(),
+            "title": f"Conversation {conversation_index}",
+        }
+        for message_index in range(messages):
+            role = roles[message_index % len(roles)]
+            if role == "user":
+                content = "What changed in the client's portfolio this quarter?"
+            elif role == "tool":
+                content = json.dumps(citations)
+            else:
+                content = "The portfolio was rebalanced towards bonds. " * 60
+            yield {
+                "id": str(uuid.uuid4()),
+                "type": "message",
+                "userId": USER_ID,
+                "conversationId": conversation_id,
+                "createdAt": (
+                    created_at + timedelta(seconds=message_index)
+                ).isoformat(),
+                "updatedAt": created_at.isoformat(),
+                "role": role,
+                "content": content,
+                "feedback": "",
+            }
+
+
+async def query_charge(container, query, parameters):
+    charge = 0
+    pages = container.query_items(
+        query=query, parameters=parameters, partition_key=USER_ID
+    ).by_page()
+    async for page in pages:
+        async for _ in page:
+            pass
+        charge += request_charge(container)
+    return charge
+
+
+async def run(container, items, composite_order_by):
+    charges = {"conversation writes": 0, "message writes": 0}
+    conversation_ids = []
+    for item in items:
+        await container.upsert_item(item)
+        if item["type"] == "conversation":
+            conversation_ids.append(item["id"])
+            charges["conversation writes"] += request_charge(container)
+        else:
+            charges["message writes"] += request_charge(container)
+
+    # the default policy has no composite indexes for the equality-prefixed
+    # ORDER BY clauses, so it is queried the way the app queries such containers
+    if composite_order_by:
+        conversations_order_by = "c.userId DESC, c.type DESC, c.updatedAt DESC"
+        messages_order_by = "c.userId, c.type, c.conversationId, c.createdAt"
+    else:
+        conversations_order_by = "c.updatedAt DESC"
+        messages_order_by = "c.createdAt"
+    parameters = [{"name": "@userId", "value": USER_ID}]
+    charges["history list"] = await query_charge(
+        container,
+        f"SELECT {CONVERSATION_LIST_FIELDS} FROM c where c.userId = @userId and c.type='conversation' order by {conversations_order_by}",
+        parameters,
+    )
+    charges["message reads"] = 0
+    for conversation_id in conversation_ids:
+        charges["message reads"] += await query_charge(
+            container,
+            f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY {messages_order_by}",
+            parameters + [{"name": "@conversationId", "value": conversation_id}],
+        )
+    return charges
+
+
+async def main(args):
+    load_dotenv()
+    account = os.environ["AZURE_COSMOSDB_ACCOUNT"]
+    credential = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
+    if not credential:
+        credential = DefaultAzureCredential()
+
+    items = list(sample_items(args.conversations, args.messages))
+    suffix = uuid.uuid4().hex[:8]
+    policies = {"default": None, "history": HISTORY_INDEXING_POLICY}
+    results = {}
+
+    async with CosmosClient(
+        f"https://{account}.documents.azure.com:443/", credential=credential
+    ) as client:
+        database = client.get_database_client(os.environ["AZURE_COSMOSDB_DATABASE"])
+        for name, policy in policies.items():
+            container_id = f"indexing_benchmark_{name}_{suffix}"
+            options = {"indexing_policy": policy} if policy else {}
+            container = await database.create_container(
+                container_id, partition_key=PartitionKey(path="/userId"), **options
+            )
+            try:
+                results[name] = await run(container, items, policy is not None)
+            finally:
+                if not args.keep:
+                    await database.delete_container(container_id)
+
+    if isinstance(credential, DefaultAzureCredential):
+        await credential.close()
+
+    print(f"{args.conversations} conversation(s) with {args.messages} message(s) each")
+    print(f"{'RU':<22}{'default':>12}{'history':>12}{'change':>10}")
+    for operation, default in results["default"].items():
+        history = results["history"][operation]
+        change = f"{(history - default) / default:+.0%}" if default else ""
+        print(f"{operation:<22}{default:>12.2f}{history:>12.2f}{change:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--conversations", type=int, default=20, help="conversations to write"
+    )
+    parser.add_argument(
+        "--messages", type=int, default=9, help="messages per conversation"
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the containers for inspection"
+    )
+    asyncio.run(main(parser.parse_args()))
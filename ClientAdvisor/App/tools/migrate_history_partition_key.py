@@ -0,0 +1,116 @@
+"""
+Copy the chat history container into one partitioned by (userId, conversationId).
+
+Every item is upserted into the target container with a conversationId, which
+conversations, jobs and the conversation index documents get from their own
+id. The source container is left untouched, so the copy can be run again to
+pick up writes made while it ran. Deletes made in the meantime are not copied.
+
+Once the copy is done, point AZURE_COSMOSDB_CONVERSATIONS_CONTAINER at the
+target container and set AZURE_COSMOSDB_HIERARCHICAL_PARTITION_KEY=true.
+
+    python tools/migrate_history_partition_key.py conversations conversations_v2
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import CosmosClient
+from azure.identity.aio import DefaultAzureCredential
+from dotenv import load_dotenv
+
+# Add parent directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from backend.history.cosmosdbservice import HIERARCHICAL_PARTITION_KEY  # noqa: E402, isort:skip
+from backend.history.cosmosdbservice import HISTORY_INDEXING_POLICY  # noqa: E402, isort:skip
+
+# Cosmos DB sets these on every item; the target container sets its own
+SYSTEM_PROPERTIES = ("_rid", "_self", "_etag", "_attachments", "_ts")
+
+
+def migrate_item(item):
+    migrated = {
+        key: value for key, value in item.items() if key not in SYSTEM_PROPERTIES
+    }
+    migrated.setdefault("conversationId", item["id"])
+    return migrated
+
+
+async def copy_items(source, target, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = []
+    copied = 0
+
+    async def copy_item(item):
+        nonlocal copied
+        async with semaphore:
+            try:
+                await target.upsert_item(migrate_item(item))
+                copied += 1
+            except Exception as e:
+                failures.append((item["id"], e))
+
+    tasks = set()
+    async for item in source.read_all_items():
+        tasks.add(asyncio.create_task(copy_item(item)))
+        # keep the number of waiting tasks bounded on large containers
+        if len(tasks) >= concurrency * 10:
+            _, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    if tasks:
+        await asyncio.wait(tasks)
+
+    return copied, failures
+
+
+async def main(args):
+    load_dotenv()
+    account = os.environ["AZURE_COSMOSDB_ACCOUNT"]
+    credential = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
+    if not credential:
+        credential = DefaultAzureCredential()
+
+    async with CosmosClient(
+        f"https://{account}.documents.azure.com:443/", credential=credential
+    ) as client:
+        database = client.get_database_client(os.environ["AZURE_COSMOSDB_DATABASE"])
+        source = database.get_container_client(args.source)
+        target = await database.create_container_if_not_exists(
+            id=args.target,
+            partition_key=PartitionKey(
+                path=HIERARCHICAL_PARTITION_KEY, kind="MultiHash"
+            ),
+            indexing_policy=HISTORY_INDEXING_POLICY,
+        )
+
+        properties = await target.read()
+        if properties["partitionKey"]["paths"] != HIERARCHICAL_PARTITION_KEY:
+            sys.exit(
+                f"Container {args.target} is not partitioned by userId, conversationId"
+            )
+
+        copied, failures = await copy_items(source, target, args.concurrency)
+
+    if isinstance(credential, DefaultAzureCredential):
+        await credential.close()
+
+    print(f"Copied {copied} item(s) from {args.source} to {args.target}")
+    for item_id, error in failures:
+        print(f"Failed to copy {item_id}: {error}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("source", help="container to copy from")
+    parser.add_argument(
+        "target", help="container to copy to, created if it does not exist"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=16, help="upserts kept in flight"
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -3,7 +3,12 @@ import os
 import logging
 import requests
 import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from flask import Flask, Response, request, jsonify, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from dotenv import load_dotenv
 import urllib.request
 import json
@@ -11,9 +16,43 @@ import os
 
 import asyncio
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 load_dotenv()
 
+# Keep the stdlib's acceptance of int/float dict keys; datetimes go through the
+# caller's default hook, as they would with json.dumps
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME if orjson else 0
+
+def json_dumps(obj, default=None):
+    # orjson when it is installed, json.dumps when it is not or cannot encode obj
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=default, option=ORJSON_OPTIONS).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(obj, default=default, ensure_ascii=False)
+
+def json_loads(s):
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
+
+class JSONProvider(DefaultJSONProvider):
+    # jsonify and request.json through the fast JSON helpers
+    def dumps(self, obj, **kwargs):
+        if "indent" in kwargs:
+            return super().dumps(obj, **kwargs)
+        return json_dumps(obj, default=self.default)
+
+    def loads(self, s, **kwargs):
+        return json_loads(s)
+
 app = Flask(__name__, static_folder="static")
+app.json = JSONProvider(app)
 
 # Static Files
 @app.route("/")
@@ -54,6 +93,8 @@ AZURE_SEARCH_URL_COLUMN = os.environ.get("AZURE_SEARCH_URL_COLUMN")
 AZURE_SEARCH_VECTOR_COLUMNS = os.environ.get("AZURE_SEARCH_VECTOR_COLUMNS")
 AZURE_SEARCH_QUERY_TYPE = os.environ.get("AZURE_SEARCH_QUERY_TYPE")
 AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_COLUMN")
+AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL = float(os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL", 300))
+AZURE_SEARCH_PERMITTED_GROUPS_CACHE_SIZE = int(os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_CACHE_SIZE", 1024))
 AZURE_SEARCH_STRICTNESS = os.environ.get("AZURE_SEARCH_STRICTNESS", SEARCH_STRICTNESS)
 AZURE_SEARCH_INDEX_GRANTS = os.environ.get("AZURE_SEARCH_INDEX_GRANTS")
 AZURE_SEARCH_INDEX_ARTICLES = os.environ.get("AZURE_SEARCH_INDEX_ARTICLES")
@@ -87,6 +128,14 @@ frontend_settings = { "auth_enabled": AUTH_ENABLED }
 loop = asyncio.new_event_loop()
 asyncio.set_event_loop(loop)
 
+# Pooled connections to Microsoft Graph for group membership lookups
+graph_session = requests.Session()
+# sha256 of the user token -> (expiry, groups), least recently used first
+user_groups_cache = OrderedDict()
+user_groups_lock = threading.Lock()
+# sha256 of the user token -> lock held while that user's groups are fetched
+user_groups_fetch_locks = {}
+
 def is_chat_model():
     if 'gpt-4' in AZURE_OPENAI_MODEL_NAME.lower() or AZURE_OPENAI_MODEL_NAME.lower() in ['gpt-35-turbo-4k', 'gpt-35-turbo-16k']:
         return True
@@ -101,7 +150,7 @@ def should_use_data():
     return False
 
 def format_as_ndjson(obj: dict) -> str:
-    return json.dumps(obj, ensure_ascii=False) + "\n"
+    return json_dumps(obj) + "\n"
 
 def parse_multi_columns(columns: str) -> list:
     if "|" in columns:
@@ -109,36 +158,64 @@ def parse_multi_columns(columns: str) -> list:
     else:
         return columns.split(",")
 
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
-    
+def fetchUserGroups(userToken):
+    # Fetch group membership, following @odata.nextLink page by page.
+    # Returns None when Graph could not be queried.
+    endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+
     headers = {
         'Authorization': "bearer " + userToken
     }
+    groups = []
     try :
-        r = requests.get(endpoint, headers=headers)
-        if r.status_code != 200:
-            if DEBUG_LOGGING:
-                logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
-            return []
-        
-        r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r['value'].extend(nextLinkData)
-        
-        return r['value']
+        while endpoint:
+            r = graph_session.get(endpoint, headers=headers)
+            if r.status_code != 200:
+                if DEBUG_LOGGING:
+                    logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
+                return None
+
+            r = r.json()
+            groups.extend(r['value'])
+            endpoint = r.get("@odata.nextLink")
+
+        return groups
     except Exception as e:
         logging.error(f"Exception in fetchUserGroups: {e}")
-        return []
+        return None
+
+def getUserGroups(userToken):
+    # Serve group membership from the TTL cache; concurrent requests of the same
+    # user wait on one Graph lookup instead of issuing their own
+    cacheKey = hashlib.sha256(userToken.encode("utf-8")).hexdigest()
+    with user_groups_lock:
+        cached = user_groups_cache.get(cacheKey)
+        if cached and cached[0] > time.monotonic():
+            user_groups_cache.move_to_end(cacheKey)
+            return cached[1]
+        fetchLock = user_groups_fetch_locks.setdefault(cacheKey, threading.Lock())
+
+    with fetchLock:
+        with user_groups_lock:
+            cached = user_groups_cache.get(cacheKey)
+            if cached and cached[0] > time.monotonic():
+                user_groups_cache.move_to_end(cacheKey)
+                return cached[1]
+
+        groups = fetchUserGroups(userToken)
+        with user_groups_lock:
+            user_groups_fetch_locks.pop(cacheKey, None)
+            # Failed lookups are not cached so the next request retries Graph
+            if groups is not None and AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL > 0:
+                user_groups_cache[cacheKey] = (time.monotonic() + AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL, groups)
+                user_groups_cache.move_to_end(cacheKey)
+                while len(user_groups_cache) > AZURE_SEARCH_PERMITTED_GROUPS_CACHE_SIZE:
+                    user_groups_cache.popitem(last=False)
+        return groups or []
 
 def generateFilterString(userToken):
     # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
+    userGroups = getUserGroups(userToken)
 
     # Construct filter string
     if not userGroups:
@@ -248,8 +325,8 @@ def stream_with_data(body, headers, endpoint, history_metadata={}):
             with s.post(endpoint, json=body, headers=headers, stream=True) as r:
                 for line in r.iter_lines(chunk_size=10):
                     try:
-                        rawResponse = json.loads(line.lstrip(b'data:').decode('utf-8'))["answer"]
-                        lineJson = json.loads(rawResponse)
+                        rawResponse = json_loads(line.lstrip(b'data:'))["answer"]
+                        lineJson = json_loads(rawResponse)
                     except json.decoder.JSONDecodeError:
                         continue
 
@@ -278,10 +355,10 @@ def stream_with_data(body, headers, endpoint, history_metadata={}):
 
                     if line:
                         if AZURE_OPENAI_PREVIEW_API_VERSION == '2023-06-01-preview':
-                            lineJson = json.loads(line.lstrip(b'data:').decode('utf-8'))
+                            lineJson = json_loads(line.lstrip(b'data:'))
                         else:
                             try:
-                                rawResponse = json.loads(line.lstrip(b'data:').decode('utf-8'))
+                                rawResponse = json_loads(line.lstrip(b'data:'))
                                 lineJson = formatApiResponseStreaming(rawResponse)
                             except json.decoder.JSONDecodeError:
                                 continue